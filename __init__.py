@@ -10,6 +10,9 @@ import numpy
 import json
 import hashlib
 import uuid
+import time
+
+module_t0 = time.time()
 
 analyzer_enabled = False
 normalizer_enabled = False
@@ -51,12 +54,13 @@ from .armature import (
     rescale_one_bone
 )
 
-from . import add_extras, importer, armature, solve_for_deform, attributes
+from . import add_extras, importer, armature, solve_for_deform, attributes, extras_scheduler, shape_key_store, preset_store, preset_journal, preset_scanner, character_library, dump_watcher, library_builder, extras_cache
 
 from bpy.props import (
     BoolProperty,
     EnumProperty,
     FloatProperty,
+    IntProperty,
     PointerProperty,
     StringProperty,
     FloatVectorProperty
@@ -101,26 +105,131 @@ preset_favorites=set()
 waifus_path=""
 presets_dirty = False
 
-def get_preset_list(self, context):
-    preset_list = []
+# Presets live in assets/hs2blender.db (see preset_store); hs2blender.json is imported into it on first use.
+preset_db = None
+# Journal records not yet applied to the store; a save writes only the presets they name
+pending_records = []
+# Presets came from the legacy .cfg and are not in the store yet, the next save writes all of them
+store_stale = False
+
+#
+# Journaled edits (see preset_journal) and debounced autosave
+#
+
+autosave_delay = 5.0
+
+def autosave():
+    try:
+        flush_presets()
+    except Exception as e:
+        print("Preset autosave failed:", e)
+    return None
+
+def journal(record):
+    preset_journal.append(record)
+    pending_records.append(record)
+    try:
+        if bpy.app.timers.is_registered(autosave):
+            bpy.app.timers.unregister(autosave)
+        bpy.app.timers.register(autosave, first_interval=autosave_delay)
+    except:
+        pass
+
+def journal_field(p, field):
+    value = p.as_dict()[field]
+    if not isinstance(value, (str, int, float, bool, list, dict, type(None))):
+        value = list(value)
+    journal({"op": "field", "uuid": p["uuid"], "field": field, "value": value})
+
+def find_preset_by_uuid(uid):
+    return update_preset_catalog()["by_uuid"].get(uid, None)
+
+# Applies journal records left over from a session that ended before they were saved
+def replay_journal():
+    global waifus_path
+    records = preset_journal.read()
+    pending_records.extend(records)
+    for r in records:
+        if r["op"]=="field":
+            x = find_preset_by_uuid(r["uuid"])
+            if x is None:
+                continue
+            p = preset_map[x]
+            if r["field"] in ["name", "path", "eye_color", "hair_color"]:
+                setattr(p, r["field"], r["value"])
+                presets_changed()
+            else:
+                p[r["field"]] = r["value"]
+        elif r["op"]=="add":
+            # (convert_preset_from_dict empties the dict it is given, the record stays pending)
+            preset_map[r["id"]] = convert_preset_from_dict(dict(r["preset"]))
+            presets_changed()
+        elif r["op"]=="delete":
+            x = find_preset_by_uuid(r["uuid"])
+            if x is not None:
+                preset_map.pop(x)
+                presets_changed()
+        elif r["op"]=="favorite":
+            if r["on"]:
+                preset_favorites.add(r["uuid"])
+            else:
+                preset_favorites.discard(r["uuid"])
+            presets_changed()
+        elif r["op"]=="setting" and r["key"]=="waifus_path":
+            waifus_path = r["value"]
+    return len(records)
+
+# Dropdown items and the uuid index are rebuilt only when the list changes (presets added, renamed,
+# deleted or (un)favorited, see presets_changed()), not on every redraw. Blender also needs the items list
+# returned to an EnumProperty to stay referenced, which preset_catalog does.
+preset_catalog_version = 0
+preset_catalog = {"version": -1, "items": [], "by_uuid": {}}
+
+def presets_changed():
+    global preset_catalog_version
+    preset_catalog_version += 1
+
+def update_preset_catalog():
+    ensure_presets()
+    if preset_catalog["version"]==preset_catalog_version:
+        return preset_catalog
+    items = []
+    by_uuid = {}
     for k in preset_map:
         name = preset_map[k].name
         if preset_map[k]["uuid"] in preset_favorites:
             # Blender UI seems unable to handle non-ASCII characters in drop-down menus, at least in Linux
             # (although they are fine in texts/labels); so, we can't use any of the natural options like ⭐ ٭ ★ etc.
             name = "* " + name + " *"
-        preset_list.append((str(k), name, preset_map[k]["uuid"], k))
-    return preset_list
+        items.append((str(k), name, preset_map[k]["uuid"], k))
+        by_uuid[preset_map[k]["uuid"]] = k
+    preset_catalog["version"] = preset_catalog_version
+    preset_catalog["items"] = items
+    preset_catalog["by_uuid"] = by_uuid
+    return preset_catalog
+
+def get_preset_list(self, context):
+    return update_preset_catalog()["items"]
 
 def get_export_dir(self):
+    ensure_presets()
     return waifus_path
 
 def set_export_dir(self, x):
     global waifus_path, presets_dirty
+    ensure_presets()
     if x!=waifus_path:
         presets_dirty = True
+        journal({"op": "setting", "key": "waifus_path", "value": x})
     waifus_path=x
 
+# Plugin-wide for the session, like the other module switches (see extras_cache)
+def get_cache_formulas(self):
+    return extras_cache.use_cache
+
+def set_cache_formulas(self, x):
+    extras_cache.use_cache = x
+
 #
 #
 #   PRESET LIST
@@ -184,10 +293,46 @@ def convert_preset_from_dict(dict_preset):
         pr[x]=dict_preset[x]
     return pr
 
+#
+# Presets and the texture index are loaded on first use (panel draw, preset lookup, import) or by an idle timer
+# shortly after startup, not in register().
+#
+
+presets_loaded = False
+textures_indexed = False
+startup_phases = []
+deferred_load_delay = 2.0
+
+def timed_phase(name, func):
+    t1 = time.time()
+    func()
+    t2 = time.time()
+    startup_phases.append((name, t2-t1))
+
+def ensure_presets():
+    if not presets_loaded:
+        timed_phase("Load presets", load_presets)
+
+def ensure_texture_index():
+    ensure_presets()
+    if not textures_indexed:
+        timed_phase("Index textures", index_textures)
+
+def deferred_load():
+    ensure_texture_index()
+    startup_report()
+    return None
+
+def startup_report():
+    print("HS2 add-on startup:")
+    for name, t in startup_phases:
+        print("    %-20s %8.3f s" % (name, t))
+
 def load_presets():
     print("load_presets")
-    global preset_map, waifus_path, presets_dirty, stored_json_preset_map, preset_favorites
+    global preset_map, waifus_path, presets_dirty, stored_json_preset_map, preset_favorites, preset_db, store_stale, presets_loaded
     preset_map={}
+    presets_loaded = True
     # Tricky! I can't write 'preset_list=[]', because there's a reference to the _original_ instance of preset_list
     # stored inside hs2rig_data.presets. And if I simply reassign it, the UI will keep on using the old list.
     #preset_list.clear()
@@ -196,25 +341,24 @@ def load_presets():
     loaded = False
 
     cfg_path = os.path.dirname(__file__)+"/assets/hs2blender.json"
+    db_path = os.path.dirname(__file__)+"/assets/hs2blender.db"
     try:
-        fp=open(cfg_path, "r")
-        cfg = json.load(fp)
-        fp.close()
-        waifus_path = cfg["waifus_path"]
-        json_preset_map = cfg["presets"]
-        if "favorites" in cfg:
-            preset_favorites=set(cfg["favorites"])
-        for x in json_preset_map:
-            preset_map[int(x)]=json_preset_map[x]
-            if isinstance(preset_map[int(x)], list):
-                preset_map[int(x)] = convert_preset(preset_map[int(x)])
-            elif isinstance(preset_map[int(x)], dict):
-                preset_map[int(x)] = convert_preset_from_dict(preset_map[int(x)])
-            else:
-                print("Unexpected preset type")
-        loaded = True
-    except:
-        pass
+        if preset_db is None:
+            # no store yet, or an empty one left by an interrupted import
+            if os.path.exists(cfg_path) and preset_store.stored_preset_count(db_path)==0:
+                print("Importing", cfg_path, "into", db_path)
+                preset_store.create_from_json(db_path, cfg_path)
+            preset_db = preset_store.open_store(db_path)
+        waifus_path = preset_store.get_setting(preset_db, "waifus_path", "")
+        preset_favorites = preset_store.favorites(preset_db)
+        for x, d in preset_store.all_presets(preset_db).items():
+            preset_map[x] = convert_preset_from_dict(d)
+        loaded = len(preset_map)>0
+        if loaded:
+            # the presets as they were at the start of the session
+            preset_store.backup(preset_db, db_path+".bak")
+    except Exception as e:
+        print("Failed to open the preset store:", e)
     if not loaded:
         try:
             cfg=open(config_path,"r").readlines()
@@ -238,6 +382,19 @@ def load_presets():
                 index+=1
         except:
             pass
+    store_stale = not loaded
+    pending_records.clear()
+    presets_changed()
+    replayed = replay_journal()
+    if replayed>0:
+        print("Recovered", replayed, "unsaved preset edits")
+        flush_presets()
+
+# Adds the textures of every preset's dump to importer.hash_to_file_map (assets/hash_map.txt keeps the
+# ones already hashed)
+def index_textures():
+    global textures_indexed
+    textures_indexed = True
     n = 0
 
     #for x in preset_map:
@@ -317,42 +474,77 @@ def preset_update(self, context):
     p = find_preset(hs2object())
     if p is not None:
         for x in v:
-            p[x]=v[x]
+            if (not x in p) or p[x]!=v[x]:
+                p[x]=v[x]
+                journal_field(p, x)
 
 def save_presets():
-    global presets_dirty
     preset_update(None,None)
-
-    cfg_path = os.path.dirname(__file__)+"/assets/hs2blender.json"
-
-    cfg = {
-    "waifus_path":waifus_path,
-    "presets":{x:preset_map[x].as_dict() for x in preset_map},
-    "favorites": list(preset_favorites)
-    }
-    #print(preset_map)
-    s = json.dumps(cfg, indent=4)
-    importer.save_with_backup(s, cfg_path)
+    flush_presets()
+
+# Writes the presets named by the pending journal records to the store and empties the journal
+def flush_presets():
+    global presets_dirty, preset_db, store_stale
+    t1 = time.time()
+    if preset_db is None:
+        preset_db = preset_store.open_store(os.path.dirname(__file__)+"/assets/hs2blender.db")
+    changed = set()
+    deleted = set()
+    favorites = {}
+    for r in pending_records:
+        if r["op"]=="field":
+            changed.add(r["uuid"])
+        elif r["op"]=="add":
+            changed.add(r["preset"]["uuid"])
+        elif r["op"]=="delete":
+            changed.discard(r["uuid"])
+            deleted.add(r["uuid"])
+        elif r["op"]=="favorite":
+            favorites[r["uuid"]] = r["on"]
+    if store_stale:
+        changed = set(preset_map[x]["uuid"] for x in preset_map)
+        stored_favorites = preset_store.favorites(preset_db)
+        favorites = {x: x in preset_favorites for x in preset_favorites ^ stored_favorites}
+    for x in changed:
+        id = find_preset_by_uuid(x)
+        if id is not None:
+            preset_store.put_preset(preset_db, id, preset_map[id].as_dict())
+    for x in deleted:
+        preset_store.delete_preset(preset_db, x)
+    for x in favorites:
+        preset_store.set_favorite(preset_db, x, favorites[x])
+    preset_store.set_setting(preset_db, "waifus_path", waifus_path)
+    pending_records.clear()
+    store_stale = False
+    preset_journal.clear()
     presets_dirty = False
+    t2 = time.time()
+    print("Saved %d changed and %d deleted presets in %.3f s" % (len(changed), len(deleted), t2-t1))
     return
 
 def delete_preset():
     global preset_map, presets_dirty
+    ensure_presets()
     id=bpy.context.scene.hs2rig_data.presets
     print("delete_preset", id)
+    journal({"op": "delete", "uuid": preset_map[int(id)]["uuid"]})
     preset_map.pop(int(id))
+    presets_changed()
     if int(id)-1 in preset_map:
         bpy.context.scene.hs2rig_data.presets = str(int(id)-1)
 
-def add_new_preset(h):
+def add_new_preset(h, name=None):
     if h is None:
         return
     global preset_map, presets_dirty
+    ensure_presets()
     value = len(preset_map)
-    s = bpy.context.scene.hs2rig_data.char_name
+    s = name if name is not None else bpy.context.scene.hs2rig_data.char_name
     preset_map[value] = Preset(s, h["dump_dir"], h["Eye color"][:], h["Hair color"][:])
     #preset_list.append((str(value), s, preset_map[value]["uuid"], value))
     h["preset_uuid"] = preset_map[value]["uuid"]
+    journal({"op": "add", "id": value, "preset": preset_map[value].as_dict()})
+    presets_changed()
     preset_update(None,None)
 
 def find_preset(h):
@@ -360,10 +552,8 @@ def find_preset(h):
         return None
     if not "preset_uuid" in h:
         return None
-    for p in preset_map:
-        if preset_map[p]["uuid"]==h["preset_uuid"]:
-            return preset_map[p]
-    return None
+    x = find_preset_by_uuid(h["preset_uuid"])
+    return preset_map[x] if x is not None else None
 
 analyzer_report=''
 
@@ -485,6 +675,14 @@ def standard_pose_select(self, value):
    self['standard_pose']=value
    set_fixed_pose(bpy.context, value)
 
+subdivide_mode_options=[
+("BAKED","Baked","Apply one level of subdivision to the mesh (shape keys and weights are subdivided too)"),
+("MASKED","Masked","Keep the base mesh and subdivide the same regions with a geometry nodes modifier, at render time only by default")
+]
+
+extras_mod_options=[("CHANGED","Edited","Every mod whose inputs changed since it last ran")] + [
+(m.name, m.name.replace('_', ' ').capitalize(), "Run this mod again, then the mods depending on it") for m in extras_scheduler.mods if m.rerun]
+
 injector_options=[
 ("Auto","Auto","Autodetect"),
 ("Yes","Yes","Attach"),
@@ -505,13 +703,16 @@ def set_attr(name, x, store=True):
                 if name=="Eye color":
                     if p.set_eye_color(x):
                         presets_dirty = True
+                        journal_field(p, "eye_color")
                 elif name=="Hair color":
                     if p.set_hair_color(x):
                         presets_dirty = True
+                        journal_field(p, "hair_color")
                 else:
                     if (not name in p) or (p[name] != x):
                         p[name] = x
                         presets_dirty = True
+                        journal_field(p, name)
 
     attributes.set_attr(name, x)
 
@@ -529,6 +730,71 @@ def WrapProperty(prop, name, store=True, **kwargs):
         default=get_default_attr(name),
         **kwargs)
 
+# Guess the character's name from the dump directory
+def dump_name(s):
+    name = os.path.basename(s)
+    while len(name) and (name[0].isdigit() or name[0]=='_'):
+        name=name[1:]
+    return name
+
+# Import settings of the panel, as import_body() arguments
+def import_options(context):
+    d = context.scene.hs2rig_data
+    return dict(refactor=d.refactor, do_extend_safe=d.extend_safe, do_extend_full=d.extend_full,
+        replace_teeth=d.replace_teeth, add_injector=d.add_injector, add_exhaust=d.add_exhaust,
+        subdivide=d.subdivide, subdivide_mode=d.subdivide_mode, reweight_clothing=d.reweight_clothing)
+
+# Options that decide what a cached character looks like (see character_library.is_current())
+def cache_options(kwargs):
+    out = {}
+    for x in kwargs:
+        if x in ['input', 'name']:
+            continue
+        v = kwargs[x]
+        out[x] = v if isinstance(v, (str, int, float, bool, type(None))) else list(v)
+    return out
+
+#
+# Export directory watcher (see dump_watcher): new dumps in the export directory are queued for import
+# once they are complete and have stopped changing; each finished character gets a preset and is saved
+# to the import cache (character_library).
+#
+
+def watch_exports():
+    context = bpy.context
+    if not context.scene.hs2rig_data.watch_exports:
+        return None
+    ensure_presets()
+    for d in dump_watcher.poll(waifus_path):
+        name = dump_name(d)
+        print("New dump:", d)
+        kwargs = dict(input=d, c_eye=(0.0, 0.0, 0.8), c_hair=(0.8, 0.8, 0.5), name=name, customization=None)
+        kwargs.update(import_options(context))
+
+        def done(arm, name=name, kwargs=kwargs):
+            if arm is None:
+                return
+            add_new_preset(arm, name)
+            bpy.context.scene.hs2rig_data.standard_poses="T"
+            if bpy.context.scene.hs2rig_data.characters_in_libraries:
+                # queue_import() moves it to the library
+                return
+            try:
+                character_library.write(arm, cache_options(kwargs))
+            except Exception as e:
+                print("Failed to write the import cache:", e)
+
+        queue_import(context, name, kwargs, done)
+    return dump_watcher.poll_interval
+
+def toggle_watcher(self, context):
+    if bpy.app.timers.is_registered(watch_exports):
+        bpy.app.timers.unregister(watch_exports)
+    if self.watch_exports:
+        ensure_presets()
+        dump_watcher.start(waifus_path, [preset_map[x].get_path() for x in preset_map])
+        bpy.app.timers.register(watch_exports, first_interval=dump_watcher.poll_interval, persistent=True)
+
 class hs2rig_props(PropertyGroup):
     #
     #   Plugin-wide settings
@@ -541,6 +807,20 @@ class hs2rig_props(PropertyGroup):
         set=set_export_dir,
         subtype="DIR_PATH",
     )
+    build_in_workers: BoolProperty(name="Build in workers", default=False,
+        description="Load all presets / Load favorite presets: build the characters missing from the import cache in parallel background Blender processes, then link them all into the scene through library overrides")
+    worker_count: IntProperty(name="Workers", default=2, min=1, max=32,
+        description="Number of background Blender processes building characters at the same time")
+    worker_memory_gb: FloatProperty(name="Memory per worker (GB)", default=8.0, min=0.0,
+        description="Memory cap of each background build process (0 = no cap; not enforced on Windows)")
+    characters_in_libraries: BoolProperty(name="Keep characters in libraries", default=False,
+        description="Save every imported character to a library .blend in its dump directory and link it into the scene, instead of keeping all its data in this file")
+    watch_exports: BoolProperty(name="Watch export directory", default=False, update=toggle_watcher,
+        description="Import new dumps as they appear in the export directory (once they stop changing), add presets for them and save them to the import cache")
+    use_import_cache: BoolProperty(name="Use import cache", default=True,
+        description="Load a preset from the library .blend in its dump directory that was built with the same settings, if the dump has not changed since")
+    cache_formulas: BoolProperty(name="Cache formula results", get=get_cache_formulas, set=set_cache_formulas,
+        description="Reuse the vertex group and shape key formula results of the extras between characters with the same mesh topology. Formulas that depend on a character's shape are still evaluated for it")
     presets: bpy.props.EnumProperty(items=get_preset_list,
             description="description",
             default=None
@@ -564,6 +844,10 @@ class hs2rig_props(PropertyGroup):
         )
     subdivide: BoolProperty(name="Subdivide", default=True,
         description="Bake one level of subdivision into the mesh in the face and other critical areas. Improves quality of new shape keys. Ignored if the import is high-poly")
+    subdivide_mode: EnumProperty(name="Subdivision mode",
+        items=subdivide_mode_options,
+        default="BAKED",
+        description="How subdivision is added to the face, hands and feet")
     extend_safe: BoolProperty(name="Extend (safe)", default=True,
         description="Apply various enhancements to the mesh and the rig")
     extend_full: BoolProperty(name="Extend (full)", default=False,
@@ -613,6 +897,10 @@ class hs2rig_props(PropertyGroup):
         default="", 
         description=""
     )
+    extras_mod: EnumProperty(name="Mod",
+        items=extras_mod_options,
+        default="CHANGED",
+        description="Extra to run again on the selected character")
  
     def execute(self, context):
         return {'FINISHED'}
@@ -676,6 +964,56 @@ def set_fixed_pose(context, pose):
 #
 #
 
+# Old command names of mods, now run through extras_scheduler
+command_aliases = {
+    'nails': 'tweak_nails',
+    'lip_shape': 'lip_arch',
+    'nose_shape': 'nasolabial_crease',
+}
+
+class hs2rig_OT_rerun_extras(Operator):
+    bl_idname = "object.rerun_extras"
+    bl_label = "Rerun"
+    bl_description = "Runs the selected mod again (or every mod with edited inputs), then the mods downstream of it whose inputs changed"
+    bl_options = {'REGISTER', 'UNDO'}
+    def execute(self, context):
+        arm = hs2object()
+        if arm is None:
+            return {'FINISHED'}
+        mod = context.scene.hs2rig_data.extras_mod
+        ran, stale = extras_scheduler.rerun(arm, arm["body"], None if mod=='CHANGED' else mod)
+        if len(stale)>0:
+            self.report({'WARNING'}, "Re-import to update: " + ", ".join(stale))
+        else:
+            self.report({'INFO'}, "Ran " + (", ".join(ran) if len(ran)>0 else "nothing, all mods up to date"))
+        return {'FINISHED'}
+
+class hs2rig_OT_compact_shape_keys(Operator):
+    bl_idname = "object.compact_shape_keys"
+    bl_label = "Compact shape keys"
+    bl_description = "Drops generated shape keys identical to Basis or to another key, and moves the generated keys that are off into a compressed file next to the dump (they come back when a preset uses them, or with Restore)"
+    bl_options = {'REGISTER', 'UNDO'}
+    def execute(self, context):
+        arm = hs2object()
+        if arm is not None:
+            shape_key_store.compact(arm, arm["body"], bake_keys=True)
+        return {'FINISHED'}
+
+class hs2rig_OT_restore_shape_keys(Operator):
+    bl_idname = "object.restore_shape_keys"
+    bl_label = "Restore shape keys"
+    bl_description = "Recreates the shape keys moved out by Compact shape keys"
+    bl_options = {'REGISTER', 'UNDO'}
+    def execute(self, context):
+        arm = hs2object()
+        if arm is not None:
+            body = arm["body"]
+            restored = shape_key_store.restore(body)
+            if "shape_key_memory" in body:
+                body["shape_key_memory"] = (body["shape_key_memory"][0], shape_key_store.key_memory(body))
+            self.report({'INFO'}, "Restored " + (", ".join(restored) if len(restored)>0 else "nothing"))
+        return {'FINISHED'}
+
 class hs2rig_OT_execute(Operator):
     bl_idname = "object.execute_command"
     bl_label = "Execute arbitrary command"
@@ -684,14 +1022,10 @@ class hs2rig_OT_execute(Operator):
     def execute(self, context):
         arm = hs2object()
         if arm is not None:
-            if context.scene.hs2rig_data.command == 'nails':
-                add_extras.tweak_nails(arm, arm["body"])
-            elif context.scene.hs2rig_data.command == 'eye_shape':
-                add_extras.eye_shape(arm, arm["body"], None)
-            elif context.scene.hs2rig_data.command == 'lip_shape':
-                add_extras.lip_arch_shapekey(arm, arm["body"], None)
-            elif context.scene.hs2rig_data.command == 'nose_shape':
-                add_extras.nasolabial_crease(arm, arm["body"], None)
+            command = context.scene.hs2rig_data.command
+            command = command_aliases.get(command, command)
+            if extras_scheduler.find_mod(command) is not None:
+                extras_scheduler.rerun(arm, arm["body"], command)
             else:
                 getattr(normalizer, context.scene.hs2rig_data.command)(arm, arm["body"])
         return {'FINISHED'}
@@ -737,6 +1071,7 @@ class hs2rig_OT_save_cust(Operator):
         print("Preset", p)
         if p is not None:
             p["customization"]=s
+            journal_field(p, "customization")
         return {'FINISHED'}
 
 class hs2rig_OT_name_to_preset(Operator):
@@ -750,6 +1085,8 @@ class hs2rig_OT_name_to_preset(Operator):
         p = find_preset(h)
         if p is not None:
             p.name = h["Name"]
+            journal_field(p, "name")
+            presets_changed()
         return {'FINISHED'}
 
 #
@@ -789,6 +1126,117 @@ class hs2rig_OT_clothing(Operator):
             x.hide_viewport = not x.hide_viewport
         return {'FINISHED'}
 
+#
+# Import queue: the import operators add importer.ImportJob's here, and hs2rig_OT_import_queue runs them
+# one stage per timer tick, with progress and ETA in the status bar. Esc cancels the running import
+# (its objects are removed) and drops the rest of the queue.
+#
+
+import_queue = []
+import_queue_running = False
+# jobs finished since the queue was last empty, for the "3/10" in the status bar
+import_queue_finished = 0
+
+def queue_import(context, label, kwargs, on_done=None):
+    def done(arm):
+        if arm is not None:
+            arm["import_options"] = json.dumps(cache_options(kwargs))
+        if on_done is not None:
+            on_done(arm)
+        if arm is not None and bpy.context.scene.hs2rig_data.characters_in_libraries:
+            character_library.move_to_library(arm, cache_options(kwargs))
+
+    job = importer.ImportJob(label, kwargs, done)
+    # timers (the export watcher) run without a window
+    window = context.window
+    if window is None and len(context.window_manager.windows)>0:
+        window = context.window_manager.windows[0]
+    if bpy.app.background or window is None:
+        while job.step():
+            pass
+        return
+    import_queue.append(job)
+    if not import_queue_running:
+        with context.temp_override(window=window):
+            bpy.ops.object.import_queue('INVOKE_DEFAULT')
+
+def format_eta(t):
+    t = int(t+0.5)
+    return "%d:%02d" % (t//60, t%60)
+
+class hs2rig_OT_import_queue(Operator):
+    bl_idname = "object.import_queue"
+    bl_label = "Import queued characters"
+    bl_description = "Runs the queued imports one stage at a time. Esc cancels"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def invoke(self, context, event):
+        global import_queue_running, import_queue_finished
+        import_queue_running = True
+        import_queue_finished = 0
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.05, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, 100)
+        self.show_status(context)
+        return {'RUNNING_MODAL'}
+
+    def finish(self, context):
+        global import_queue_running
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        import_queue_running = False
+        for a in context.screen.areas:
+            a.tag_redraw()
+
+    def show_status(self, context):
+        if len(import_queue)==0:
+            return
+        job = import_queue[0]
+        total = import_queue_finished+len(import_queue)
+        eta = sum([x.remaining() for x in import_queue])
+        context.workspace.status_text_set("Importing %s (%d/%d): %s, ETA %s. Esc to cancel" %
+            (job.label, import_queue_finished+1, total, job.stage or importer.import_stages[0], format_eta(eta)))
+        context.window_manager.progress_update(int(100.0*(import_queue_finished+job.progress())/total))
+        for a in context.screen.areas:
+            a.tag_redraw()
+
+    def modal(self, context, event):
+        global import_queue_finished
+        if event.type=='ESC' and event.value=='PRESS':
+            dropped = max(len(import_queue)-1, 0)
+            if len(import_queue)>0:
+                import_queue[0].cancel()
+            import_queue.clear()
+            self.finish(context)
+            importer.last_import_status='Import cancelled'
+            self.report({'WARNING'}, "Import cancelled" + (", %d queued characters dropped" % dropped if dropped>0 else ""))
+            return {'CANCELLED'}
+        if event.type!='TIMER':
+            # the user keeps working while characters import
+            return {'PASS_THROUGH'}
+        if len(import_queue)==0:
+            self.finish(context)
+            return {'FINISHED'}
+
+        job = import_queue[0]
+        try:
+            running = job.step()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            running = False
+        if not running:
+            import_queue.pop(0)
+            import_queue_finished += 1
+            if len(import_queue)==0:
+                self.finish(context)
+                return {'FINISHED'}
+        self.show_status(context)
+        return {'RUNNING_MODAL'}
+
 class hs2rig_OT_load_preset_character(Operator):
     bl_idname = "object.load_preset_character"
     bl_label = "Load preset char"
@@ -797,6 +1245,7 @@ class hs2rig_OT_load_preset_character(Operator):
     
     def execute(self, context):
         print("trying to import...")
+        ensure_texture_index()
         preset = None
         uuid = None
         name = ""
@@ -805,7 +1254,14 @@ class hs2rig_OT_load_preset_character(Operator):
         hair_color = preset.hair_color
         uuid = preset["uuid"]
         name = preset.name
-        arm=importer.import_body(preset.get_path(),
+        def done(arm):
+            if arm is None:
+                return
+            arm["preset_uuid"] = uuid
+            bpy.context.scene.hs2rig_data.standard_poses="T"
+            attributes.push_mat_attributes(preset)
+
+        kwargs = dict(input=preset.get_path(),
             refactor=context.scene.hs2rig_data.refactor,
             do_extend_safe=context.scene.hs2rig_data.extend_safe,
             do_extend_full=context.scene.hs2rig_data.extend_full,
@@ -813,17 +1269,24 @@ class hs2rig_OT_load_preset_character(Operator):
             add_injector=context.scene.hs2rig_data.add_injector,
             add_exhaust=context.scene.hs2rig_data.add_exhaust,
             subdivide=context.scene.hs2rig_data.subdivide,
+            subdivide_mode=context.scene.hs2rig_data.subdivide_mode,
             c_eye=eye_color,
             c_hair=hair_color,
             name=name,
             customization=preset.get("customization"),
             reweight_clothing=context.scene.hs2rig_data.reweight_clothing
             )
-        if uuid is not None:
-            arm["preset_uuid"] = uuid
-        bpy.context.scene.hs2rig_data.standard_poses="T"
-        if preset is not None:
-            attributes.push_mat_attributes(preset)
+        options = cache_options(kwargs)
+        if context.scene.hs2rig_data.use_import_cache and character_library.is_current(preset.get_path(), options):
+            if context.scene.hs2rig_data.characters_in_libraries:
+                arm = character_library.link(preset.get_path(), options)
+            else:
+                arm = character_library.append(preset.get_path(), options)
+            if arm is not None:
+                context.view_layer.objects.active = arm
+                done(arm)
+                return {'FINISHED'}
+        queue_import(context, name, kwargs, done)
         return {'FINISHED'}
 
 class DirSelector(Operator):
@@ -900,6 +1363,7 @@ class hs2rig_OT_import(DirSelector):
 
     def execute(self, context):
         print("trying to import...")
+        ensure_texture_index()
         preset = None
         uuid = None
         eye_color = (0.0, 0.0, 0.8)
@@ -916,12 +1380,12 @@ class hs2rig_OT_import(DirSelector):
         if os.path.basename(s).lower() == "textures":
             s = os.path.dirname(s)
 
-        # Guess the character's name
-        name = os.path.basename(s)
-        while len(name) and (name[0].isdigit() or name[0]=='_'):
-            name=name[1:]
+        name = dump_name(s)
+
+        def done(arm):
+            bpy.context.scene.hs2rig_data.standard_poses="T"
 
-        arm=importer.import_body(s,
+        queue_import(context, name, dict(input=s,
             refactor=context.scene.hs2rig_data.refactor,
             do_extend_safe=context.scene.hs2rig_data.extend_safe,
             do_extend_full=context.scene.hs2rig_data.extend_full,
@@ -929,12 +1393,93 @@ class hs2rig_OT_import(DirSelector):
             add_injector=context.scene.hs2rig_data.add_injector,
             add_exhaust=context.scene.hs2rig_data.add_exhaust,
             subdivide=context.scene.hs2rig_data.subdivide,
+            subdivide_mode=context.scene.hs2rig_data.subdivide_mode,
             c_eye=eye_color,
             c_hair=hair_color,
             name = name,
             customization = None
-            )
-        bpy.context.scene.hs2rig_data.standard_poses="T"
+            ), done)
+        return {'FINISHED'}
+
+#
+# "Load all presets" with "Build in workers": characters missing from the import cache are built in headless
+# Blender processes (library_builder), and every character is then linked into the scene through a library
+# override (character_library.link()), so the session only holds what it displays.
+#
+
+build_count = 0
+
+def build_presets(context, presets):
+    global build_count
+    build_count = 0
+    for preset in presets:
+        kwargs = dict(input=preset.get_path(), c_eye=preset.eye_color, c_hair=preset.hair_color,
+            name=preset.name, customization=preset.get("customization"))
+        kwargs.update(import_options(context))
+        options = cache_options(kwargs)
+        if character_library.is_current(kwargs["input"], options):
+            link_character(kwargs["input"], options, preset)
+        else:
+            # presets that come out the same share one build
+            library_builder.submit({"kwargs": kwargs, "preset": preset.as_dict(), "options": options,
+                "library": character_library.library_path(kwargs["input"], options),
+                "cache_formulas": extras_cache.use_cache}, preset)
+    if library_builder.busy() and not bpy.app.timers.is_registered(poll_builds):
+        bpy.app.timers.register(poll_builds, first_interval=0.5)
+
+def link_character(dump_dir, options, preset):
+    global build_count
+    arm = character_library.link(dump_dir, options)
+    if arm is not None:
+        arm.location = Vector([build_count, 0, 0])
+        build_count += 1
+        # the library has the material attributes of the preset it was built for
+        arm["preset_uuid"] = preset["uuid"]
+        bpy.context.view_layer.objects.active = arm
+        attributes.push_mat_attributes(preset)
+
+def poll_builds():
+    d = bpy.context.scene.hs2rig_data
+    for b in library_builder.poll(bpy.app.binary_path, d.worker_count, d.worker_memory_gb):
+        if b.returncode==0:
+            for preset in b.tags:
+                link_character(b.dump_dir, b.job["options"], preset)
+    if library_builder.busy():
+        importer.last_import_status = "Building characters: %d running, %d queued" % (len(library_builder.running), len(library_builder.queued))
+    else:
+        importer.last_import_status = "Built and linked %d characters" % build_count
+    for w in bpy.context.window_manager.windows:
+        for a in w.screen.areas:
+            a.tag_redraw()
+    return 1.0 if library_builder.busy() else None
+
+class hs2rig_OT_move_to_library(Operator):
+    bl_idname = "object.move_to_library"
+    bl_label = "Move to library"
+    bl_description = "Saves the character to a library .blend in its dump directory and replaces it with a linked copy. Only pose, shape key values, custom properties and material attributes are then kept in this file"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        arm = hs2object()
+        if arm is None or arm.override_library is not None or arm.library is not None or not "dump_dir" in arm:
+            return {'FINISHED'}
+        options = json.loads(arm["import_options"]) if "import_options" in arm else {}
+        linked = character_library.move_to_library(arm, options)
+        if linked is None:
+            self.report({'WARNING'}, "Could not link the library, the character stays local (see the console)")
+            return {'FINISHED'}
+        context.view_layer.objects.active = linked
+        return {'FINISHED'}
+
+class hs2rig_OT_cancel_builds(Operator):
+    bl_idname = "object.cancel_builds"
+    bl_label = "Cancel builds"
+    bl_description = "Stops the character builds that are running and drops the queued ones"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        library_builder.cancel()
+        importer.last_import_status = "Builds cancelled"
         return {'FINISHED'}
 
 class hs2rig_OT_import_subset(Operator):
@@ -942,14 +1487,28 @@ class hs2rig_OT_import_subset(Operator):
     
     def execute(self, context):
         print("trying to import...")
-        count = 0
+        if context.scene.hs2rig_data.build_in_workers:
+            build_presets(context, [preset_map[x] for x in preset_map if self.import_check(preset_map[x]["uuid"])])
+            return {'FINISHED'}
+        ensure_texture_index()
+        count = [0]
         for value in preset_map:
             preset = preset_map[value]
             if not self.import_check(preset["uuid"]):
                 continue
             eye_color = preset.eye_color
             hair_color = preset.hair_color
-            arm = importer.import_body(preset.get_path(),
+
+            def done(arm, preset=preset):
+                if arm is None:
+                    return
+                arm.location = Vector([count[0], 0, 0])
+                count[0]+=1
+                arm["preset_uuid"] = preset["uuid"]
+                attributes.push_mat_attributes(preset)
+                bpy.context.scene.hs2rig_data.standard_poses="T"
+
+            queue_import(context, preset.name, dict(input=preset.get_path(),
                 refactor=context.scene.hs2rig_data.refactor,
                 do_extend_safe=context.scene.hs2rig_data.extend_safe,
                 do_extend_full=context.scene.hs2rig_data.extend_full,
@@ -957,20 +1516,12 @@ class hs2rig_OT_import_subset(Operator):
                 add_injector=context.scene.hs2rig_data.add_injector,
                 add_exhaust=context.scene.hs2rig_data.add_exhaust,
                 subdivide=context.scene.hs2rig_data.subdivide,
+                subdivide_mode=context.scene.hs2rig_data.subdivide_mode,
                 c_eye=preset.eye_color,
                 c_hair=preset.hair_color,
                 name=preset.name,
                 customization=preset.get("customization")
-                )
-
-            if arm is not None:
-                arm.location = Vector([count, 0, 0])
-                count+=1
-            if "uuid" in preset_map[value]:
-                arm["preset_uuid"] = preset_map[value]["uuid"]
-
-            attributes.push_mat_attributes(preset_map[value])
-            bpy.context.scene.hs2rig_data.standard_poses="T"
+                ), done)
         return {'FINISHED'}
 
 
@@ -995,7 +1546,12 @@ class hs2rig_OT_reload_presets(Operator):
     bl_options = {'REGISTER', 'UNDO'}
     
     def execute(self, context):
+        # discards unsaved edits, including the journaled ones
+        if bpy.app.timers.is_registered(autosave):
+            bpy.app.timers.unregister(autosave)
+        preset_journal.clear()
         load_presets()
+        index_textures()
         return {'FINISHED'} 
 
 class hs2rig_OT_favorite_add(Operator):
@@ -1008,6 +1564,8 @@ class hs2rig_OT_favorite_add(Operator):
         global preset_favorites
         if h is not None and "preset_uuid" in h:
             preset_favorites.add(h["preset_uuid"])
+            journal({"op": "favorite", "uuid": h["preset_uuid"], "on": True})
+            presets_changed()
         return {'FINISHED'} 
 
 class hs2rig_OT_favorite_remove(Operator):
@@ -1021,6 +1579,8 @@ class hs2rig_OT_favorite_remove(Operator):
         if h is not None and "preset_uuid" in h:
             if h["preset_uuid"] in preset_favorites:
                 preset_favorites.remove(h["preset_uuid"])
+                journal({"op": "favorite", "uuid": h["preset_uuid"], "on": False})
+                presets_changed()
         return {'FINISHED'} 
 
 class hs2rig_OT_select_export_dir(Operator):
@@ -1063,6 +1623,26 @@ class hs2rig_OT_delete_preset(Operator):
         delete_preset()
         return {'FINISHED'}
 
+class hs2rig_OT_scan_presets(Operator):
+    bl_idname = "object.scan_presets"
+    bl_label = "Scan presets"
+    bl_description = "Checks the dump directories of all presets (FBX, Unity dump, textures, bone sets) without importing them. Unchanged directories are not read again"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        ensure_presets()
+        res = preset_scanner.scan([preset_map[x].get_path() for x in preset_map if len(preset_map[x].get_path())>0])
+        counts = preset_scanner.summary(res)
+        for x in preset_map:
+            r = preset_scanner.status(preset_map[x].get_path())
+            if r is not None and r["status"]!="OK":
+                print(r["status"], preset_map[x].name, preset_map[x].get_path())
+                for y in r["problems"]:
+                    print("    " + y)
+        self.report({'WARNING'} if counts["Error"]>0 else {'INFO'},
+            "%d OK, %d warnings, %d errors (see the console)" % (counts["OK"], counts["Warning"], counts["Error"]))
+        return {'FINISHED'}
+
 class hs2rig_OT_reset_skin_tone(Operator):
     bl_idname = "object.reset_skin_tone"
     bl_label = "Reset"
@@ -1083,6 +1663,7 @@ class HS2RIG_PT_ui(Panel):
     bl_options = {'DEFAULT_CLOSED'}
 
     def draw(self, context):
+        ensure_presets()
         layout = self.layout
         scene = context.scene
         arm = context.active_object #bpy.data.objects['Armature']
@@ -1121,10 +1702,22 @@ class HS2RIG_PT_ui(Panel):
                 row = layout.row(align=True)
                 row.prop(context.scene.hs2rig_data, "ik")
 
+            body = arm["body"] if "body" in arm else None
+            if body is not None and body.data.shape_keys is not None:
+                row = layout.row(align=True)
+                row.operator("object.compact_shape_keys")
+                if len(shape_key_store.baked_keys(body))>0:
+                    row.operator("object.restore_shape_keys")
+                if "shape_key_memory" in body:
+                    layout.label(text="Shape keys: %.1f MB -> %.1f MB" % tuple(body["shape_key_memory"]))
+
             if analyzer_enabled:
                 row = layout.row(align=True)
                 row.prop(context.scene.hs2rig_data, "command")
                 row.operator("object.execute_command")
+                row = layout.row(align=True)
+                row.prop(context.scene.hs2rig_data, "extras_mod")
+                row.operator("object.rerun_extras")
         
             row = layout.row(align=True)
             box = layout.box()
@@ -1169,6 +1762,8 @@ class HS2RIG_PT_ui(Panel):
             row.operator("object.reset_skin_tone")
             row = box.row(align=True)
             row.operator("object.add_new_preset")
+            if arm.override_library is None and arm.library is None and "dump_dir" in arm:
+                row.operator("object.move_to_library")
 
         box = layout.box()
         box.label(text="System settings")
@@ -1181,8 +1776,15 @@ class HS2RIG_PT_ui(Panel):
         row.operator("object.reload_presets")
         row.operator("object.save_presets")
         row.operator("object.delete_preset")
+        row.operator("object.scan_presets")
         if len(preset_map)==0:
             row.enabled=False
+        selected = preset_map.get(int(context.scene.hs2rig_data.presets)) if context.scene.hs2rig_data.presets!='' else None
+        if selected is not None:
+            r = preset_scanner.status(selected.get_path())
+            if r is not None:
+                row = box.row(align=True)
+                row.label(text="Scan: " + "; ".join([r["status"]]+r["problems"]), icon={"OK": 'CHECKMARK', "Stale": 'QUESTION'}.get(r["status"], 'ERROR'))
         row = box.row(align=True)
         row2 = row.row(align=True)
         op = row2.operator("object.load_preset_character")
@@ -1201,6 +1803,9 @@ class HS2RIG_PT_ui(Panel):
         row = box.row(align=True)
         row.prop(context.scene.hs2rig_data, "subdivide")
         row.prop(context.scene.hs2rig_data, "refactor")
+        if context.scene.hs2rig_data.subdivide:
+            row = box.row(align=True)
+            row.prop(context.scene.hs2rig_data, "subdivide_mode", expand=True)
         if context.scene.hs2rig_data.refactor:
             row = box.row(align=True)
             row.prop(context.scene.hs2rig_data, "extend_safe")
@@ -1213,6 +1818,19 @@ class HS2RIG_PT_ui(Panel):
             op=row.prop_menu_enum(context.scene.hs2rig_data, "add_injector")
             op=row.prop(context.scene.hs2rig_data, "add_exhaust")
         row = box.row(align=True)
+        row.prop(context.scene.hs2rig_data, "build_in_workers")
+        if context.scene.hs2rig_data.build_in_workers:
+            row.prop(context.scene.hs2rig_data, "worker_count")
+            row.prop(context.scene.hs2rig_data, "worker_memory_gb")
+        if library_builder.busy():
+            row.operator("object.cancel_builds")
+        row = box.row(align=True)
+        row.prop(context.scene.hs2rig_data, "watch_exports")
+        row.prop(context.scene.hs2rig_data, "use_import_cache")
+        row = box.row(align=True)
+        row.prop(context.scene.hs2rig_data, "characters_in_libraries")
+        row.prop(context.scene.hs2rig_data, "cache_formulas")
+        row = box.row(align=True)
         row.label(text=importer.last_import_status)
         """
         if active_object is not None:
@@ -1244,6 +1862,9 @@ hs2rig_OT_save_cust,
 hs2rig_OT_load_cust,
 hs2rig_OT_reset_cust,
 hs2rig_OT_import,
+hs2rig_OT_import_queue,
+hs2rig_OT_cancel_builds,
+hs2rig_OT_move_to_library,
 hs2rig_OT_import_all,
 hs2rig_OT_import_favorites,
 hs2rig_OT_save_presets,
@@ -1251,10 +1872,14 @@ hs2rig_OT_reload_presets,
 hs2rig_OT_add_new_preset,
 hs2rig_OT_delete_preset,
 hs2rig_OT_reset_skin_tone,
+hs2rig_OT_scan_presets,
 hs2rig_OT_name_to_preset,
 hs2rig_OT_load_preset_character,
 hs2rig_props,
 hs2rig_OT_execute,
+hs2rig_OT_rerun_extras,
+hs2rig_OT_compact_shape_keys,
+hs2rig_OT_restore_shape_keys,
 
 hs2rig_OT_favorite_add,
 hs2rig_OT_favorite_remove,
@@ -1263,16 +1888,42 @@ hs2rig_OT_favorite_remove,
 ]
 
 def unregister():
+    for job in import_queue:
+        job.cancel()
+    import_queue.clear()
+    library_builder.cancel()
+    for f in [deferred_load, autosave, watch_exports, poll_builds]:
+        try:
+            if bpy.app.timers.is_registered(f):
+                bpy.app.timers.unregister(f)
+        except:
+            pass
     for x in addon_classes: 
         try:
             bpy.utils.unregister_class(x)
         except:
             pass
     
+def reload_modules():
+    import importlib
+    importlib.reload(add_extras)
+    importlib.reload(extras_scheduler)
+    importlib.reload(attributes)
+    importlib.reload(importer)
+    importlib.reload(armature)
+    if analyzer_enabled:
+        importlib.reload(analyzer)
+    if normalizer_enabled:
+        importlib.reload(normalizer)
+    importlib.reload(solve_for_deform)
+
+# Only registers classes; presets and textures are loaded later (see ensure_presets)
 def register():
     global config_path
+    t1 = time.time()
+    startup_phases.clear()
+    startup_phases.append(("Import modules", t1-module_t0))
     config_path = os.path.dirname(__file__)+"/assets/hs2blender.cfg"
-    load_presets()
 
     print("Registering...")
 
@@ -1280,15 +1931,14 @@ def register():
         bpy.utils.register_class(x)
     last_preset = None
     bpy.types.Scene.hs2rig_data = PointerProperty(type=hs2rig_props)
+    t2 = time.time()
+    startup_phases.append(("Register classes", t2-t1))
 
-    import importlib
-    importlib.reload(add_extras)
-    importlib.reload(attributes)
-    importlib.reload(importer)
-    importlib.reload(armature)
+    # development setups (with the analyzer) pick up edits to the other modules when the add-on is re-registered
     if analyzer_enabled:
-        importlib.reload(analyzer)
-    if normalizer_enabled:
-        importlib.reload(normalizer)
-    importlib.reload(solve_for_deform)
+        timed_phase("Reload modules", reload_modules)
 
+    try:
+        bpy.app.timers.register(deferred_load, first_interval=deferred_load_delay)
+    except:
+        pass
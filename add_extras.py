@@ -11,23 +11,17 @@ from .importer import replace_mat, set_tex, set_bump, join_meshes, disconnect_li
 import time
 import random
 
-from . import armature
+from . import armature, catmull_clark, extras_cache, mesh_cache, regions, spatial, weights
 
 from .attributes import set_attr
 
 def clamp01(x):
     return max(0.0, min(1.0, x))
 
+# For each vertex of subset2, position in subset1 of the nearest vertex
 def find_nearest_vertices(body, subset1, subset2):
-    cos = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
-    body.data.vertices.foreach_get("co", cos)
-    cos = cos.reshape([-1,3])
-    ys = cos[subset1].reshape([1,-1,3])
-    xs = cos[subset2].reshape([-1,1,3])
-    xy = xs-ys
-    xy *= xy
-    xy = np.sqrt(xy[:,:,0]+xy[:,:,1]+xy[:,:,2])
-    return np.argmin(xy, axis=1)
+    cos = mesh_cache.snapshot(body).co()
+    return spatial.PointIndex(cos[subset1]).nearest(cos[subset2])[0]
 
 
 def make_child_bone(arm, parent, name, offset, collection, rotation_mode='XYZ', 
@@ -83,6 +77,9 @@ def get_weight(body, vertex, group):
 def set_weight(body, vertex, group, weight):
     if isinstance(group, str):
         group = body.vertex_groups[group].index
+    snap = mesh_cache.open_snapshot(body)
+    if snap is not None:
+        snap.weight_written(vertex, group, weight)
     for g in body.data.vertices[vertex].groups:
         if g.group==group:
             g.weight=weight
@@ -104,15 +101,24 @@ def add_weight(body, vertex, group, weight):
 
     if isinstance(group, str):
         group = body.vertex_groups[group].index
+    snap = mesh_cache.open_snapshot(body)
     for g in body.data.vertices[vertex].groups:
         if g.group==group:
             g.weight+=weight
+            if snap is not None:
+                snap.weight_written(vertex, group, g.weight)
             return
     body.vertex_groups[group].add([vertex], weight, 'ADD')
+    if snap is not None:
+        snap.weight_written(vertex, group, weight)
 
 def vgroup(obj, name, min_wt=None):
     if min_wt is None:
         min_wt = 0.0
+    snap = mesh_cache.open_snapshot(obj)
+    if snap is not None:
+        names = name if isinstance(name, list) else [name]
+        return snap.members([obj.vertex_groups[vg].index for vg in names if vg in obj.vertex_groups], min_wt)
     if isinstance(name, list):
         ids = [obj.vertex_groups[vg].index for vg in name if vg in obj.vertex_groups]
         return [x for x in range(len(obj.data.vertices)) if any([(g.group==id and g.weight>min_wt) for g in obj.data.vertices[x].groups for id in ids])]
@@ -127,26 +133,57 @@ def vgroup(obj, name, min_wt=None):
         return [x for x in range(len(obj.data.vertices)) if any([(g.group==id and g.weight>min_wt) for g in obj.data.vertices[x].groups])]
 
 
+# Debug: also evaluate formulas outside of their uv_rect, and report vertices that would have changed
+verify_uv_rects = False
+
+# Mask over 'v' of the vertices whose UV lies in 'uv_rect' = (u0, v0, u1, v1),
+# or, with mirror=True, in its mirror image across u=0.5 (for formulas that fold uv[0]>0.5 onto the other side).
+def uv_rect_mask(body, v, uv_rect, mirror=False):
+    if uv_rect is None:
+        return np.ones([len(v)], dtype=bool)
+    grid = mesh_cache.snapshot(body).uv_grid()
+    inside = np.zeros([len(body.data.vertices)], dtype=bool)
+    inside[grid.in_rect(uv_rect)] = True
+    if mirror:
+        inside[grid.in_rect((1-uv_rect[2], uv_rect[1], 1-uv_rect[0], uv_rect[3]))] = True
+    return inside[np.asarray(v, dtype=np.int64)]
+
+# Evaluates a formula over 'v', skipping vertices outside of 'inside' (they get 'zero')
+def evaluate_formula(body, name, v, func, inside, zero, set_id=False):
+    snap = mesh_cache.snapshot(body)
+    # vertices without loops get (0,0)
+    uvs = snap.uvs()
+    cos = snap.undeformed_co()
+    norms = snap.normals()
+    def f(i, x):
+        if set_id:
+            return func(uv=Vector(uvs[x]), vert=x, co=Vector(cos[x]), norm=Vector(norms[x]), set_id=i)
+        return func(uv=Vector(uvs[x]), vert=x, co=Vector(cos[x]), norm=Vector(norms[x]))
+    out = [f(i, x) if inside[i] else zero for i, x in enumerate(v)]
+    if verify_uv_rects:
+        missed = [x for i, x in enumerate(v) if not inside[i] and np.any(np.asarray(f(i, x))!=0)]
+        if len(missed)>0:
+            print("uv_rect of", name, "misses", len(missed), "affected verts, e.g.", missed[:5])
+    return out
+
 # Calls 'func' for each vertex in 'vg' (which is an index, a string, or a list of vertex groups), to calculate 'wt' (a value in 0 to 1 range).
 # Assigns weight 'wt' to the newly created VG and reduces weights of all other VGs on that vertex, without changing their relative weights.
-def create_functional_vgroup(body, name, vg, func, bm = None):
+# If 'func' is known to be 0 outside of a UV rectangle, passing it as 'uv_rect' (see uv_rect_mask) skips the other vertices.
+def create_functional_vgroup(body, name, vg, func, uv_rect=None, mirror=False):
     if name in body.vertex_groups:
         body.vertex_groups.remove(body.vertex_groups[name])
     new_group = body.vertex_groups.new(name=name)
     new_id  = new_group.index
-    if bm is None:
-        bm = bmesh.new()
-        bm.from_mesh(body.data)
-        bm.verts.ensure_lookup_table()
-        bm.faces.ensure_lookup_table()
-        bm_owned = True
-    else:
-        bm_owned = False
-    lay = bm.loops.layers.uv['uv1']
+    snap = mesh_cache.snapshot(body)
+    # removing a group renumbers the ones after it
+    snap.touch('weights')
     v = vgroup(body, vg)
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        wt = func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal)
+    key = extras_cache.entry_key(body, 'vgroup', name, vg, func, v, uv_rect, mirror)
+    wts = extras_cache.lookup(key, v)
+    if wts is None:
+        wts = evaluate_formula(body, name, v, func, uv_rect_mask(body, v, uv_rect, mirror), 0.0)
+        extras_cache.store(key, v, wts)
+    for x, wt in zip(v, wts):
         if wt > 0:
             s = 0
             for g in body.data.vertices[x].groups:
@@ -154,11 +191,10 @@ def create_functional_vgroup(body, name, vg, func, bm = None):
             for g in body.data.vertices[x].groups:
                 g.weight *= (1-wt)/s
             add_weight(body, x, new_id, wt)
-    if bm_owned:
-        bm.free()
+    snap.touch('weights')
 
 # Similar to 'create_functional_vgroup', except that it reduces weights of _only_ vertex groups specified in 'vg'.
-def split_vgroup(body, name, vg, func, bm = None):
+def split_vgroup(body, name, vg, func, uv_rect=None, mirror=False):
     if not name in body.vertex_groups:
         body.vertex_groups.new(name=name)
     if isinstance(vg, list):
@@ -166,55 +202,45 @@ def split_vgroup(body, name, vg, func, bm = None):
     else:
         old_id = [body.vertex_groups[vg].index]
     new_id = body.vertex_groups[name].index
-    if bm is None:
-        bm = bmesh.new()
-        bm.from_mesh(body.data)
-        bm.verts.ensure_lookup_table()
-        bm.faces.ensure_lookup_table()
-        bm_owned = True
-    else:
-        bm_owned = False
-    lay = bm.loops.layers.uv['uv1']
     v = vgroup(body, vg)
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
+    inside = uv_rect_mask(body, v, uv_rect, mirror)
+    key = extras_cache.entry_key(body, 'split', name, vg, func, v, uv_rect, mirror)
+    fracs = extras_cache.lookup(key, v)
+    if fracs is None:
+        fracs = evaluate_formula(body, name, v, func, inside, 0.0)
+        extras_cache.store(key, v, fracs)
+    for x, frac, x_inside in zip(v, fracs, inside):
+        if not x_inside:
+            continue
         wold = [get_weight(body, x, y) for y in old_id]
-        frac = func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal)
         for k in range(len(old_id)):
             set_weight(body, x, old_id[k], wold[k]*(1.-frac))
         set_weight(body, x, new_id, sum(wold)*frac)
-    if bm_owned:
-        bm.free()
 
-def create_functional_shape_key(body, name, vg, func, on=True, max=1.0, bm=None):
+def create_functional_shape_key(body, name, vg, func, on=True, max=1.0, uv_rect=None, mirror=False):
     if name in body.data.shape_keys.key_blocks:
         body.shape_key_remove(key=body.data.shape_keys.key_blocks[name])
     sk = body.shape_key_add(name=name)
     sk.interpolation='KEY_LINEAR'
-    for x in range(len(body.data.vertices)):
-        sk.data[x].co = body.data.shape_keys.key_blocks["Basis"].data[x].co
-    if bm is None:
-        bm = bmesh.new()
-        bm.from_mesh(body.data)
-        bm.verts.ensure_lookup_table()
-        bm.faces.ensure_lookup_table()
-        bm_owned = True
-    else:
-        bm_owned = False
-    lay = bm.loops.layers.uv['uv1']
+    coords = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
+    body.data.shape_keys.key_blocks["Basis"].data.foreach_get("co", coords)
+    coords = coords.reshape([-1,3])
 
     if isinstance(vg, list) and isinstance(vg[0], int):
         v = vg
     else:
         v = vgroup(body, vg)
 
-    for i, x in enumerate(v):        
-        uv = bm.verts[x].link_loops[0][lay].uv if len(bm.verts[x].link_loops)>0 else (0,0)
-        sk.data[x].co += func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal, set_id=i)
+    key = extras_cache.entry_key(body, 'shape_key', name, vg, func, v, uv_rect, mirror)
+    offsets = extras_cache.lookup_offsets(body, key, v)
+    if offsets is None:
+        offsets = evaluate_formula(body, name, v, func, uv_rect_mask(body, v, uv_rect, mirror), (0.0, 0.0, 0.0), set_id=True)
+        offsets = np.array([tuple(x) for x in offsets], dtype=np.float32).reshape([-1,3])
+        extras_cache.store_offsets(body, key, v, offsets)
+    np.add.at(coords, np.asarray(v, dtype=np.int64), offsets)
+    sk.data.foreach_set("co", coords.reshape([-1]))
     body.data.shape_keys.key_blocks[name].value=0.
     body.data.shape_keys.key_blocks[name].slider_max=max
-    if bm_owned:
-        bm.free()
 
 
 def sigmoid(x, x_full=None, x_min=None):
@@ -351,7 +377,7 @@ def weighted_center(body, name):
 #
 #
 
-def eye_shape(arm, body, bm, on=True):
+def eye_shape(arm, body, on=True):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = body
     #if 'Eye shape' in body.data.shape_keys.key_blocks:
@@ -434,9 +460,9 @@ def eye_shape(arm, body, bm, on=True):
         """
         return effect
 
-    create_functional_shape_key(body, 'Eye shape', eye_soft, formula, on = on, bm = bm)
+    create_functional_shape_key(body, 'Eye shape', eye_soft, formula, on = on)
 
-def tweak_nose(arm, body, bm, on):
+def tweak_nose(arm, body, on):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = body
     #bpy.ops.object.mode_set(mode='EDIT')
@@ -470,7 +496,7 @@ def tweak_nose(arm, body, bm, on):
 
     create_functional_shape_key(body, 'Nostril pinch', ['cf_J_Nose_tip','cf_J_Nose_t','cf_J_NoseBase_s'], formula, max=2.0)
 
-def add_mouth_blendshape(body, bm):
+def add_mouth_blendshape(body):
     if not 'cf_J_CheekLow_L' in body.vertex_groups: # custom head
         return 
     if not 'cf_J_Mouthup' in body.vertex_groups: # custom head
@@ -494,14 +520,10 @@ def add_mouth_blendshape(body, bm):
     # draw the line from mouth corner to cheek center, and continue it for the same distance
     ccorn=mcorn + (ccent-mcorn)*2.0
 
-    mesh=body.data
-
     #find the nearest vertex to that point
-    ccorn_nearest=mesh.vertices[0].co
-    for x in mesh.vertices:
-        if (x.co-ccorn).length<(ccorn_nearest-ccorn).length:
-            ccorn_nearest=x.co
-    ccorn=ccorn_nearest
+    cos = mesh_cache.snapshot(body).co()
+    d = cos-np.array(ccorn, dtype=np.float32)
+    ccorn=Vector(cos[np.argmin((d*d).sum(axis=1))])
     
     ccent=(ccorn+mcorn)*0.5
     vmc=ccent-mcorn
@@ -600,18 +622,18 @@ def add_mouth_blendshape(body, bm):
         return effect
 
     create_functional_shape_key(body, 'better_smile', ['cf_J_MouthBase_s','cf_J_MouthLow','cf_J_Mouthup','cf_J_CheekLow_L','cf_J_CheekLow_R',
-        'cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=False, bm=bm)
+        'cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=False)
 
-def adams_apple_delete(arm, body, bm):
+def adams_apple_delete(arm, body):
     def formula(uv, **kwargs):
         if uv[0]>=0.115 and uv[0]<=0.135 and uv[1]>=0.970 and uv[1]<=0.991:
             return Vector([0,0,-0.02-0.02*bump(uv[1],0.970,0.980,0.990)])
         return Vector([0,0,0])
-    create_functional_shape_key(body, 'Adams apple delete', ['cf_J_Neck_s'], formula, on=False, bm=bm)
+    create_functional_shape_key(body, 'Adams apple delete', ['cf_J_Neck_s'], formula, on=False)
 
 
 # Pushes the flesh between the upper lip and the nose smoothly toward the skull, creating a trough.
-def upper_lip_shapekey(arm, body, bm, on=True):
+def upper_lip_shapekey(arm, body, on=True):
     def formula(uv, norm, **kwargs):
         curve=[
         (0.442,0.352),
@@ -621,10 +643,10 @@ def upper_lip_shapekey(arm, body, bm, on=True):
         effect1 = wx * bump(uv[1], curve_interp(curve, uv[0], xsymm=True), None, 0.399, shape='cos') * Vector([0, -0.01, -0.01])
         return effect1
     boy = (body['Boy']>0.0)
-    create_functional_shape_key(body, 'Upper lip trough', ['cf_J_Mouthup','cf_J_MouthBase_s_s'], formula, on = on and (not boy), bm = bm)
+    create_functional_shape_key(body, 'Upper lip trough', ['cf_J_Mouthup','cf_J_MouthBase_s_s'], formula, on = on and (not boy))
 
 # Smoothly arches the lips
-def lip_arch_shapekey(arm, body, bm, on=True):
+def lip_arch_shapekey(arm, body, on=True):
     boy = (body['Boy']>0.0)
 
     # There are only a few rows of verts in the lips, 
@@ -723,9 +745,9 @@ def lip_arch_shapekey(arm, body, bm, on=True):
         #set_weight(body, vert, vglx.index, wx)
         return wx*Vector([0, 0.01*curve_interp(spread_curve, y_pos), 0.01*curve_interp(push_curve, y_pos)]) + Vector([0, 0, 0.0075*(bump(uv[0],0.432,None,0.500)+bump(uv[0],0.500,None,0.568)) * bump(y_pos, -4.0, -2.0, 0.0)])
     create_functional_shape_key(body, 'Lip arch', ['cf_J_Mouthup','cf_J_MouthLow', 'cf_J_ChinTip_s', 'cf_J_MouthBase_s_s'], formula,
-            max=2.0, on=on and not boy, bm = bm)
+            max=2.0, on=on and not boy)
 
-def eyelid_crease(arm, body, bm, on=True):
+def eyelid_crease(arm, body, on=True):
     curve_upper = [
     (0.338,0.5590),
     (0.349,0.5626),
@@ -754,10 +776,11 @@ def eyelid_crease(arm, body, bm, on=True):
         wy = bump(uv[1], ynear-0.002, ynear, ynear+0.002)
         return Vector([0,0,-wx*wy*0.02])
 
-    create_functional_shape_key(body, 'Eyelid crease', ['cf_J_Eye02_s_L','cf_J_Eye02_s_R'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Eyelid crease', ['cf_J_Eye02_s_L','cf_J_Eye02_s_R'], formula, on=on,
+        uv_rect=(0.338, 0.542, 0.439, 0.571), mirror=True)
 
 
-def forehead_flatten(arm, body, bm, on=True):
+def forehead_flatten(arm, body, on=True):
     if not "cf_J_FaceUp_tz" in body.vertex_groups:
         return
     ftz_id = body.vertex_groups["cf_J_FaceUp_tz"].index
@@ -768,9 +791,9 @@ def forehead_flatten(arm, body, bm, on=True):
         w *= sigmoid(norm[2], 1.0, 0.2)
         return Vector([0,0,w])
 
-    create_functional_shape_key(body, 'Forehead flatten', ['cf_J_FaceUp_tz','cf_J_FaceUpFront_ty'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Forehead flatten', ['cf_J_FaceUp_tz','cf_J_FaceUpFront_ty'], formula, on=on)
 
-def temple_depress(arm, body, bm, on=True):
+def temple_depress(arm, body, on=True):
     def formula(uv, **kwargs):
         if uv[0]>0.500:
             uv=(1-uv[0], uv[1])
@@ -788,9 +811,10 @@ def temple_depress(arm, body, bm, on=True):
         r2[1]*=0.5
         return (sigmoid(r.length, 0, 0.08)-sigmoid(r2.length,0,0.025)*0.5) * Vector([0.025*sign, 0, 0])
 
-    create_functional_shape_key(body, 'Temple depress', ['cf_J_FaceUp_tz','cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=on, bm = bm)
+    create_functional_shape_key(body, 'Temple depress', ['cf_J_FaceUp_tz','cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=on,
+        uv_rect=(0.170, 0.420, 0.345, 0.750), mirror=True)
 
-def jaw_soften(arm, body, bm, on=True):
+def jaw_soften(arm, body, on=True):
     curve_m=[
     (0.223, 0.244),
     (0.326, 0.213),
@@ -811,12 +835,52 @@ def jaw_soften(arm, body, bm, on=True):
         effect = bump(pos, -2*width, 0, width, shape='cos') * (1. + bump(uv[0], 0.43, 0.46, 0.49, shape='cos')) * sigmoid(uv[0], 0.225, 0.150)
         return norm * -0.01 * effect
     width = 0.035
-    create_functional_shape_key(body, 'Jaw soften', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=False, bm=bm)
+    create_functional_shape_key(body, 'Jaw soften', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=False)
     width = 0.060
-    create_functional_shape_key(body, 'Jaw soften more', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Jaw soften more', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=on)
 
 # Explicitly subdivide the mesh before trying to build new shape keys.
 # Necessary to produce good quality shape keys in sensitive areas (e.g. around the nose).
+# [(name, coords)] for the reference key and every other shape key, where coords is what the mesh
+# looks like with only that key at 1.0 (Basis + weight * (key - relative key))
+def shape_key_mixes(body):
+    nv = len(body.data.vertices)
+    blocks = body.data.shape_keys.key_blocks
+    cos = {}
+    for key in blocks:
+        co = np.zeros([nv*3], dtype=np.float32)
+        key.data.foreach_get("co", co)
+        cos[key.name] = co.reshape([-1,3])
+    ref = body.data.shape_keys.reference_key
+    out = [(ref.name, cos[ref.name])]
+    weights = mesh_cache.snapshot(body).weights()
+    for key in blocks:
+        if key.name==ref.name:
+            continue
+        delta = cos[key.name] - cos[key.relative_key.name]
+        if key.vertex_group in body.vertex_groups:
+            w = np.zeros([nv, 1], dtype=np.float32)
+            for x, wt in weights.get(body.vertex_groups[key.vertex_group].index, {}).items():
+                w[x] = wt
+            delta *= w
+        out.append((key.name, cos[ref.name] + delta))
+    return out
+
+# Regions where subdivide() keeps the new detail, first match wins (see regions.py)
+subdivide_keep_regions = [
+    # Don't subdivide eyes and eyelashes
+    (False, {'type': 'materials', 'materials': ['eyelash_mat', 'eye_mat', 'eyeshadow_mat']}),
+    # Preserve detail in the face
+    (True, {'type': 'box', 'min': (None, 15.45, 0.0), 'max': (None, None, None)}),
+    # Keep subdivision of the navel
+    (True, {'type': 'sphere', 'center': (0, 11.54, 0.67), 'radius': 0.30}),
+    # Keep hands
+    (True, {'type': 'half_space', 'normal': (1, 0, 0), 'offset': 6.0}),
+    (True, {'type': 'half_space', 'normal': (-1, 0, 0), 'offset': 6.0}),
+    # Keep toes
+    (True, {'type': 'box', 'min': (None, None, 0.6), 'max': (None, 0.5, None)}),
+]
+
 def subdivide(arm, body):
     if len(body.data.vertices)>60000:
         return
@@ -864,77 +928,71 @@ def subdivide(arm, body):
     subsurf.show_viewport = True
 
     bpy.ops.object.modifier_move_to_index(modifier="subsurf", index=0)
-    bpy.ops.object.duplicate()
-    body_copy = bpy.context.view_layer.objects.active 
-    bpy.context.view_layer.objects.active = body
+
+    # Subdivision is linear in vertex positions, so every shape key can be subdivided with one
+    # sparse mat-vec. The operator is built from the topology and checked against a single
+    # evaluation of the Basis; if they disagree (e.g. non-manifold geometry), fall back to
+    # evaluating a copy of the body once per shape key.
+    t3 = time.time()
+    snap = mesh_cache.snapshot(body)
+    op = catmull_clark.build_operator(len(body.data.vertices), len(body.data.polygons),
+        snap.edges(), snap.loop_verts(), snap.loop_edges(), snap.loop_faces())
+    keys = shape_key_mixes(body)
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    dup = body.evaluated_get(depsgraph)
+    use_operator = len(dup.data.vertices)==op.shape[0]
+    if use_operator:
+        coords = np.zeros([len(dup.data.vertices)*3], dtype=np.float32)
+        dup.data.vertices.foreach_get("co", coords)
+        error = np.abs(coords.reshape([-1,3]) - op.apply(keys[0][1])).max()
+        use_operator = error < 0.0001
+        print("Subdivision operator: %d entries, max error %.6f" % (len(op.vals), error))
+    t4 = time.time()
+    print("Subdivision operator built in %.3f s" % (t4-t3))
+    if not use_operator:
+        print("Subdivision operator does not match the modifier, evaluating each shape key")
+        bpy.ops.object.duplicate()
+        body_copy = bpy.context.view_layer.objects.active
+        bpy.context.view_layer.objects.active = body
     bpy.ops.object.shape_key_remove(all=True, apply_mix=True)
     bpy.ops.object.modifier_apply(modifier="subsurf")
     sk = body.shape_key_add(name="Basis")
-    for key in body_copy.data.shape_keys.key_blocks:
-        if key.name=='Basis':
-            continue
-        bpy.context.view_layer.objects.active = body_copy
-        s=0
-        for k in body_copy.data.shape_keys.key_blocks:
-            k.value = 1.0 if k.name==key.name else 0.0
-            s+=k.value
-        depsgraph = bpy.context.evaluated_depsgraph_get()
-        dup = body_copy.evaluated_get(depsgraph)
-        #bpy.qwerty()
-        sk = body.shape_key_add(name=key.name)
-        dup.data.vertices.update()
-        sk.interpolation='KEY_LINEAR'
-        coords = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
-        dup.data.vertices.foreach_get("co", coords)
-        sk.data.foreach_set("co", coords)
-
-    bpy.data.objects.remove(body_copy)
-    bpy.context.view_layer.objects.active = body
-
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type='VERT')
-    bpy.ops.mesh.select_all(action='DESELECT')
-    for i, slot in enumerate(body.material_slots):
-        if slot.material in [body["eyelash_mat"], body["eye_mat"], body["eyeshadow_mat"]]:
-            body.active_material_index = i
-            bpy.ops.object.material_slot_select()
-    eye_mask = [False]*len(body.data.vertices)
-    bpy.ops.object.mode_set(mode='OBJECT')
-    body.data.vertices.foreach_get("select", eye_mask)
-
-    #spine01 = vgroup(body, 'cf_J_Spine01_s')
-    #for x in spine01:
-    #    if (body.data.vertices[x].co-Vector([0, 11.54, 0.67])).length < 0.30:
-    #        eye_mask[x] = True
+    if use_operator:
+        for name, co in keys[1:]:
+            sk = body.shape_key_add(name=name)
+            sk.interpolation='KEY_LINEAR'
+            sk.data.foreach_set("co", op.apply(co).reshape([-1]))
+    else:
+        for key in body_copy.data.shape_keys.key_blocks:
+            if key.name=='Basis':
+                continue
+            bpy.context.view_layer.objects.active = body_copy
+            for k in body_copy.data.shape_keys.key_blocks:
+                k.value = 1.0 if k.name==key.name else 0.0
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+            dup = body_copy.evaluated_get(depsgraph)
+            sk = body.shape_key_add(name=key.name)
+            dup.data.vertices.update()
+            sk.interpolation='KEY_LINEAR'
+            coords = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
+            dup.data.vertices.foreach_get("co", coords)
+            sk.data.foreach_set("co", coords)
+
+        bpy.data.objects.remove(body_copy)
+        bpy.context.view_layer.objects.active = body
+
+    # Keep the subdivision where detail matters, dissolve it everywhere else
+    snap = mesh_cache.snapshot(body)
+    keep = regions.classify(subdivide_keep_regions, False, snap.co(), regions.mesh_vertex_materials(body, snap))
+
+    # Dissolve candidates: vertices of rank 3 (from the edge count histogram) outside the kept regions
+    rank = np.bincount(snap.edges().reshape([-1]), minlength=len(body.data.vertices))
+    rank_3 = np.nonzero(~keep & (rank==3))[0]
 
     bm = bmesh.new()
     bm.from_mesh(body.data)
     bm.verts.ensure_lookup_table()
-    bm.edges.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
-
-    def should_dissolve(x):
-        # Don't subdivide eyes and eyelashes
-        if eye_mask[x]:
-            return True
-        co = bm.verts[x].co
-        # Preserve detail in the face
-        if co[1]>=15.45 and co[2]>0.0:
-            return False
-        # Keep subdivision of the navel
-        if (co-Vector([0, 11.54, 0.67])).length < 0.30:
-            return False
-        # Keep hands
-        if abs(co[0])>6.0:
-            return False
-        # Keep toes
-        if co[1]<0.5 and co[2]>0.6:
-            return False
-        # Dissolve everything else
-        return True
-
-
-    rank_3_verts = [bm.verts[x] for x in range(len(bm.verts)) if should_dissolve(x) and len(bm.verts[x].link_edges)==3]
+    rank_3_verts = [bm.verts[x] for x in rank_3]
     # dissolve rank 3 verts
     bmesh.ops.dissolve_verts(bm, verts=rank_3_verts)
     bm.verts.ensure_lookup_table()
@@ -952,58 +1010,191 @@ def subdivide(arm, body):
     t2 = time.time()
     print("Subdivision done in %.3f s" % (t2-t1))
 
+#
+# Non-destructive alternative to subdivide(): the base mesh is kept, and one level of Catmull-Clark
+# is added by a geometry nodes modifier in the faces selected by the "Subdivision Mask" vertex group
+# (mean weight > 0.5), by default the same regions subdivide() keeps. The mask can be weight painted.
+#
+# The modifier runs after the armature, so deformation, shape keys and weight repaints all work on the base
+# mesh. Boundary edges and vertices of the selection are creased, so they stay where they are and the
+# subdivided patch is welded back onto the rest of the mesh.
+# Levels are inputs of the modifier: "Viewport Level" (0 by default) and "Render Level" (1).
+#
+def masked_subdivision_node_group():
+    name = "HS2 Masked Subdivision"
+    if name in bpy.data.node_groups:
+        return bpy.data.node_groups[name]
+    ng = bpy.data.node_groups.new(name, 'GeometryNodeTree')
+    ng.interface.new_socket("Geometry", in_out='INPUT', socket_type='NodeSocketGeometry')
+    socket = ng.interface.new_socket("Viewport Level", in_out='INPUT', socket_type='NodeSocketInt')
+    socket.default_value = 0
+    socket.min_value = 0
+    socket.max_value = 3
+    socket = ng.interface.new_socket("Render Level", in_out='INPUT', socket_type='NodeSocketInt')
+    socket.default_value = 1
+    socket.min_value = 0
+    socket.max_value = 3
+    ng.interface.new_socket("Geometry", in_out='OUTPUT', socket_type='NodeSocketGeometry')
+
+    nodes = ng.nodes
+    links = ng.links
+    group_in = nodes.new('NodeGroupInput')
+    group_out = nodes.new('NodeGroupOutput')
+
+    mask = nodes.new('GeometryNodeInputNamedAttribute')
+    mask.data_type = 'FLOAT'
+    mask.inputs["Name"].default_value = "Subdivision Mask"
+    # (older versions have one hidden output per data type)
+    mask_out = [x for x in mask.outputs if x.name=="Attribute" and x.enabled][0]
+    selected = nodes.new('FunctionNodeCompare')
+    selected.data_type = 'FLOAT'
+    selected.operation = 'GREATER_THAN'
+    selected.inputs[1].default_value = 0.5
+    links.new(mask_out, selected.inputs[0])
+
+    # flag the vertices on the boundary of the selected faces (some faces around them selected, some not),
+    # they are split by the separation and welded again at the end
+    face_share = nodes.new('GeometryNodeFieldOnDomain')
+    face_share.data_type = 'FLOAT'
+    face_share.domain = 'FACE'
+    links.new(selected.outputs["Result"], [x for x in face_share.inputs if x.enabled][0])
+    on_boundary = nodes.new('FunctionNodeCompare')
+    on_boundary.data_type = 'FLOAT'
+    on_boundary.operation = 'EQUAL'
+    on_boundary.inputs[1].default_value = 0.5
+    on_boundary.inputs["Epsilon"].default_value = 0.499
+    links.new([x for x in face_share.outputs if x.enabled][0], on_boundary.inputs[0])
+    store_seam = nodes.new('GeometryNodeStoreNamedAttribute')
+    store_seam.data_type = 'BOOLEAN'
+    store_seam.domain = 'POINT'
+    store_seam.inputs["Name"].default_value = "hs2_subdivision_seam"
+    links.new(group_in.outputs["Geometry"], store_seam.inputs["Geometry"])
+    links.new(on_boundary.outputs["Result"], [x for x in store_seam.inputs if x.name=="Value" and x.enabled][0])
+
+    separate = nodes.new('GeometryNodeSeparateGeometry')
+    separate.domain = 'FACE'
+    links.new(store_seam.outputs["Geometry"], separate.inputs["Geometry"])
+    links.new(selected.outputs["Result"], separate.inputs["Selection"])
+
+    # crease the boundary of the selection
+    edge_neighbors = nodes.new('GeometryNodeInputMeshEdgeNeighbors')
+    edge_crease = nodes.new('FunctionNodeCompare')
+    edge_crease.data_type = 'INT'
+    edge_crease.operation = 'EQUAL'
+    links.new(edge_neighbors.outputs["Face Count"], edge_crease.inputs[2])
+    edge_crease.inputs[3].default_value = 1
+    vertex_neighbors = nodes.new('GeometryNodeInputMeshVertexNeighbors')
+    vertex_crease = nodes.new('FunctionNodeCompare')
+    vertex_crease.data_type = 'INT'
+    vertex_crease.operation = 'LESS_THAN'
+    links.new(vertex_neighbors.outputs["Face Count"], vertex_crease.inputs[2])
+    links.new(vertex_neighbors.outputs["Vertex Count"], vertex_crease.inputs[3])
+
+    # level = render + is_viewport * (viewport - render)
+    is_viewport = nodes.new('GeometryNodeIsViewport')
+    level_delta = nodes.new('ShaderNodeMath')
+    level_delta.operation = 'SUBTRACT'
+    links.new(group_in.outputs["Viewport Level"], level_delta.inputs[0])
+    links.new(group_in.outputs["Render Level"], level_delta.inputs[1])
+    level = nodes.new('ShaderNodeMath')
+    level.operation = 'MULTIPLY_ADD'
+    links.new(is_viewport.outputs[0], level.inputs[0])
+    links.new(level_delta.outputs[0], level.inputs[1])
+    links.new(group_in.outputs["Render Level"], level.inputs[2])
+
+    subdiv = nodes.new('GeometryNodeSubdivisionSurface')
+    links.new(separate.outputs["Selection"], subdiv.inputs["Mesh"])
+    links.new(level.outputs[0], subdiv.inputs["Level"])
+    links.new(edge_crease.outputs["Result"], subdiv.inputs["Edge Crease"])
+    links.new(vertex_crease.outputs["Result"], subdiv.inputs["Vertex Crease"])
+
+    join = nodes.new('GeometryNodeJoinGeometry')
+    links.new(separate.outputs["Inverted"], join.inputs["Geometry"])
+    links.new(subdiv.outputs["Mesh"], join.inputs["Geometry"])
+    # only weld the seam between the two parts
+    seam = nodes.new('GeometryNodeInputNamedAttribute')
+    seam.data_type = 'BOOLEAN'
+    seam.inputs["Name"].default_value = "hs2_subdivision_seam"
+    weld = nodes.new('GeometryNodeMergeByDistance')
+    weld.inputs["Distance"].default_value = 0.00001
+    links.new(join.outputs["Geometry"], weld.inputs["Geometry"])
+    links.new([x for x in seam.outputs if x.name=="Attribute" and x.enabled][0], weld.inputs["Selection"])
+    remove_seam = nodes.new('GeometryNodeRemoveAttribute')
+    remove_seam.inputs["Name"].default_value = "hs2_subdivision_seam"
+    links.new(weld.outputs["Geometry"], remove_seam.inputs["Geometry"])
+    links.new(remove_seam.outputs["Geometry"], group_out.inputs["Geometry"])
+    return ng
+
+def add_masked_subdivision(arm, body):
+    t1 = time.time()
+    bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.view_layer.objects.active = body
+    snap = mesh_cache.snapshot(body)
+    keep = regions.classify(subdivide_keep_regions, False, snap.co(), regions.mesh_vertex_materials(body, snap))
+    if "Subdivision Mask" in body.vertex_groups:
+        body.vertex_groups.remove(body.vertex_groups["Subdivision Mask"])
+    vg = body.vertex_groups.new(name="Subdivision Mask")
+    vg.add(np.nonzero(keep)[0].tolist(), 1.0, 'REPLACE')
+    mesh_cache.touch(body, 'weights')
+
+    mod = body.modifiers.new("Masked subdivision", "NODES")
+    mod.node_group = masked_subdivision_node_group()
+    # after the armature, before the render-time subsurf
+    index = len(body.modifiers)-1
+    for i, m in enumerate(body.modifiers):
+        if m.type=='SUBSURF':
+            index = i
+            break
+    bpy.ops.object.modifier_move_to_index(modifier=mod.name, index=index)
+    t2 = time.time()
+    print("Masked subdivision: %d / %d verts in %.3f s" % (keep.sum(), len(keep), t2-t1))
+
 def add_shape_keys(arm, body, on):
     #bpy.qwerty()
     t1=time.time()
     t0=t1
-    bm = bmesh.new()
-    bm.from_mesh(body.data)
-    bm.verts.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
-    bm_owned = True
     # these are off by default:
     # Smile shape key
-    add_mouth_blendshape(body, bm)
+    add_mouth_blendshape(body)
     t2=time.time()
     print("Mouth: %.3f s" % (t2-t1))
     t1=t2
     if body['Boy']>0:
-        adams_apple_delete(arm, body, bm)
+        adams_apple_delete(arm, body)
     # these are on by default (possibly depending on gender) unless "Extend" is off:
-    tweak_nose(arm, body, bm, on=on)
+    tweak_nose(arm, body, on=on)
     t2=time.time()
     print("Nose: %.3f s" % (t2-t1))
     t1=t2
-    eye_shape(arm, body, bm, on=on)
+    eye_shape(arm, body, on=on)
     t2=time.time()
     print("Eye: %.3f s" % (t2-t1))
     t1=t2
-    eyelid_crease(arm, body, bm, on=on)
+    eyelid_crease(arm, body, on=on)
     t2=time.time()
     print("Eyelid: %.3f s" % (t2-t1))
     t1=t2
-    upper_lip_shapekey(arm, body, bm, on=on)
+    upper_lip_shapekey(arm, body, on=on)
     t2=time.time()
     print("Upper lip: %.3f s" % (t2-t1))
     t1=t2
-    lip_arch_shapekey(arm, body, bm, on=False)
+    lip_arch_shapekey(arm, body, on=False)
     t2=time.time()
     print("Lip arch: %.3f s" % (t2-t1))
     t1=t2
-    temple_depress(arm, body, bm, on=on)
+    temple_depress(arm, body, on=on)
     t2=time.time()
     print("temple_depress: %.3f s" % (t2-t1))
     t1=t2
-    forehead_flatten(arm, body, bm, on=on)
+    forehead_flatten(arm, body, on=on)
     t2=time.time()
     print("forehead_flatten: %.3f s" % (t2-t1))
     t1=t2
-    jaw_soften(arm, body, bm, on=False)
+    jaw_soften(arm, body, on=False)
     t2=time.time()
     print("jaw_soften: %.3f s" % (t2-t1))
     t1=t2
-    nasolabial_crease(arm, body, bm)
-    bm.free()
+    nasolabial_crease(arm, body)
     t2=time.time()
     print("%.3f s to add shape keys" % (t2-t0))
 #
@@ -1076,9 +1267,8 @@ def repaint_mouth_cavity(x):
         if old_chw==0.0 and chw>0.0:
             x.vertex_groups['cf_J_Chin_rs'].add([y], chw, 'ADD')
 
-def patch_cheekup_transitions(arm, body, bm):
+def patch_cheekup_transitions(arm, body):
     print("patch_cheekup_transitions")
-    lay = bm.loops.layers.uv['uv1']
 
     v_l=vgroup(body, ['cf_J_CheekUp_L','cf_J_CheekUp_R'])
     id_upl=body.vertex_groups['cf_J_CheekUp_L'].index
@@ -1147,18 +1337,20 @@ def patch_cheekup_transitions(arm, body, bm):
         w_cheek_max = min(w_cheek_max, cap_x2)
         return max(0.0, w_cheek - w_cheek_max) / w_cheek
 
-    split_vgroup(body, 'cf_J_CheekUp2_L', 'cf_J_CheekUp_L', cheek_excess_fraction, bm=bm)
-    split_vgroup(body, 'cf_J_CheekUp2_R', 'cf_J_CheekUp_R', cheek_excess_fraction, bm=bm)
+    split_vgroup(body, 'cf_J_CheekUp2_L', 'cf_J_CheekUp_L', cheek_excess_fraction)
+    split_vgroup(body, 'cf_J_CheekUp2_R', 'cf_J_CheekUp_R', cheek_excess_fraction)
     make_child_bone(arm, 'cf_J_FaceLow_s', 'cf_J_CheekUp2_L', Vector([0.32, 0.40, 0.19]), "Cheeks")
     make_child_bone(arm, 'cf_J_FaceLow_s', 'cf_J_CheekUp2_R', Vector([-0.32, 0.40, 0.19]), "Constrained - soft", copy='lrs')
 
-def patch_cheekup_transitions_part2(arm, body, bm):
-    lay = bm.loops.layers.uv['uv1']
+def patch_cheekup_transitions_part2(arm, body):
+    uvs = mesh_cache.snapshot(body).uvs()
     # Touch up weights of CheekLow at the cheek / nose boundary
     v_l=vgroup(body, ['cf_J_CheekUp_L','cf_J_CheekUp_R'])
+    # (no change outside of 0.630 < tx < 0.664, |ty| < 0.061)
+    v_l=np.array(v_l, dtype=np.int64)[uv_rect_mask(body, v_l, (0.390, 0.390, 0.460, 0.500), mirror=True)]
     id = body.vertex_groups['cf_J_FaceLow_s'].index
     for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
+        uv = Vector(uvs[x])
         if uv[0]>0.500:
             g='cf_J_CheekLow_L'
             uv=(1.-uv[0], uv[1])
@@ -1176,12 +1368,12 @@ def patch_cheekup_transitions_part2(arm, body, bm):
                 set_weight(body, x, g, old_weight + delta)
                 set_weight(body, x, id, wfl + delta)
 
-def patch_cheeklow_transitions(arm, body, bm):
-    lay = bm.loops.layers.uv['uv1']
+def patch_cheeklow_transitions(arm, body):
+    uvs = mesh_cache.snapshot(body).uvs()
     # Touch up weights of CheekLow at the cheek / chin boundary
     v_l=vgroup(body, ['cf_J_CheekLow_L','cf_J_CheekLow_R'])
     for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
+        uv = Vector(uvs[x])
         if uv[0]>0.500:
             g='cf_J_CheekLow_L'
         else:
@@ -1193,7 +1385,7 @@ def patch_cheeklow_transitions(arm, body, bm):
             new_weight = max(0., 0.095+t*3)
             set_weight(body, x, g, min(old_weight, new_weight))
 
-def create_cheekmid(arm, body, bm):
+def create_cheekmid(arm, body):
     vs = body.data.vertices
     v_r=vgroup(body, 'cf_J_CheekUp_R', min_wt=0.01)
     hl = [vs[y].co[1]+0.5*abs(vs[y].co[0]) for y in v_r]
@@ -1205,8 +1397,8 @@ def create_cheekmid(arm, body, bm):
         h = co[1]+0.5*abs(co[0])
         return clamp01(1.5-2.*(h-minpos)/(maxpos-minpos))
 
-    split_vgroup(body, 'cf_J_CheekMid_L', 'cf_J_CheekUp_L', mid_fraction, bm=bm)
-    split_vgroup(body, 'cf_J_CheekMid_R', 'cf_J_CheekUp_R', mid_fraction, bm=bm)
+    split_vgroup(body, 'cf_J_CheekMid_L', 'cf_J_CheekUp_L', mid_fraction)
+    split_vgroup(body, 'cf_J_CheekMid_R', 'cf_J_CheekUp_R', mid_fraction)
     make_child_bone(arm, 'cf_J_CheekUp_L', 'cf_J_CheekMid_L', Vector([-0.1, 0, 0]), "Cheeks")
     make_child_bone(arm, 'cf_J_CheekUp_R', 'cf_J_CheekMid_R', Vector([0.1, 0, 0]), "Constrained - soft", copy='lrs')
 
@@ -1224,19 +1416,14 @@ def add_skull_soft_neutral(arm, body):
     id_l = body.vertex_groups['cf_J_CheekUp_L'].index
     id_r = body.vertex_groups['cf_J_CheekUp_R'].index
 
-    bm = bmesh.new()
-    bm.from_mesh(body.data)
-    bm.verts.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
-
-    patch_cheekup_transitions(arm, body, bm)
-    patch_cheekup_transitions_part2(arm, body, bm)
-    patch_cheeklow_transitions(arm, body, bm)
+    patch_cheekup_transitions(arm, body)
+    patch_cheekup_transitions_part2(arm, body)
+    patch_cheeklow_transitions(arm, body)
 
-    create_cheekmid(arm, body, bm)
+    create_cheekmid(arm, body)
 
     # This is irreversible but harmless (fixing upper/lower lip identifications.)
-    repaint_mouth_minimal(arm, body, bm)
+    repaint_mouth_minimal(arm, body)
 
     make_child_bone(arm, 'cf_J_FaceLow_s', 'cf_J_FaceLow_s_s', Vector([0, 0, 0.01]), "Head internal")
     make_child_bone(arm, 'cf_J_MouthBase_s', 'cf_J_MouthBase_s_s', Vector([0, 0, 0.01]), "Mouth")
@@ -1246,8 +1433,6 @@ def add_skull_soft_neutral(arm, body):
     body.vertex_groups['cf_J_MouthBase_s'].name = 'cf_J_MouthBase_s_s'
     body.vertex_groups['cf_J_Nose_t'].name = 'cf_J_Nose_t_s'
 
-    bm.free()
-
 
 # Above pupil level, partially transfer nose weight to faceup 
 # (because, as painted, NoseBridge's effect extends well into the forehead)
@@ -1328,7 +1513,7 @@ def add_spine_rear_soft(arm, body):
     make_child_bone(arm, 'cf_J_Kosi01_s', 'cf_J_Kosi01_f_s', Vector([0,-0.1,0.04]), "Spine - soft")
     make_child_bone(arm, 'cf_J_Spine01_s', 'cf_J_Spine01_f_s', Vector([0,0.1,0.04]), "Spine - soft")
 
-def repaint_mouth_minimal(arm, body, bm):
+def repaint_mouth_minimal(arm, body):
     print("Repainting mouth...")
     if not 'cf_J_MouthCavity' in body.vertex_groups:
         return
@@ -1352,9 +1537,9 @@ def repaint_mouth_minimal(arm, body, bm):
     mcands = set(vgroup(body, ['cf_J_MouthLow','cf_J_Mouthup']))
     coord = {}
 
-    lay = bm.loops.layers.uv['uv1']
+    uvs = mesh_cache.snapshot(body).uvs()
     for n in mcands:
-        uv = bm.verts[n].link_loops[0][lay].uv
+        uv = Vector(uvs[n])
         upper = (uv[1]>0.335) or (uv[1]>0.330 and body.data.vertices[n].normal[1]<0)
         if uv[1]>0.315 and uv[1]<0.355 and uv[0]>0.432 and uv[0]<0.568:
             wud=get_weight(body, n, "cf_J_MouthLow")+get_weight(body, n, "cf_J_Mouthup")
@@ -1426,7 +1611,7 @@ def dissolve_facelow_s(arm, body, bm):
     t2=time.time()
     print("%3f s to dissolve facelow" % (t2-t1))
 
-def create_nasolabial(arm, body, bm):
+def create_nasolabial(arm, body):
     print("nasolabial")
     curve=[
     (0.332, 0.420),
@@ -1444,17 +1629,18 @@ def create_nasolabial(arm, body, bm):
         else:
             x_weight = max(0.0, 1.-abs(uv[0]-fold)/0.060)
         return x_weight * x_weight * y_weight * 0.5
-    create_functional_vgroup(body, "cf_J_Nasolabial_s", ["cf_J_NoseBase_s", "cf_J_MouthBase_s_s"], weight_nasolabial, bm=bm)
+    create_functional_vgroup(body, "cf_J_Nasolabial_s", ["cf_J_NoseBase_s", "cf_J_MouthBase_s_s"], weight_nasolabial,
+        uv_rect=(0.355, 0.332, 0.500, 0.450), mirror=True)
     make_child_bone(arm, 'cf_J_FaceBase', 'cf_J_Nasolabial_s', Vector([0,-0.15,0.8]), "Nose", tail_offset=Vector([0, 0.1, 0]))
 
-def create_nose_cheek(arm, body, bm):
+def create_nose_cheek(arm, body):
     #print("Creating cf_J_NoseCheek_s")
     def weight_nose_cheek(co, vert, **kwargs):
         return sigmoid(1-6.0*abs(co[0]), 0, 1) * sigmoid(co[1], 16.2, 16.0) * sigmoid(co[1], 16.4, 16.6)
-    split_vgroup(body, 'cf_J_NoseCheek_s', ['cf_J_NoseBase_s','cf_J_NoseBridge_s'], weight_nose_cheek, bm = bm)
+    split_vgroup(body, 'cf_J_NoseCheek_s', ['cf_J_NoseBase_s','cf_J_NoseBridge_s'], weight_nose_cheek)
     make_child_bone(arm, 'cf_J_NoseBase_s', 'cf_J_NoseCheek_s', Vector([0, 0.2, 0.01]), "Nose")
 
-def restrict_nosebase(arm, body, bm):
+def restrict_nosebase(arm, body):
     # Remove verts outside nasolabial folds from cf_J_NoseBase_s
     id_base = body.vertex_groups['cf_J_NoseBase_s'].index
     v=vgroup(body, 'cf_J_NoseBase_s', min_wt=0.001)
@@ -1469,6 +1655,7 @@ def restrict_nosebase(arm, body, bm):
                     g.weight = wmax
                 else:
                     g.weight *= (1.-wmax) / (1.-old_weight)
+    mesh_cache.touch(body, 'weights')
 
 
 def clean_cheeks(arm, body):
@@ -1485,7 +1672,7 @@ def clean_cheeks(arm, body):
         if body.data.vertices[x].co[0]>0:
             set_weight(body, x, id_r, 0.0)
 
-def jaw_edge(arm, body, bm):
+def jaw_edge(arm, body):
     curve=[
     (0.154, 0.333),
     (0.212, 0.260),
@@ -1511,9 +1698,9 @@ def jaw_edge(arm, body, bm):
     id_root_r = body.vertex_groups['cf_J_FaceRoot_r_s'].index
     v=vgroup(body, ['cf_J_Chin_rs','cf_J_ChinLow'], min_wt=0.001)
     vs=body.data.vertices
-    lay = bm.loops.layers.uv['uv1']
+    uvs = mesh_cache.snapshot(body).uvs()
     for y in v:
-        uv = bm.verts[y].link_loops[0][lay].uv
+        uv = Vector(uvs[y])
         if uv[0]>0.500:
             uv=(1-uv[0],uv[1])
         fold = curve_interp(curve, uv[1])
@@ -1533,15 +1720,15 @@ def jaw_edge(arm, body, bm):
                 add_weight(body, y, id_root, delta*(1-frac))
                 add_weight(body, y, id_root_r, delta*frac)
 
-def reassign_cheekup2(arm, body, bm):
+def reassign_cheekup2(arm, body):
     id_2l = body.vertex_groups['cf_J_CheekUp2_L'].index
     id_2r = body.vertex_groups['cf_J_CheekUp2_R'].index
     v_l=vgroup(body, ['cf_J_CheekUp2_L','cf_J_CheekUp2_R'])
     id_nasolabial = body.vertex_groups['cf_J_Nasolabial_s'].index
     id_nosecheek = body.vertex_groups['cf_J_NoseCheek_s'].index
-    lay = bm.loops.layers.uv['uv1']
+    uvs = mesh_cache.snapshot(body).uvs()
     for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
+        uv = Vector(uvs[x])
         wnl = get_weight(body, x, id_nasolabial)
         wnc = get_weight(body, x, id_nosecheek)
         if wnl+wnc>0.002:
@@ -1552,19 +1739,19 @@ def reassign_cheekup2(arm, body, bm):
             set_weight(body, x, id_2r, 0)
 
 
-def create_chin_cheek(arm, body, bm):
+def create_chin_cheek(arm, body):
     def weight_chin_cheek(uv, co, vert, **kwargs):
         if uv[0]>0.500:
             uv=(1-uv[0],uv[1])
         uv=(uv[0]-0.415,uv[1]-0.300)
         return sigmoid(math.sqrt(uv[0]*uv[0]+0.5*uv[1]*uv[1]-0.25*uv[0]*uv[1]), 0.0, 0.04)
-    #create_functional_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, bm = bm)
-    split_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, bm = bm)
+    #create_functional_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek)
+    split_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, uv_rect=(0.370, 0.240, 0.460, 0.360), mirror=True)
     make_child_bone(arm, 'cf_J_ChinFront_s', 'cf_J_ChinCheek_s', Vector([0,0,0.02]), "Chin")
 
 
 # does not work very well without subdivision, because we lack the level of detail in the area
-def nasolabial_crease(arm, body, bm):
+def nasolabial_crease(arm, body):
     curve=[
     (0.420, 0.332),
     (0.421, 0.362),
@@ -1615,7 +1802,7 @@ def nasolabial_crease(arm, body, bm):
 
     create_functional_shape_key(body, 'Nasolabial crease', ['cf_J_FaceLow_s_s','cf_J_MouthBase_s_s', 'cf_J_NoseBase_s',
         'cf_J_NoseWing_tx_L', 'cf_J_NoseWing_tx_R','cf_J_Mouth_L','cf_J_Mouth_R'], weight_nasolabial_crease, 
-        on = True, bm = None)
+        on = True)
     body.data.shape_keys.key_blocks['Nasolabial crease'].value=1.
 
 def clone_object(x):
@@ -1651,46 +1838,29 @@ def test_alignment(body, mesh):
 
     bpy.ops.object.mode_set(mode='OBJECT')
 
-    bmd = bmesh.new()
-    bmd.from_mesh(mesh.data)
-    bmd.verts.ensure_lookup_table()
-    v=set()
-    for x in bmd.edges:
-        if x.is_boundary:
-            if x.verts[0].co[1]<1.0:
-                vc = x.verts[0].co.copy()
-                vc.freeze()
-                v.add(vc)
-                vc = x.verts[1].co.copy()
-                vc.freeze()
-                v.add(vc)
+    # distinct positions of the candidate's open boundary
+    v = np.unique(mesh_cache.snapshot(mesh).co()[lower_boundary_edges(mesh).reshape([-1])], axis=0)
 
     #print("Body:", body, len(body.data.vertices))
-    #boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
-    boundary = [min([Vector((body.matrix_world @ y.co)-z).length for y in body.data.vertices])<0.0015 for z in v]
+    boundary = mesh_cache.snapshot(body).world_index().any_within(v, 0.0015)
     print("Candidate mesh:", mesh.name, "boundary", sum(boundary), "/", len(v), "verts")
     marked = sum(boundary)
-    bmd.free()
     return float(marked)/len(v)
 
-def uv_stitch(body, mesh):
-    bmd = bmesh.new()
-    bmd.from_mesh(mesh.data)
-    bmd.verts.ensure_lookup_table()
-    bmd.edges.ensure_lookup_table()
-    #v=set()
+# Open boundary of a prefab mesh: edges with a single linked face, below y=1.0
+def lower_boundary_edges(mesh):
+    snap = mesh_cache.snapshot(mesh)
+    edges = snap.edges()[snap.edge_face_counts()==1]
+    return edges[snap.co()[edges[:,0],1]<1.0]
 
+def uv_stitch(body, mesh):
     vg = mesh.vertex_groups.new(name="Stitch Boundary")
     vg2 = mesh.vertex_groups.new(name="Stitch Mesh")
     vg2.add(list(range(len(mesh.data.vertices))), 1.0, 'ADD')
-    for x in bmd.edges:
-        if x.is_boundary:
-            if x.verts[0].co[1]<1.0:
-                vg.add([x.verts[0].index], 1.0, 'ADD')
-                vg.add([x.verts[1].index], 1.0, 'ADD')
-    bmd.free()
+    vg.add(np.unique(lower_boundary_edges(mesh)).tolist(), 1.0, 'ADD')
     body.data.update()
     mesh.data.update()
+    # (join_meshes leaves us in object mode, with mesh data in sync)
     join_meshes([body.name, mesh.name])
     v = vgroup(body, "Stitch Boundary")
     vm = set(vgroup(body, "Stitch Mesh"))
@@ -1698,45 +1868,36 @@ def uv_stitch(body, mesh):
     main_mesh = set(vgroup(body, 'cf_J_Kosi02_s')) - vm
     vs = body.data.vertices
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.object.mode_set(mode='OBJECT')
     bmd = bmesh.new()
     bmd.from_mesh(body.data)
 
     bmd.verts.ensure_lookup_table()
     bmd.edges.ensure_lookup_table()
-    lay = bmd.loops.layers.uv['uv1']
-    def uv(x, k):
-        return bmd.verts[x].link_loops[k % len(bmd.verts[x].link_loops)][lay].uv
+    snap = mesh_cache.snapshot(body)
 
     stitch = []
     stitch_verts=[]
     t1 = time.time()
 
-    cos = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
-    body.data.vertices.foreach_get("co", cos)
-    cos = cos.reshape([-1,3])
-    xs = cos[v].reshape([-1,1,3])
-    main_mesh_list = [z for z in main_mesh]
-    ys = cos[main_mesh_list].reshape([1,-1,3])
-    xy = xs-ys
-    xy *= xy
-    xy = np.sqrt(xy[:,:,0]+xy[:,:,1]+xy[:,:,2])
-    v_nearest = np.argmin(xy, axis=1)
+    cos = snap.co()
+    main_mesh_list = sorted(main_mesh)
+    v_nearest, v_dist = spatial.vertex_index(cos, main_mesh_list).nearest(cos[v])
+    # No 3D match: fall back to the nearest main mesh vertex in UV space, over all of its loop UVs
+    fallback = np.nonzero(v_dist >= 0.002)[0]
+    if len(fallback)>0:
+        offsets, loop_uvs = snap.loop_uvs()
+        uv_index = spatial.loop_uv_index(offsets, loop_uvs, main_mesh_list)
+        v_nearest[fallback] = uv_index.nearest(snap.uvs()[np.array(v)[fallback]])[0]
     t2 = time.time()
     for i, x in enumerate(v):
-        nearest_xyz = main_mesh_list[v_nearest[i]]
-        if (bmd.verts[x].co-bmd.verts[nearest_xyz].co).length < 0.002:
-            nearest = nearest_xyz
-        else:
-            nearest_uv = min([z for z in main_mesh], key=lambda y: min([(uv(y,k)-uv(x,0)).length for k in range(6)]))
-            nearest = nearest_uv
+        nearest = int(v_nearest[i])
+        if nearest<0:
+            continue
         stitch.append([x,nearest])
         stitch_verts.append(bmd.verts[x])
         stitch_verts.append(bmd.verts[nearest])
     t3 = time.time()
-    print("find_nearest: %.3f + %.3f s" % (t2-t1, t3-t2))
+    print("find_nearest: %.3f + %.3f s, %d / %d verts matched in UV space" % (t2-t1, t3-t2, len(fallback), len(v)))
     main_boundary = [x[1] for x in stitch]
     boundary_mask = [False]*len(vs)
     for x in main_boundary:
@@ -1780,6 +1941,7 @@ def uv_stitch(body, mesh):
 
     body.vertex_groups.remove(body.vertex_groups["Stitch Boundary"])
     body.vertex_groups.remove(body.vertex_groups["Stitch Mesh"])
+    mesh_cache.touch(body)
 
 
 # stitch=True: merge into the body even if there's no edge alignment
@@ -1797,23 +1959,13 @@ def excise_neuter_mesh(body, injector_mesh, stitch=False):
 
     bpy.ops.object.mode_set(mode='OBJECT')
 
-    bmd = bmesh.new()
-    bmd.from_mesh(injector_mesh.data)
-    bmd.verts.ensure_lookup_table()
-    v=set()
-    for x in bmd.edges:
-        if x.is_boundary:
-            if x.verts[0].co[1]<1.0:
-                vc = x.verts[0].co.copy()
-                vc.freeze()
-                v.add(vc)
-                vc = x.verts[1].co.copy()
-                vc.freeze()
-                v.add(vc)
+    # distinct positions of the injector's open boundary, and the body verts that lie on it
+    v = np.unique(mesh_cache.snapshot(injector_mesh).co()[lower_boundary_edges(injector_mesh).reshape([-1])], axis=0)
+    slit = spatial.PointIndex(v)
 
     #print("Body:", body, len(body.data.vertices))
     #print("New mesh: 
-    boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
+    boundary = slit.any_within(mesh_cache.snapshot(body).world_co(), 0.0015)
     marked = sum(boundary)
     print(marked, "/", len(v), "excision vertices found")
     #if marked > 0 and marked < len(v):
@@ -1841,28 +1993,15 @@ def excise_neuter_mesh(body, injector_mesh, stitch=False):
         join_meshes([body.name, injector_mesh.name])
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        bmd = bmesh.new()
-        bmd.from_mesh(body.data)
-        bmd.verts.ensure_lookup_table()
-        new_boundary=set()
-        for x in bmd.edges:
-            if x.is_boundary:
-                vc=x.verts[0].co.copy()
-                vc.freeze()
-                new_boundary.add(vc)
-                vc=x.verts[1].co.copy()
-                vc.freeze()
-                new_boundary.add(vc)
-
-        boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
+        snap = mesh_cache.snapshot(body)
+        cos = snap.co()
+        new_boundary = spatial.PointIndex(np.unique(cos[snap.edges()[snap.edge_face_counts()==1].reshape([-1])], axis=0))
+
+        boundary = slit.any_within(snap.world_co(), 0.0015)
         print("Near the slit:", sum(boundary), "verts")
-        
-        for x in range(len(body.data.vertices)):
-            if not boundary[x]:
-                continue
-            y=body.data.vertices[x].co
-            if min([Vector(y-z).length for z in new_boundary])>0.00001:
-                boundary[x]=False
+
+        near = np.nonzero(boundary)[0]
+        boundary[near] = new_boundary.any_within(cos[near], 0.00001)
         print("Boundary:", sum(boundary), "verts")
 
         body.data.vertices.foreach_set('select', boundary)
@@ -2180,6 +2319,9 @@ def attach_injector(arm, body):
     print("%.3f s to attach injector" % (t2-t1))
 
 def paint_scalp(arm, body):
+    if "Scalp" in body.vertex_groups:
+        body.vertex_groups.remove(body.vertex_groups["Scalp"])
+        mesh_cache.touch(body, 'weights')
     vg=body.vertex_groups.new(name="Scalp")
     faceup = vgroup(body,"cf_J_FaceUp_ty")
     ignore = set(vgroup(body,['cf_J_EarLow_L','cf_J_EarLow_R',
@@ -2200,6 +2342,7 @@ def paint_scalp(arm, body):
         if get_weight(body, v, "cf_J_FaceRoot_s")>0.0 and body.data.vertices[v].co[2]>-0.5:
             continue
         vg.add([v], 1.0, 'ADD')
+    mesh_cache.touch(body, 'weights')
 
 def mesh_hair_to_curves(body, hair):
     #paint_scalp(body)
@@ -2229,7 +2372,7 @@ def mesh_hair_to_curves(body, hair):
     # Create hair material and connect hair color to interface
 
 
-def paint_nostrils(arm, body, bm):
+def paint_nostrils(arm, body):
     id_l=body.vertex_groups['cf_J_Nostril_L'].index
     id_r=body.vertex_groups['cf_J_Nostril_R'].index
     id_c=body.vertex_groups['cf_J_Nose_Septum'].index
@@ -2246,32 +2389,39 @@ def paint_nostrils(arm, body, bm):
         'cf_J_Nostril_L','cf_J_Nostril_R',
         'cf_J_Nose_Septum', 'cf_J_NoseBase_s'])
 
-    lay = bm.loops.layers.uv['uv1']
+    uvs = mesh_cache.snapshot(body).uvs()
+
+    # The nostril and septum ovals are 0 outside of this rectangle (see uv_rect_mask); the nose tip / base
+    # transfer below applies to every vertex in 'v'
+    inside = uv_rect_mask(body, v, (0.455, 0.365, 0.545, 0.445))
 
     #print(len(v), "candidate nostril verts")
     boy = (body['Boy']>0.0)
     uv_skew = 0.0 if boy else 0.7
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        septum_bump = bump(uv[0], 0.490, 0.500, 0.510)
-        # 'cf_J_Nostril_*' support: ovals around (0.4826,0.4195) 
-        # (geometry is slightly different between M and F)
-
-        r = (uv-Vector([1-0.4826,0.4195]))
-        r = math.sqrt(r[0]*r[0] + r[1]*r[1] + uv_skew*r[0]*r[1])
-        wtl = sigmoid(r, 0.006, 0.018) * (1-septum_bump)
-
-        r2 = uv-Vector([0.4826,0.4195])
-        r2 = math.sqrt(r2[0]*r2[0] + r2[1]*r2[1] - uv_skew*r2[0]*r2[1])
-        wtr = sigmoid(r2, 0.006, 0.018) * (1-septum_bump)
-
-        # 'cf_J_Nose_Septum' support: oval around (0.500,0.406) .. (0.500,0.418) 
-        r3 = uv-Vector([0.5000,0.418])
-        if r3[1]<0.0:
-            r3[1] = min(0.0, r3[1]+0.012)
+    for i, x in enumerate(v):
+        uv = Vector(uvs[x])
+        if inside[i]:
+            septum_bump = bump(uv[0], 0.490, 0.500, 0.510)
+            # 'cf_J_Nostril_*' support: ovals around (0.4826,0.4195) 
+            # (geometry is slightly different between M and F)
+
+            r = (uv-Vector([1-0.4826,0.4195]))
+            r = math.sqrt(r[0]*r[0] + r[1]*r[1] + uv_skew*r[0]*r[1])
+            wtl = sigmoid(r, 0.006, 0.018) * (1-septum_bump)
+
+            r2 = uv-Vector([0.4826,0.4195])
+            r2 = math.sqrt(r2[0]*r2[0] + r2[1]*r2[1] - uv_skew*r2[0]*r2[1])
+            wtr = sigmoid(r2, 0.006, 0.018) * (1-septum_bump)
+
+            # 'cf_J_Nose_Septum' support: oval around (0.500,0.406) .. (0.500,0.418) 
+            r3 = uv-Vector([0.5000,0.418])
+            if r3[1]<0.0:
+                r3[1] = min(0.0, r3[1]+0.012)
+            else:
+                r3[1] *= 2.0
+            wtc = sigmoid(r3.length, 0.000, 0.036)
         else:
-            r3[1] *= 2.0
-        wtc = sigmoid(r3.length, 0.000, 0.036)
+            wtl = wtr = wtc = 0.0
 
         w_nose_t = get_weight(body, x, id_tt)
         w_nose_wl = get_weight(body, x, id_wl)
@@ -2306,7 +2456,7 @@ def paint_nostrils(arm, body, bm):
         set_weight(body, x, id_tt, w_nose_t)
 
 
-def add_nostrils(arm, body, bm):
+def add_nostrils(arm, body):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = arm
     make_child_bone(arm, 'cf_J_Nose_t', 'cf_J_Nostril_L', Vector([0.07, -0.065, 0.07]), "Nose")
@@ -2322,68 +2472,81 @@ def add_nostrils(arm, body, bm):
     vgl = body.vertex_groups.new(name='cf_J_Nostril_L')
     vgr = body.vertex_groups.new(name='cf_J_Nostril_R')
     vgs = body.vertex_groups.new(name='cf_J_Nose_Septum')
-    paint_nostrils(arm, body, bm)
-
-    bpy.context.view_layer.objects.active = body
-    bpy.ops.paint.weight_paint_toggle()
-    bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.002)
-    bpy.ops.paint.weight_paint_toggle()
+    mesh_cache.touch(body, 'weights')
+    paint_nostrils(arm, body)
+
+    weights.clean_weights(body, arm, 0.002)
+
+# Hash of everything the T-pose shape depends on: final bone matrices, rest coordinates, the data and values
+# of the active shape keys, the vertex weights and the topology
+def rig_hash(arm, body):
+    bpy.context.view_layer.update()
+    h = hashlib.sha1()
+    mats = np.zeros([len(arm.pose.bones), 16], dtype=np.float32)
+    for i, b in enumerate(arm.pose.bones):
+        mats[i] = np.array(b.matrix, dtype=np.float32).reshape([-1])
+    h.update(np.round(mats, 5).tobytes())
+    mesh = body.data
+    h.update(str(mesh_cache.topology_key(mesh)).encode())
+    co = np.zeros([len(mesh.vertices)*3], dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    h.update(co.tobytes())
+    if mesh.shape_keys is not None:
+        blocks = mesh.shape_keys.key_blocks
+        values = np.zeros([len(blocks)], dtype=np.float32)
+        blocks.foreach_get("value", values)
+        h.update(np.round(values, 5).tobytes())
+        active = set()
+        for k in blocks:
+            if k.value!=0.0 and not k.mute:
+                active.update([k.name, k.relative_key.name])
+        for k in blocks:
+            if k.name in active:
+                h.update(k.name.encode())
+                k.data.foreach_get("co", co)
+                h.update(co.tobytes())
+    h.update(str([g.name for g in body.vertex_groups]).encode())
+    verts, groups, wts = weights.read_weights(body)
+    order = np.lexsort((verts, groups))
+    for x in [verts, groups, wts]:
+        h.update(x[order].tobytes())
+    return h.hexdigest()
+
+def set_vector_attribute(body, name, values):
+    if name in body.data.attributes:
+        body.data.attributes.remove(body.data.attributes[name])
+    attr = body.data.attributes.new(name=name, type="FLOAT_VECTOR", domain="POINT")
+    # attribute is a float vector, but foreach_set expects a flattened float array
+    attr.data.foreach_set("vector", values)
 
 # memorize coordinates and normals of all verts in T-pose (used by the skin generator, 
 # to correctly distribute skin pores and to tan upward-facing skin)
+# Skipped if the rig, the mesh, the shape keys and the weights haven't changed since the last call.
 def add_t_pos(arm, body):
     armature.set_fk_pose(arm, [])
     bpy.context.view_layer.objects.active = body
-    if "T-position" in body.data.attributes:
-        body.data.attributes.remove(body.data.attributes["T-position"])
-    attr = body.data.attributes.new(name="T-position", type="FLOAT_VECTOR", domain="POINT")
-    depsgraph = bpy.context.evaluated_depsgraph_get()
-    bm = bmesh.new()
-    bm.from_object( body, depsgraph )
-    bm.verts.ensure_lookup_table()
-    verts = [y for x in range(len(body.data.vertices)) for y in bm.verts[x].co]
-    verts = verts[:]
-    # attribute is a float vector, but foreach_set expects a flattened float array
-    attr.data.foreach_set("vector", verts)
-    if "T-normal" in body.data.attributes:
-        body.data.attributes.remove(body.data.attributes["T-normal"])
-    attrn = body.data.attributes.new(name="T-normal", type="FLOAT_VECTOR", domain="POINT")
-    verts = [y for x in range(len(body.data.vertices))  for y in bm.verts[x].normal]
-    verts = verts[:]
-    #print(verts[:6])
-    attrn.data.foreach_set("vector", verts)
-    bm.free()
-
-def get_linked_by_material(body, x, bm):
-    v=set({x})
-    mat = bm.verts[x].link_faces[0].material_index
-
-    v_out=set({x})
-    while len(v)>0:
-        v_next=set({})
-        for y in v:
-            for z in bm.verts[y].link_edges:
-                for w in z.verts:
-                    if w.index in v_out:
-                        continue
-                    if any([f.material_index==mat for f in w.link_faces]):
-                        v_next.add(w.index)
-        v_out = v_out | v_next
-        v = v_next
-    return v_out
+    key = rig_hash(arm, body)
+    if body.get("t_pos_hash")==key and "T-position" in body.data.attributes and "T-normal" in body.data.attributes:
+        print("T-position unchanged")
+        return
 
-    """
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_all(action='DESELECT')
-    bpy.ops.object.mode_set(mode='OBJECT')
-    body.data.vertices[x].select = True
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_linked(delimit={'MATERIAL'})
-    bpy.ops.object.mode_set(mode='OBJECT')
-    v = [False]*len(body.data.vertices)
-    body.data.vertices.foreach_get("select", v)
-    return set([x for x in range(len(v)) if v[x]])
-    """
+    # Modifiers after the armature (e.g. masked subdivision) would change the vertex count or order
+    disabled = [mod for mod in body.modifiers if mod.type in ['SUBSURF', 'NODES'] and mod.show_viewport]
+    for mod in disabled:
+        mod.show_viewport = False
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    mesh = body.evaluated_get(depsgraph).data
+    nv = len(body.data.vertices)
+    co = np.zeros([nv*3], dtype=np.float32)
+    normal = np.zeros([nv*3], dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    mesh.vertices.foreach_get("normal", normal)
+    for mod in disabled:
+        mod.show_viewport = True
+
+    set_vector_attribute(body, "T-position", co)
+    set_vector_attribute(body, "T-normal", normal)
+    body["t_pos_hash"] = key
 
 def tweak_nails(arm, body):
     t1=time.time()
@@ -2440,13 +2603,11 @@ def tweak_nails(arm, body):
         bpy.ops.object.material_slot_assign()
 
     bpy.ops.object.mode_set(mode='OBJECT')
-    mask_full = [False]*len(body.data.vertices)
+    mask_full = np.zeros([len(body.data.vertices)], dtype=bool)
     body.data.vertices.foreach_get("select", mask_full)
-    vs_full = set([x for x in range(len(mask_full)) if mask_full[x]])
     bpy.ops.object.mode_set(mode='EDIT')
 
-    # Deselect rims (because get_linked_by_material() only works correctly
-    # when starting from a vertex entirely inside the nail)
+    # Deselect rims (a nail is found through a vertex entirely inside it)
     for i, slot in enumerate(body.material_slots):
         if slot.material == body["torso_mat"]:
             body.active_material_index = i
@@ -2454,20 +2615,18 @@ def tweak_nails(arm, body):
 
     # Get the list of all 'core' nail vertices
     bpy.ops.object.mode_set(mode='OBJECT')
-    mask = [False]*len(body.data.vertices)
+    mask = np.zeros([len(body.data.vertices)], dtype=bool)
     body.data.vertices.foreach_get("select", mask)
-    vs = set([x for x in range(len(mask)) if mask[x]])
 
-    vs_rim = vs_full-vs
+    rim = mask_full & ~mask
 
     bpy.ops.object.mode_set(mode='EDIT')
     bpy.ops.mesh.select_less()
     bpy.ops.mesh.select_less()
     bpy.ops.object.mode_set(mode='OBJECT')
-    mask2 = [False]*len(body.data.vertices)
+    mask2 = np.zeros([len(body.data.vertices)], dtype=bool)
     body.data.vertices.foreach_get("select", mask2)
-    vs2 = set([x for x in range(len(mask2)) if mask2[x]])
-    vs_rim2 = vs - vs2
+    rim2 = mask & ~mask2
 
     if not key_exists:
         # If we are doing this for the first time on the char, mark nail rims as sharp and creased
@@ -2480,147 +2639,136 @@ def tweak_nails(arm, body):
         bpy.ops.mesh.mark_sharp()
         bpy.ops.transform.edge_crease(value=1)
 
-    # Create the shape key
+    # Create the shape keys
     bpy.ops.object.mode_set(mode='OBJECT')
+    mesh_cache.touch(body)
+    snap = mesh_cache.snapshot(body)
+    nv = len(body.data.vertices)
+    basis = np.zeros([nv*3], dtype=np.float32)
+    body.data.shape_keys.key_blocks["Basis"].data.foreach_get("co", basis)
+    basis = basis.reshape([-1,3])
     sk = body.shape_key_add(name="Nails")
     sk.interpolation='KEY_LINEAR'
     sk2 = body.shape_key_add(name="Long fingernails")
     sk2.interpolation='KEY_LINEAR'
     sk3 = body.shape_key_add(name="Long toenails")
     sk3.interpolation='KEY_LINEAR'
-    for x in range(len(body.data.vertices)):
-        sk.data[x].co = body.data.shape_keys.key_blocks["Basis"].data[x].co
-        sk2.data[x].co = body.data.shape_keys.key_blocks["Basis"].data[x].co
-    sets = []
-    body.data.vertices.update()
-
-    bm = bmesh.new()
-    bm.from_mesh( body.data )
-    bm.verts.ensure_lookup_table()
-
-    while len(vs)>0:
-        body.data.vertices.update()
-        nail = get_linked_by_material(body, vs.pop(), bm)
-        sets.append(nail)
-        vs = vs-nail 
-
-    bm.free()
-    ext_sets = []
-    for nail in sets:
-        v0 = sum([body.data.vertices[x].normal for x in nail], Vector([0,0,0]))
-        v0.normalize()
-        c0 = sum([body.data.vertices[x].co for x in nail], Vector([0,0,0]))
-        c0 /= len(nail)
-
-        mat=Matrix([[0,0,0],[0,0,0],[0,0,0]])
-
-        toenail = abs(c0[0])<5.0
-        thumb = (v0[2]>0.5) and not toenail
-        scale = (1, 1.1, 0.95)
-        angle=0.08
-        if toenail:
-            v1 = Vector([1.0*(0.95-abs(c0[0]))*(1 if c0[0]>0 else -1), 0, 1])
-        elif thumb:
-            v1 = Vector([1 if c0[0]>0 else -1, 0, 0.3])
-        else:
-            v1 = Vector([1 if c0[0]>0 else -1, -0.10, 0.1*(c0[2]+0.20)])
-
-        # Doing this with bpy.ops.transform.resize/rotate/etc. does not work well (possible Blender bugs?)
-        v1.normalize()
-        v0 -= v1*v0.dot(v1)
-        v0.normalize()
-
-        v2 = v0.cross(v1)
-        offset = v1*0.006
-
-        for c in range(3):
-            v = Vector([0,0,0])
-            v[c] = 1.0
-            v = Vector([v.dot(v0), v.dot(v1), v.dot(v2)])
-            v = Vector([v[0]*scale[0], v[1]*scale[1], v[2]*scale[2]])
-            v = Vector([v[0]*math.cos(angle)-v[1]*math.sin(angle), v[0]*math.sin(angle)+v[1]*math.cos(angle), v[2]])
-            v = v0*v[0]+v1*v[1]+v2*v[2]
-            mat[c] = v
-
-        max_z = 0.0
-        max_x = 0.0
-        phi = 0.5
-
-        for x in nail:
-            co = body.data.shape_keys.key_blocks["Basis"].data[x].co.copy()
-
-            # Scale the nail bed by 1.1x lengthwise, 0.95x widthwise, 
-            # rotate it by 0.08 radians and move it towards the fingertip
-            co = (mat @ (co - c0)) + c0 + offset
-
-            dv = co-c0
-            r = dv.normalized()
-            dot = r.dot(v1)
-
-            # Flatten tips of the nails
-            dv -= v0*dv.dot(v0)*max(dot, 0.0)*0.5
-
-            # Basic (short nail) form
-            sk.data[x].co = c0+dv
-
-            # Long fingernails/toenails:
-            effect = Vector([0,0,0])
-
-            if dot>phi:
-                # Extrude the outer edge of the nail
-                if x in vs_rim:
-                    effect = v1*(dot-phi)*0.1 + v0*(dot-phi)*(-0.02 if toenail else 0.0)
-
-                # Move the next row of vertexes in the same direction
-                if x in vs_rim2:
-                    effect = v1*(dot-phi)*0.01 + v0*(dot-phi)*0.003
-
-                if toenail:
-                    sk3.data[x].co += effect
-                else:
-                    sk2.data[x].co += effect
-
-            max_z = max(max_z, (co-c0).dot(v1))
-            max_x = max(max_x, (co-c0).dot(v2))
-        ext_sets.append((nail, c0, v0, v1, v2, max_x, max_z))
-
-        for x in nail:
-            r = sk.data[x].co-c0
-
-            r.normalize()
-            dot = r.dot(v1)
-            phi = 0.5 if (thumb or toenail) else 0.66
-            if x in vs_rim or x in vs_rim2:
-                if dot>phi:
-                    if toenail:
-                        # Fix the weird shape of toenail front rims
-                        sk.data[x].co = c0 + r*max_z*(0.95 if x in vs_rim2 else 1.0)
-
-    bm = bmesh.new()
-    bm.from_mesh( body.data)
-    bm.verts.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
-
-    lay = bm.loops.layers.uv['uv1']
-    for nail, c0, v0, v1, v2, max_x, max_z in ext_sets:
-        toenail = abs(c0[0])<5.0
-        thumb = (v0[2]>0.5) and not toenail
-        for x in nail:
-            r = sk.data[x].co-c0
-            r.normalize()
-            dot = r.dot(v1)
-            phi = 0.5 if (thumb or toenail) else 0.66
-            #if dot>0.0:
-            if toenail:
-                uv = (0.954 + 0.034*(sk.data[x].co-c0).dot(v2)/max_x, 0.355 - 0.030 * (sk.data[x].co-c0).dot(v1)/max_z)
-            else:
-                uv = (0.892 + 0.014*(sk.data[x].co-c0).dot(v2)/max_x, 0.346 - 0.022 * (sk.data[x].co-c0).dot(v1)/max_z)
-            for loop in bm.verts[x].link_loops:
-                if loop.face.material_index == material_index:
-                    loop[lay].uv = uv
-
-    bm.to_mesh(body.data)
-    bm.free()
+    sk_co = basis.copy()
+    sk2_co = basis.copy()
+    sk3_co = basis.copy()
+
+    # Each nail is a connected component of the vertices in the 'Nails' material, containing some core vertices
+    nail_slots = [i for i, slot in enumerate(body.material_slots) if slot.material == body["nails_mat"]]
+    loop_verts = snap.loop_verts()
+    loop_mats = snap.face_materials()[snap.loop_faces()]
+    in_nails = np.zeros([nv], dtype=bool)
+    in_nails[loop_verts[np.isin(loop_mats, nail_slots)]] = True
+    edges = snap.edges()
+    edges = edges[in_nails[edges[:,0]] & in_nails[edges[:,1]]]
+    labels = mesh_cache.connected_components(nv, edges)
+    nail_labels = np.unique(labels[mask])
+    nail_verts = np.nonzero(np.isin(labels, nail_labels))[0]
+    nail_ids = np.searchsorted(nail_labels, labels[nail_verts])
+
+    # Centroids and mean normals
+    n_nails = len(nail_labels)
+    centers = np.zeros([n_nails, 3])
+    np.add.at(centers, nail_ids, snap.co()[nail_verts])
+    centers /= np.bincount(nail_ids, minlength=n_nails).reshape([-1,1])
+    normals = np.zeros([n_nails, 3])
+    np.add.at(normals, nail_ids, snap.normals()[nail_verts])
+
+    def unit(x):
+        return x / np.maximum(np.linalg.norm(x, axis=1), 1e-12).reshape([-1,1])
+
+    # Frame of every nail: a1 points towards the fingertip, a0 along the nail's normal, a2 across
+    c = centers.astype(np.float32)
+    sign = np.where(c[:,0]>0, 1.0, -1.0)
+    toenail = np.abs(c[:,0])<5.0
+    a0 = unit(normals)
+    thumb = (a0[:,2]>0.5) & ~toenail
+    a1 = np.stack([sign, np.full(n_nails, -0.10), 0.1*(c[:,2]+0.20)], axis=1)
+    a1[thumb] = np.stack([sign, np.zeros(n_nails), np.full(n_nails, 0.3)], axis=1)[thumb]
+    a1[toenail] = np.stack([(0.95-np.abs(c[:,0]))*sign, np.zeros(n_nails), np.ones(n_nails)], axis=1)[toenail]
+    a1 = unit(a1)
+    a0 = unit(a0 - a1*(a0*a1).sum(axis=1).reshape([-1,1]))
+    a2 = np.cross(a0, a1)
+    a0, a1, a2 = [x.astype(np.float32) for x in (a0, a1, a2)]
+
+    # Scale the nail bed by 1.1x lengthwise, 0.95x widthwise, rotate it by 0.08 radians around a2
+    # (in the nail's frame) and move it towards the fingertip
+    # (doing this with bpy.ops.transform.resize/rotate/etc. does not work well, possible Blender bugs?)
+    angle = 0.08
+    rot = np.array([[math.cos(angle), -math.sin(angle), 0], [math.sin(angle), math.cos(angle), 0], [0, 0, 1]])
+    frames = np.stack([a0, a1, a2], axis=1)
+    xforms = (frames.transpose([0,2,1]) @ (rot @ np.diag([1, 1.1, 0.95])) @ frames).astype(np.float32)
+
+    # Per-vertex copies of the per-nail values
+    cv, a0v, a1v, a2v = c[nail_ids], a0[nail_ids], a1[nail_ids], a2[nail_ids]
+    toe_v = toenail[nail_ids]
+    rim_v = rim[nail_verts]
+    rim2_v = rim2[nail_verts]
+
+    def dots(x, y):
+        return (x*y).sum(axis=1)
+
+    co = np.einsum('vj,vjk->vk', basis[nail_verts]-cv, xforms[nail_ids]) + cv + a1v*0.006
+    dv = co-cv
+    dot = dots(unit(dv), a1v)
+
+    # Flatten tips of the nails
+    dv -= a0v * (dots(dv, a0v) * np.maximum(dot, 0.0) * 0.5).reshape([-1,1])
+
+    # Basic (short nail) form
+    nail_co = cv+dv
+
+    # Long fingernails/toenails:
+    # extrude the outer edge of the nail, and move the next row of vertexes in the same direction
+    phi = 0.5
+    effect = np.zeros([len(nail_verts), 3], dtype=np.float32)
+    d = (dot-phi).reshape([-1,1])
+    m = (dot>phi) & rim_v
+    effect[m] = (a1v*d*0.1 + a0v*d*np.where(toe_v, -0.02, 0.0).reshape([-1,1]))[m]
+    m = (dot>phi) & rim2_v
+    effect[m] = (a1v*d*0.01 + a0v*d*0.003)[m]
+    sk3_co[nail_verts[toe_v]] += effect[toe_v]
+    sk2_co[nail_verts[~toe_v]] += effect[~toe_v]
+
+    max_z = np.zeros([n_nails], dtype=np.float32)
+    np.maximum.at(max_z, nail_ids, dots(co-cv, a1v))
+    max_x = np.zeros([n_nails], dtype=np.float32)
+    np.maximum.at(max_x, nail_ids, dots(co-cv, a2v))
+
+    # Fix the weird shape of toenail front rims
+    r = unit(nail_co-cv)
+    dot = dots(r, a1v)
+    phi = np.where(thumb | toenail, 0.5, 0.66)[nail_ids]
+    m = toe_v & (rim_v | rim2_v) & (dot>phi)
+    nail_co[m] = cv[m] + r[m]*(max_z[nail_ids]*np.where(rim2_v, 0.95, 1.0))[m].reshape([-1,1])
+    sk_co[nail_verts] = nail_co
+
+    d = nail_co-cv
+    u = dots(d, a2v)/max_x[nail_ids]
+    v = dots(d, a1v)/max_z[nail_ids]
+    nail_uvs = np.zeros([nv, 2], dtype=np.float32)
+    nail_uvs[nail_verts,0] = np.where(toe_v, 0.954 + 0.034*u, 0.892 + 0.014*u)
+    nail_uvs[nail_verts,1] = np.where(toe_v, 0.355 - 0.030*v, 0.346 - 0.022*v)
+
+    sk.data.foreach_set("co", sk_co.reshape([-1]))
+    sk2.data.foreach_set("co", sk2_co.reshape([-1]))
+    sk3.data.foreach_set("co", sk3_co.reshape([-1]))
+
+    # Nail UVs, on the loops of nail faces only
+    uv_layer = body.data.uv_layers['uv1']
+    uvs = np.zeros([len(body.data.loops)*2], dtype=np.float32)
+    uv_layer.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape([-1,2])
+    is_nail = np.zeros([nv], dtype=bool)
+    is_nail[nail_verts] = True
+    m = (loop_mats==material_index) & is_nail[loop_verts]
+    uvs[m] = nail_uvs[loop_verts[m]]
+    uv_layer.data.foreach_set("uv", uvs.reshape([-1]))
+    mesh_cache.touch(body, 'uvs')
 
     bpy.ops.object.mode_set(mode='OBJECT')
     arm.data.pose_position='POSE'
@@ -2669,12 +2817,6 @@ def repaint_upper_neck(arm, body):
 def repaint_head(arm, body):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = arm
-    
-    bm = bmesh.new()
-    bm.from_mesh(body.data)
-    bm.verts.ensure_lookup_table()
-    bm.edges.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
 
     # Blur the transition from upper neck to head, making cf_J_FaceRoot_s somewhat more usable
     repaint_upper_neck(arm, body)
@@ -2686,14 +2828,12 @@ def repaint_head(arm, body):
     # Completely dissolve a pesky and inconvenient VG
     #dissolve_facelow_s(arm, body, bm)
 
-    create_nasolabial(arm, body, bm)
-    create_nose_cheek(arm, body, bm)
-    restrict_nosebase(arm, body, bm)
-    jaw_edge(arm, body, bm)
+    create_nasolabial(arm, body)
+    create_nose_cheek(arm, body)
+    restrict_nosebase(arm, body)
+    jaw_edge(arm, body)
 
-    #reassign_cheekup2(arm, body, bm)
-    create_chin_cheek(arm, body, bm)
+    #reassign_cheekup2(arm, body)
+    create_chin_cheek(arm, body)
 
-    add_nostrils(arm, body, bm)
-
-    bm.free()
+    add_nostrils(arm, body)
@@ -2,6 +2,8 @@ import bpy
 import math
 from mathutils import Euler, Vector, Matrix, Color
 
+from . import shape_key_store
+
 # Will return an object so long as the active object is an armature.
 # It's up to the caller to validate accesses (it may not be a HS2 armature,
 # and could have none of the expected attributes)
@@ -34,7 +36,6 @@ defaults={
     "Name": "Kitten",
     "Fat": 0.0,
 }
-print(defaults) 
 
 def get_default_attr(name):
     return defaults[name]
@@ -316,6 +317,9 @@ def push_mat_attributes(v):
 
     for x in ['Eye shape', 'Adams apple delete', 'Upper lip trough', 'Lip arch', 'Eyelid crease', 'Temple depress',
         'Jaw soften', 'Jaw soften more', 'Nasolabial crease', 'Nails', 'Long fingernails', 'Long toenails']:
+        # keys baked by shape_key_store come back when a preset turns them on
+        if x in v and float(v[x])!=0.0 and x in shape_key_store.baked_keys(body):
+            shape_key_store.restore(body, [x])
         if x in body.data.shape_keys.key_blocks and x in v:
             body.data.shape_keys.key_blocks[x].value = float(v[x])
 
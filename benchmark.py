@@ -0,0 +1,252 @@
+import bpy
+import os
+import sys
+import time
+import tempfile
+import importlib
+import numpy as np
+from mathutils import Euler, Vector
+
+from . import importer, catmull_clark, character_library
+
+#
+# Subdivision benchmark: imports one dump with no subdivision, with the baked subdivide() and with the
+# masked geometry nodes modifier, and compares import time, mesh size, memory, viewport fps and .blend size.
+#
+# Run from Blender's Python console (this resets the open file between runs):
+#
+#   import importlib
+#   importlib.import_module("<add-on module>.benchmark").compare_subdivision("C:/path/to/dump")
+#
+# subdivision_operator() times the part of the baked subdivide() that runs outside of Blender's modifiers
+# (catmull_clark: building the operator, then subdividing every shape key with it) on a synthetic quad grid,
+# so it runs with plain NumPy too. Measured with NumPy 2.4 on Python 3.11, one core:
+#
+#   grid  verts -> subdivided  operator entries  build, s  per shape key, ms
+#    100  10201 ->      40401            445821     0.028               9.3
+#    180  32761 ->     130321           1450461     0.074              36.4
+#    250  63001 ->     251001           2802021     0.112              88.2
+#
+# compare_subdivision() (import time, memory, fps and .blend size of the three modes) needs Blender and an
+# HS2 dump and has no recorded numbers yet.
+#
+# addon_registration() times unregister() + register() of the add-on, then the deferred preset loading and
+# texture indexing that register() no longer does.
+#
+# scene_composition() saves and reopens a scene with 'characters' copies of one character, first with all of
+# them local (appended) and then linked through library overrides (character_library), and compares save time,
+# load time and file size.
+# It needs Blender and an HS2 dump and has no recorded numbers yet. No part of it runs without Blender
+# (appending, linking, overrides and .blend I/O are all bpy), so nothing can stand in for it.
+#
+# preset_panel() times what the HS2Rig panel does on every redraw (preset dropdown items and the
+# preset lookup for the active character) with a large synthetic preset list.
+#
+
+modes = [
+    ("None", False, 'BAKED'),
+    ("Baked", True, 'BAKED'),
+    ("Masked", True, 'MASKED'),
+]
+
+# Peak resident set size of the process, in MB (not available on Windows)
+def peak_memory():
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss/1048576.0 if sys.platform=='darwin' else rss/1024.0
+    except:
+        return float('nan')
+
+def mesh_stats(body):
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = body.evaluated_get(depsgraph).data
+    keys = len(body.data.shape_keys.key_blocks) if body.data.shape_keys is not None else 0
+    # shape keys are stored as full float32 copies of the coordinates
+    return len(body.data.vertices), len(evaluated.vertices), keys, keys*len(body.data.vertices)*12/1048576.0
+
+# Average time to re-evaluate the scene after a pose change
+def viewport_fps(arm, frames):
+    bone = arm.pose.bones['cf_J_Spine01'] if 'cf_J_Spine01' in arm.pose.bones else arm.pose.bones[0]
+    rotation_mode = bone.rotation_mode
+    bone.rotation_mode = 'XYZ'
+    rotation = bone.rotation_euler.copy()
+    bpy.context.view_layer.update()
+    t1 = time.time()
+    for i in range(frames):
+        bone.rotation_euler = Euler((0.01*(i%10), 0, 0))
+        bpy.context.view_layer.update()
+    t2 = time.time()
+    bone.rotation_euler = rotation
+    bone.rotation_mode = rotation_mode
+    return frames/max(t2-t1, 0.000001)
+
+def blend_size():
+    fn = os.path.join(tempfile.gettempdir(), "hs2_subdivision_benchmark.blend")
+    bpy.ops.wm.save_as_mainfile(filepath=fn, copy=True, compress=False)
+    size = os.path.getsize(fn)
+    os.remove(fn)
+    return size/1048576.0
+
+def compare_subdivision(path, frames=50):
+    results = []
+    for label, subdivide, subdivide_mode in modes:
+        bpy.ops.wm.read_homefile(use_empty=True)
+        print("Benchmark: importing with subdivision", label)
+        t1 = time.time()
+        arm = importer.import_body(path,
+            refactor=True,
+            do_extend_safe=True,
+            do_extend_full=False,
+            replace_teeth=True,
+            add_injector="Auto",
+            add_exhaust=True,
+            subdivide=subdivide,
+            subdivide_mode=subdivide_mode,
+            c_eye=(0.0, 0.0, 0.8),
+            c_hair=(0.8, 0.8, 0.5),
+            name="Benchmark",
+            customization=None
+            )
+        t2 = time.time()
+        if arm is None:
+            print("Benchmark: import failed:", importer.last_import_status)
+            return results
+        body = arm["body"]
+        base, evaluated, keys, key_mb = mesh_stats(body)
+        results.append((label, t2-t1, base, evaluated, keys, key_mb, peak_memory(), viewport_fps(arm, frames), blend_size()))
+
+    print("%-8s %10s %9s %11s %5s %13s %13s %8s %10s" % ("Mode", "Import, s", "Verts", "Evaluated", "Keys", "Key data, MB", "Peak RSS, MB", "Fps", "Blend, MB"))
+    for x in results:
+        print("%-8s %10.3f %9d %11d %5d %13.1f %13.1f %8.1f %10.1f" % x)
+    return results
+
+# Quad grid of grid x grid faces as (nv, nf, edges, loop_verts, loop_edges, loop_faces), see catmull_clark
+def quad_grid(grid):
+    n = grid+1
+    idx = np.arange(n*n).reshape([n,n])
+    h_edges = np.stack([idx[:,:-1].reshape([-1]), idx[:,1:].reshape([-1])], axis=1)
+    v_edges = np.stack([idx[:-1,:].reshape([-1]), idx[1:,:].reshape([-1])], axis=1)
+    edges = np.concatenate([h_edges, v_edges])
+    h_id = np.arange(n*grid).reshape([n,grid])
+    v_id = n*grid + np.arange(grid*n).reshape([grid,n])
+    r, c = np.meshgrid(np.arange(grid), np.arange(grid), indexing='ij')
+    loop_verts = np.stack([idx[r,c], idx[r,c+1], idx[r+1,c+1], idx[r+1,c]], axis=2).reshape([-1])
+    loop_edges = np.stack([h_id[r,c], v_id[r,c+1], h_id[r+1,c], v_id[r,c]], axis=2).reshape([-1])
+    loop_faces = np.repeat(np.arange(grid*grid), 4)
+    return n*n, grid*grid, edges, loop_verts, loop_edges, loop_faces
+
+# Build time of the subdivision operator and time to subdivide 'keys' shape keys with it, in s,
+# on a grid x grid quad mesh (180 x 180 is about the size of the body)
+def subdivision_operator(grid=180, keys=100):
+    nv, nf, edges, loop_verts, loop_edges, loop_faces = quad_grid(grid)
+    t1 = time.time()
+    op = catmull_clark.build_operator(nv, nf, edges, loop_verts, loop_edges, loop_faces)
+    t2 = time.time()
+    rng = np.random.default_rng(0)
+    co = rng.random([nv, 3]).astype(np.float32)
+    for i in range(keys):
+        op.apply(co)
+    t3 = time.time()
+    print("%d verts, %d faces -> %d verts, %d operator entries" % (nv, nf, op.shape[0], len(op.vals)))
+    print("Operator built in %.3f s, %d shape keys subdivided in %.3f s (%.2f ms per key)" % (t2-t1, keys, t3-t2, 1000.0*(t3-t2)/keys))
+    return t2-t1, t3-t2
+
+# Average time per redraw, in ms, of get_preset_list + find_preset with 'presets' presets,
+# with the cached catalogue and with the catalogue rebuilt every time (as before it was cached)
+def preset_panel(presets=5000, redraws=200):
+    addon = importlib.import_module(__package__)
+    saved_map = addon.preset_map
+    saved_favorites = addon.preset_favorites
+    try:
+        addon.preset_map = {}
+        addon.preset_favorites = set()
+        for i in range(presets):
+            p = addon.Preset("Preset %d" % i, "dump_%d" % i, [0.0, 0.0, 0.8], [0.8, 0.8, 0.5])
+            addon.preset_map[i] = p
+            if i%10==0:
+                addon.preset_favorites.add(p["uuid"])
+        addon.presets_changed()
+        h = {"preset_uuid": addon.preset_map[presets-1]["uuid"]}
+        results = []
+        for label, rebuild in [("Cached", False), ("Rebuilt", True)]:
+            t1 = time.time()
+            for i in range(redraws):
+                if rebuild:
+                    addon.presets_changed()
+                addon.get_preset_list(None, bpy.context)
+                addon.find_preset(h)
+            t2 = time.time()
+            results.append((label, 1000.0*(t2-t1)/redraws))
+        print("%d presets" % presets)
+        for x in results:
+            print("%-8s %10.3f ms per redraw" % x)
+        return results
+    finally:
+        addon.preset_map = saved_map
+        addon.preset_favorites = saved_favorites
+        addon.presets_changed()
+
+# Average register() time, in ms, over 'repeats' re-registrations, and the deferred phases
+def addon_registration(repeats=5):
+    addon = importlib.import_module(__package__)
+    total = 0.0
+    for i in range(repeats):
+        addon.unregister()
+        t1 = time.time()
+        addon.register()
+        t2 = time.time()
+        total += t2-t1
+    addon.presets_loaded = False
+    addon.textures_indexed = False
+    addon.ensure_texture_index()
+    addon.startup_report()
+    print("register(): %.3f ms" % (1000.0*total/repeats))
+    return 1000.0*total/repeats, list(addon.startup_phases)
+
+# Save and load time, in s, and .blend size, in MB, of a scene with 'characters' copies of the character in 'path',
+# local vs linked. The character library is written to a temporary directory, not to the dump's import cache.
+def scene_composition(path, characters=20):
+    bpy.ops.wm.read_homefile(use_empty=True)
+    arm = importer.import_body(path,
+        refactor=True,
+        do_extend_safe=True,
+        do_extend_full=False,
+        replace_teeth=True,
+        add_injector="Auto",
+        add_exhaust=True,
+        subdivide=True,
+        subdivide_mode='BAKED',
+        c_eye=(0.0, 0.0, 0.8),
+        c_hair=(0.8, 0.8, 0.5),
+        name="Benchmark",
+        customization=None
+        )
+    if arm is None:
+        print("Benchmark: import failed:", importer.last_import_status)
+        return []
+    library_dir = tempfile.mkdtemp(prefix="hs2_scene_benchmark_")
+    arm["dump_dir"] = library_dir
+    character_library.write(arm, {})
+
+    results = []
+    for label, add in [("Local", character_library.append), ("Linked", character_library.link)]:
+        bpy.ops.wm.read_homefile(use_empty=True)
+        for i in range(characters):
+            a = add(library_dir, {})
+            a.location = Vector([i, 0, 0])
+        fn = os.path.join(tempfile.gettempdir(), "hs2_scene_benchmark_%s.blend" % label.lower())
+        t1 = time.time()
+        bpy.ops.wm.save_as_mainfile(filepath=fn, compress=False)
+        t2 = time.time()
+        bpy.ops.wm.open_mainfile(filepath=fn)
+        t3 = time.time()
+        results.append((label, t2-t1, t3-t2, os.path.getsize(fn)/1048576.0))
+        bpy.ops.wm.read_homefile(use_empty=True)
+        os.remove(fn)
+
+    print("%d characters" % characters)
+    print("%-8s %10s %10s %10s" % ("Scene", "Save, s", "Load, s", "Blend, MB"))
+    for x in results:
+        print("%-8s %10.3f %10.3f %10.1f" % x)
+    return results
@@ -0,0 +1,85 @@
+import numpy as np
+
+#
+# One level of Catmull-Clark subdivision as a sparse linear operator.
+#
+# With the topology fixed, subdivided positions are a linear function of the control positions, so the
+# (new verts x old verts) matrix only has to be built once. Every shape key is then subdivided with
+# a single sparse mat-vec.
+#
+# Matches the Subdivision Surface modifier with levels=1, use_limit_surface=False, no creases and
+# boundary_smooth='ALL'. Vertex order is the modifier's: original vertices, then one vertex per edge
+# (in edge order), then one per face (in face order). Callers should still compare the result
+# against one modifier evaluation, since non-manifold geometry is not handled.
+#
+
+class SubdivisionOperator:
+    def __init__(self, rows, cols, vals, shape):
+        self.rows = rows
+        self.cols = cols
+        self.vals = vals
+        self.shape = shape
+
+    # (N,3) control positions -> (M,3) subdivided positions
+    def apply(self, co):
+        out = np.zeros([self.shape[0], co.shape[1]], dtype=np.float32)
+        for d in range(co.shape[1]):
+            out[:,d] = np.bincount(self.rows, weights=self.vals*co[self.cols,d], minlength=self.shape[0])
+        return out
+
+# Replaces each (row, face, w) entry with (row, v, w/n) for every one of the n vertices of the face,
+# i.e. w times the face point.
+def expand_faces(rows, faces, weights, face_starts, face_sizes, loop_verts):
+    counts = face_sizes[faces]
+    firsts = np.zeros([len(faces)], dtype=np.int64)
+    np.cumsum(counts[:-1], out=firsts[1:])
+    loops = np.repeat(face_starts[faces], counts) + np.arange(counts.sum()) - np.repeat(firsts, counts)
+    return np.repeat(rows, counts), loop_verts[loops], np.repeat(weights/counts, counts)
+
+def build_operator(nv, nf, edges, loop_verts, loop_edges, loop_faces):
+    ne = len(edges)
+    face_sizes = np.bincount(loop_faces, minlength=nf)
+    face_starts = np.zeros([nf], dtype=np.int64)
+    np.cumsum(face_sizes[:-1], out=face_starts[1:])
+    boundary_edge = np.bincount(loop_edges, minlength=ne)==1
+    boundary_vert = np.zeros([nv], dtype=bool)
+    boundary_vert[edges[boundary_edge].reshape([-1])] = True
+    inner_vert = ~boundary_vert
+    valence = np.bincount(edges.reshape([-1]), minlength=nv).astype(np.float64)
+
+    entries = []
+    def add(rows, cols, vals):
+        entries.append((np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64), np.asarray(vals, dtype=np.float64)))
+
+    # Face points: average of the face's vertices
+    faces = np.arange(nf)
+    add(*expand_faces(nv+ne+faces, faces, np.ones([nf]), face_starts, face_sizes, loop_verts))
+
+    # Edge points: (v0 + v1 + F0 + F1) / 4 inside, midpoint on the boundary
+    edge_rows = nv+np.arange(ne)
+    w = np.where(boundary_edge, 0.5, 0.25)
+    add(edge_rows, edges[:,0], w)
+    add(edge_rows, edges[:,1], w)
+    m = ~boundary_edge[loop_edges]
+    add(*expand_faces(nv+loop_edges[m], loop_faces[m], np.full([m.sum()], 0.25), face_starts, face_sizes, loop_verts))
+
+    # Vertex points: ((n-2) v + sum(neighbours)/n + sum(face points)/n) / n inside,
+    # (6 v + both boundary neighbours) / 8 on the boundary
+    verts = np.nonzero(inner_vert)[0]
+    add(verts, verts, (valence[verts]-2)/valence[verts])
+    verts = np.nonzero(boundary_vert)[0]
+    add(verts, verts, np.full([len(verts)], 0.75))
+    for a, b in [(0, 1), (1, 0)]:
+        src = edges[:,a]
+        dst = edges[:,b]
+        m = inner_vert[src]
+        add(src[m], dst[m], 1.0/valence[src[m]]**2)
+        m = boundary_edge
+        add(src[m], dst[m], np.full([m.sum()], 0.125))
+    m = inner_vert[loop_verts]
+    add(*expand_faces(loop_verts[m], loop_faces[m], 1.0/valence[loop_verts[m]]**2, face_starts, face_sizes, loop_verts))
+
+    rows = np.concatenate([x[0] for x in entries])
+    cols = np.concatenate([x[1] for x in entries])
+    vals = np.concatenate([x[2] for x in entries])
+    return SubdivisionOperator(rows, cols, vals, (nv+ne+nf, nv))
@@ -0,0 +1,200 @@
+import bpy
+import os
+import json
+import time
+import hashlib
+
+#
+# Import cache: a finished character saved as a library .blend in its dump directory, one per set of import options.
+#
+#   <dump dir>/hs2_character_<key>.blend    collection "HS2 character" with the armature and everything parented to it
+#   <dump dir>/hs2_character_<key>.json     import options it was built with, and the dump it was built from
+#
+# <key> is a hash of the import options (refactor, extras, subdivision, colors, customization), so presets of the
+# same dump with different colors or customization get their own files, and rebuilding one never replaces
+# the library another scene links. The collection name is the same in every file, so a rebuilt library still
+# resolves in the scenes that link it.
+#
+# write() saves a character right after import (or in a headless worker, see library_builder); append() brings
+# it back into the scene in a second or two instead of a full import, link() references it through a library
+# override. is_current() only accepts a library built from the same FBX/dump/textures.
+#
+# A linked character only exposes what is edited per scene (expose()): the armature and mesh objects (pose
+# bones, transforms, the hs2rig custom properties, which write() marks overridable), the meshes (shape key
+# values, material slots) and the materials (material attributes). Images stay in the library, and Blender
+# does not write the geometry and shape key data of overridden meshes to the scene file, only the edits. move_to_library() turns a local character into a linked one.
+#
+
+collection_name = "HS2 character"
+
+def library_key(options):
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:12]
+
+def library_path(dump_dir, options):
+    return os.path.join(dump_dir, "hs2_character_%s.blend" % library_key(options))
+
+def stamp_path(dump_dir, options):
+    return os.path.join(dump_dir, "hs2_character_%s.json" % library_key(options))
+
+def log_path(dump_dir, options):
+    return os.path.join(dump_dir, "hs2_character_%s.log" % library_key(options))
+
+# Newest modification time of the files import_body() reads
+def source_mtime(dump_dir):
+    t = 0.0
+    for x in os.listdir(dump_dir):
+        if x.endswith('.fbx') or (x.endswith('.txt') and not x.startswith('pose_')) or x=="Textures" or x.startswith("customization"):
+            t = max(t, os.path.getmtime(os.path.join(dump_dir, x)))
+    return t
+
+def character_objects(arm):
+    return [arm] + list(arm.children_recursive)
+
+def read_stamp(dump_dir, options):
+    try:
+        with open(stamp_path(dump_dir, options), "r") as fp:
+            return json.load(fp)
+    except:
+        return None
+
+def is_current(dump_dir, options):
+    stamp = read_stamp(dump_dir, options)
+    if stamp is None or not os.path.exists(library_path(dump_dir, options)):
+        return False
+    try:
+        return stamp["source_mtime"]>=source_mtime(dump_dir) and stamp["options"]==json.loads(json.dumps(options))
+    except:
+        return False
+
+def mark_overridable(obj):
+    for k in obj.keys():
+        try:
+            obj.property_overridable_library_set('["%s"]' % k, True)
+        except:
+            pass
+
+def write(arm, options):
+    t1 = time.time()
+    dump_dir = arm["dump_dir"]
+    path = library_path(dump_dir, options)
+    # a local "HS2 character" (an appended character) would push the new one to "HS2 character.001"
+    clashing = [c for c in bpy.data.collections if c.name==collection_name and c.library is None]
+    for c in clashing:
+        c.name = collection_name + " (appended)"
+    coll = bpy.data.collections.new(collection_name)
+    for x in character_objects(arm):
+        mark_overridable(x)
+        coll.objects.link(x)
+    try:
+        bpy.data.libraries.write(path, {coll}, path_remap='ABSOLUTE', fake_user=True, compress=True)
+    finally:
+        bpy.data.collections.remove(coll)
+        for c in clashing:
+            c.name = collection_name
+    # characters of this session linked from the old file
+    lib = loaded_library(path)
+    if lib is not None:
+        lib.reload()
+    with open(stamp_path(dump_dir, options), "w") as fp:
+        json.dump({"collection": collection_name, "name": arm.name, "source_mtime": source_mtime(dump_dir),
+            "options": options, "written": time.time()}, fp, indent=4)
+    t2 = time.time()
+    print("Saved", arm.name, "to", path, "in %.3f s" % (t2-t1))
+
+def loaded_library(path):
+    for lib in bpy.data.libraries:
+        if os.path.normcase(os.path.abspath(bpy.path.abspath(lib.filepath)))==os.path.normcase(os.path.abspath(path)):
+            return lib
+    return None
+
+# Root armature of a character collection
+def collection_armature(coll):
+    for x in coll.all_objects:
+        if x.type=='ARMATURE' and x.parent is None:
+            return x
+    return None
+
+# Appends the cached character into the scene; returns its armature
+def append(dump_dir, options, scene=None):
+    t1 = time.time()
+    scene = scene or bpy.context.scene
+    stamp = read_stamp(dump_dir, options)
+    path = library_path(dump_dir, options)
+    with bpy.data.libraries.load(path, link=False) as (data_from, data_to):
+        data_to.collections = [x for x in data_from.collections if x==collection_name]
+    if len(data_to.collections)==0:
+        return None
+    coll = data_to.collections[0]
+    scene.collection.children.link(coll)
+    arm = collection_armature(coll)
+    if arm is not None:
+        coll.name = "HS2 " + arm.name
+    t2 = time.time()
+    print("Appended", (stamp or {}).get("name"), "from", path, "in %.3f s" % (t2-t1))
+    return arm
+
+# Links the cached character and makes a library override of it in the scene; returns the overridden armature.
+# The meshes, shape keys, images and materials stay in the library file.
+def link(dump_dir, options, scene=None, view_layer=None):
+    t1 = time.time()
+    scene = scene or bpy.context.scene
+    view_layer = view_layer or bpy.context.view_layer or scene.view_layers[0]
+    stamp = read_stamp(dump_dir, options)
+    path = library_path(dump_dir, options)
+    with bpy.data.libraries.load(path, link=True) as (data_from, data_to):
+        data_to.collections = [x for x in data_from.collections if x==collection_name]
+    if len(data_to.collections)==0:
+        return None
+    override = data_to.collections[0].override_hierarchy_create(scene, view_layer, do_fully_editable=False)
+    if not override in scene.collection.children_recursive:
+        scene.collection.children.link(override)
+    expose(override)
+    arm = collection_armature(override)
+    t2 = time.time()
+    print("Linked", (stamp or {}).get("name"), "from", path, "in %.3f s" % (t2-t1))
+    return arm
+
+# Makes the per-scene parts of an overridden character editable, see the top of the file
+def expose(coll):
+    materials = set()
+    for obj in coll.all_objects:
+        if obj.override_library is None:
+            continue
+        obj.override_library.is_system_override = False
+        if obj.type!='MESH':
+            continue
+        if obj.data.library is not None:
+            obj.data = obj.data.override_create(remap_local_usages=True)
+        materials.update([m for m in obj.data.materials if m is not None and m.library is not None])
+    for m in materials:
+        m.override_create(remap_local_usages=True)
+
+# Deletes a local character and the data only it used
+def remove_character(arm):
+    objs = character_objects(arm)
+    data = set([x.data for x in objs if x.data is not None])
+    materials = set([m for x in objs if x.type=='MESH' for m in x.data.materials if m is not None])
+    images = set([n.image for m in materials if m.node_tree is not None for n in m.node_tree.nodes if n.type=='TEX_IMAGE' and n.image is not None])
+    colls = [c for c in bpy.data.collections if len(c.objects)>0 and all([x in objs for x in c.objects])]
+    bpy.data.batch_remove(objs)
+    for group in [data, materials, images]:
+        bpy.data.batch_remove([x for x in group if x.users==0])
+    bpy.data.batch_remove([c for c in colls if len(c.objects)==0 and len(c.children)==0])
+
+# Saves a local character to its library and replaces it with a linked override; returns the new armature,
+# or None (and the local character stays) if the library could not be linked
+def move_to_library(arm, options):
+    dump_dir = arm["dump_dir"]
+    location = arm.location.copy()
+    write(arm, options)
+    try:
+        linked = link(dump_dir, options)
+    except Exception as e:
+        print("Failed to link", library_path(dump_dir, options), ":", e)
+        linked = None
+    if linked is None:
+        print("Keeping the local", arm.name)
+        return None
+    linked.location = location
+    remove_character(arm)
+    return linked
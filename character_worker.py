@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import time
+import importlib.util
+import bpy
+
+#
+# Headless character build, run by library_builder in a separate Blender process:
+#
+#   blender --background --factory-startup --python character_worker.py -- job.json
+#
+# job.json: {"kwargs": import_body() arguments, "preset": preset dict or null, "options": import cache options,
+#            "cache_formulas": extras_cache.use_cache}
+#
+# Loads the add-on from the directory this script is in (it need not be installed or enabled), imports the
+# character into the empty factory scene, applies the preset's material attributes and saves the character
+# to the import cache (character_library.write()). Exits with 0 on success.
+#
+
+def load_addon():
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    name = os.path.basename(package_dir)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(package_dir, "__init__.py"),
+        submodule_search_locations=[package_dir])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    module.register()
+    return module
+
+def main(job_path):
+    t1 = time.time()
+    with open(job_path, "r") as fp:
+        job = json.load(fp)
+    addon = load_addon()
+    addon.extras_cache.use_cache = job.get("cache_formulas", False)
+    arm = addon.importer.import_body(**job["kwargs"])
+    if arm is None:
+        print("Import failed:", addon.importer.last_import_status)
+        return 1
+    preset = job.get("preset")
+    if preset is not None:
+        arm["preset_uuid"] = preset["uuid"]
+        bpy.context.view_layer.objects.active = arm
+        addon.attributes.push_mat_attributes(preset)
+    addon.character_library.write(arm, job["options"])
+    t2 = time.time()
+    print("Character built in %.3f s" % (t2-t1))
+    return 0
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else []
+    try:
+        code = main(argv[0])
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    os._exit(code)
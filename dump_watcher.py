@@ -0,0 +1,81 @@
+import os
+import time
+
+#
+# Export directory watcher, by polling (no platform-specific file notification APIs).
+#
+# start(root, known) takes note of the folders already in the export directory; poll(root), called from a
+# bpy.app.timers callback, returns the new folders that are ready to import: a Unity dump (.txt other than
+# pose_*.txt), an FBX and a Textures/ folder with at least one image are all there, and the names, sizes and
+# modification times of all of them have not changed for settle_time seconds. A folder that is still being
+# written keeps changing its snapshot and stays pending.
+#
+
+poll_interval = 5.0
+settle_time = 10.0
+
+root_dir = None
+# folders that existed at start(), or have been returned by poll() already
+known = set()
+# folder -> (snapshot, time it was first seen)
+pending = {}
+
+def subdirs(root):
+    try:
+        return [os.path.join(root, x) for x in os.listdir(root) if os.path.isdir(os.path.join(root, x))]
+    except OSError:
+        return []
+
+def file_state(path):
+    st = os.stat(path)
+    return (os.path.basename(path), st.st_size, st.st_mtime)
+
+# Names, sizes and mtimes of the files an import reads, or None while the folder is incomplete
+def snapshot(path):
+    try:
+        files = os.listdir(path)
+        dumps = [x for x in files if x.endswith('.txt') and not x.startswith('pose_')]
+        fbxs = [x for x in files if x.endswith('.fbx')]
+        tex_dir = os.path.join(path, "Textures")
+        if len(dumps)==0 or len(fbxs)==0 or not os.path.isdir(tex_dir):
+            return None
+        textures = [x for x in os.listdir(tex_dir) if x.endswith('.png')]
+        if len(textures)==0:
+            return None
+        return tuple(sorted([file_state(os.path.join(path, x)) for x in dumps+fbxs] +
+            [file_state(os.path.join(tex_dir, x)) for x in textures]))
+    except OSError:
+        # a file vanished while we were looking, i.e. still being written
+        return None
+
+def start(root, already_known=()):
+    global root_dir
+    root_dir = root
+    known.clear()
+    pending.clear()
+    known.update(os.path.normpath(x) for x in subdirs(root))
+    known.update(os.path.normpath(x) for x in already_known if len(x)>0)
+    print("Watching", root, "for new dumps,", len(known), "folders already there")
+
+def poll(root):
+    if root!=root_dir:
+        start(root)
+    ready = []
+    now = time.time()
+    for d in subdirs(root):
+        d = os.path.normpath(d)
+        if d in known:
+            continue
+        snap = snapshot(d)
+        if snap is None:
+            pending.pop(d, None)
+            continue
+        if not d in pending or pending[d][0]!=snap:
+            pending[d] = (snap, now)
+            continue
+        newest = max([x[2] for x in snap])
+        if now-pending[d][1]>=settle_time and now-newest>=settle_time:
+            ready.append(d)
+            known.add(d)
+            pending.pop(d)
+    return ready
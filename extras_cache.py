@@ -0,0 +1,242 @@
+import os
+import sys
+import dis
+import hashlib
+import numpy as np
+
+from . import mesh_cache
+
+#
+# Cached formula results, shared by characters with the same mesh topology ("Cache formula results").
+#
+# Most characters share the stock head and body topology, and the functional helpers in add_extras
+# (create_functional_vgroup, split_vgroup, create_functional_shape_key) evaluate the same formulas over
+# the same UVs every time. Between begin() and end(), each helper call looks up its result by
+#   - the mesh fingerprint (face index array and UVs, see MeshSnapshot.fingerprint)
+#   - the call's identity (helper, name, vertex groups, uv_rect, call order) and the code of the formula and
+#     the values it captured (positions measured on the mesh, parameters), so editing a formula misses
+#   - the per-character inputs the formula actually reads (formula_reads()), over the call's vertices only:
+#     undeformed positions if it reads 'co', normals if it reads 'norm', and everything (positions,
+#     normals and weights of the whole mesh, MeshSnapshot.digest) if it reaches into the mesh through 'body'.
+#     A formula of the UVs alone is shared by every character with the same topology.
+# Shape key offsets are stored in each vertex's local frame (tangent, bitangent, normal of the rest shape)
+# and rotated into the current character's frame on load, so they follow its rest shape; shape key
+# formulas reading 'norm' don't need the normals in their key.
+# On a miss, the live result is stored and written to <user cache dir>/hs2rig/extras_cache/<fingerprint>.npz
+# by end(). An entry is only used if the vertex set it was computed for is identical, so a different set of
+# earlier mods (e.g. Extend (full) off) falls back to the live path.
+#
+#   with mesh_cache.MeshSnapshot(body), extras_cache.Session():
+#       add_extras.add_shape_keys(arm, body, False)
+#       ...
+#
+# Bump cache_version when something the formulas read outside of their arguments and captured values changes.
+#
+
+cache_version = 3
+use_cache = False
+
+def user_cache_dir():
+    if sys.platform=="win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/AppData/Local")
+    elif sys.platform=="darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "hs2rig", "extras_cache")
+
+cache_dir = user_cache_dir()
+
+active = False
+loaded = {}
+dirty = set()
+call_counts = {}
+hits = 0
+misses = 0
+
+def begin():
+    global active, hits, misses
+    active = use_cache
+    call_counts.clear()
+    hits = 0
+    misses = 0
+
+# Writes the new entries. Other processes (build workers) may have added entries to the same file
+# since it was loaded: those are merged in, and the file is replaced in one step.
+def end():
+    global active
+    if not active:
+        return
+    active = False
+    print("Extras cache: %d hits, %d misses" % (hits, misses))
+    for fp in dirty:
+        path = cache_path(fp)
+        tmp = "%s.%d.tmp.npz" % (path[:-4], os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            merged = read_entries(path)
+            merged.update(loaded[fp])
+            np.savez_compressed(tmp, **merged)
+            os.replace(tmp, path)
+        except Exception as e:
+            print("Failed to write the extras cache:", e)
+    dirty.clear()
+
+class Session:
+    def __enter__(self):
+        begin()
+        return self
+
+    def __exit__(self, *args):
+        end()
+        return False
+
+def cache_path(fp):
+    return os.path.join(cache_dir, "%s_v%d.npz" % (fp, cache_version))
+
+def read_entries(path):
+    try:
+        with np.load(path) as f:
+            return {x: f[x] for x in f.files}
+    except:
+        return {}
+
+def entries(fp):
+    if not fp in loaded:
+        loaded[fp] = read_entries(cache_path(fp))
+    return loaded[fp]
+
+# Digest of a formula: its code, including nested functions and lambdas (their reprs carry addresses),
+# and the values it captured from the enclosing function (parameters, positions measured on the mesh)
+def code_digest(code, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        if hasattr(c, "co_code"):
+            code_digest(c, h)
+        else:
+            h.update(repr(c).encode())
+
+def func_digest(func):
+    h = hashlib.sha1()
+    code_digest(func.__code__, h)
+    for cell in (func.__closure__ or ()):
+        try:
+            x = cell.cell_contents
+        except ValueError:
+            continue
+        if isinstance(x, np.ndarray):
+            h.update(x.tobytes())
+        elif callable(x) and hasattr(x, "__code__"):
+            h.update(func_digest(x).digest())
+        else:
+            h.update(repr(x).encode())
+    return h
+
+# Names loaded by a code object and the ones nested in it, and its string constants (kwargs['co'])
+def code_loads(code, out):
+    for ins in dis.get_instructions(code):
+        if ins.opname.startswith("LOAD"):
+            if isinstance(ins.argval, str):
+                out.add(ins.argval)
+            elif isinstance(ins.argval, tuple):
+                out.update([x for x in ins.argval if isinstance(x, str)])
+    for c in code.co_consts:
+        if hasattr(c, "co_code"):
+            code_loads(c, out)
+    return out
+
+formula_reads_cache = {}
+
+# Per-character inputs a formula reads: any of 'co', 'norm', 'body' (see evaluate_formula() in add_extras).
+# Functions it captured count as part of it.
+def formula_reads(func, seen=None):
+    seen = set() if seen is None else seen
+    seen.add(func)
+    code = func.__code__
+    if not code in formula_reads_cache:
+        formula_reads_cache[code] = code_loads(code, set()) & {'co', 'norm', 'body'}
+    out = set(formula_reads_cache[code])
+    for cell in (func.__closure__ or ()):
+        try:
+            x = cell.cell_contents
+        except ValueError:
+            continue
+        if callable(x) and hasattr(x, "__code__") and not x in seen:
+            out |= formula_reads(x, seen)
+    return out
+
+def subset_digest(values, verts, h):
+    h.update((np.round(values[verts], 4)+0.0).astype(np.float32).tobytes())
+
+# Identifies one helper call on the current mesh. Repeated calls with the same arguments are told apart by their order.
+def entry_key(body, kind, name, vg, func, verts, uv_rect=None, mirror=False):
+    if not active:
+        return None
+    snap = mesh_cache.snapshot(body)
+    fp = snap.fingerprint()
+    call = (kind, name, repr(vg), repr(uv_rect), mirror)
+    n = call_counts.get((fp, call), 0)
+    call_counts[(fp, call)] = n+1
+    h = func_digest(func)
+    h.update(repr(call+(n,)).encode())
+    reads = formula_reads(func)
+    verts = np.asarray(verts, dtype=np.int64)
+    if 'body' in reads:
+        h.update(snap.digest().encode())
+    else:
+        if 'co' in reads:
+            subset_digest(snap.undeformed_co(), verts, h)
+        # shape key offsets follow the normals through the local frames
+        if 'norm' in reads and kind!='shape_key':
+            subset_digest(snap.normals(), verts, h)
+    return fp, h.hexdigest()[:16]
+
+# Local frames of 'verts' as (K,3,3) arrays of rows: tangent, bitangent, normal
+def local_frames(body, verts):
+    snap = mesh_cache.snapshot(body)
+    cos = snap.co()
+    offsets, neighbours = snap.adjacency()
+    verts = np.asarray(verts, dtype=np.int64)
+    n = snap.normals()[verts].astype(np.float64)
+    n /= np.maximum(np.linalg.norm(n, axis=1), 1e-12).reshape([-1,1])
+    has_neighbour = offsets[verts+1]>offsets[verts]
+    first = neighbours[np.minimum(offsets[verts], len(neighbours)-1)]
+    t = np.where(has_neighbour.reshape([-1,1]), cos[first]-cos[verts], np.array([1.0, 0.0, 0.0]))
+    t -= n*(t*n).sum(axis=1).reshape([-1,1])
+    t /= np.maximum(np.linalg.norm(t, axis=1), 1e-12).reshape([-1,1])
+    return np.stack([t, np.cross(n, t), n], axis=1)
+
+# Cached per-vertex values for the call, or None if there is no entry for this vertex set
+def lookup(key, verts):
+    global hits, misses
+    if key is None:
+        return None
+    fp, h = key
+    e = entries(fp)
+    if not (h+"_v") in e or not np.array_equal(e[h+"_v"], np.asarray(verts, dtype=np.int32)):
+        misses += 1
+        return None
+    hits += 1
+    return e[h+"_x"]
+
+def store(key, verts, values):
+    if key is None:
+        return
+    fp, h = key
+    e = entries(fp)
+    e[h+"_v"] = np.asarray(verts, dtype=np.int32)
+    e[h+"_x"] = np.asarray(values, dtype=np.float32)
+    dirty.add(fp)
+
+# Shape key offsets go through the local frames of the rest shape
+def lookup_offsets(body, key, verts):
+    local = lookup(key, verts)
+    if local is None:
+        return None
+    return np.einsum("kji,kj->ki", local_frames(body, verts), local.reshape([-1,3])).astype(np.float32)
+
+def store_offsets(body, key, verts, offsets):
+    if key is None:
+        return
+    store(key, verts, np.einsum("kij,kj->ki", local_frames(body, verts), np.asarray(offsets, dtype=np.float64).reshape([-1,3])))
@@ -0,0 +1,296 @@
+import time
+import hashlib
+import fnmatch
+import numpy as np
+
+from . import add_extras, mesh_cache
+
+#
+# Registry of the add_extras mods, with a dependency scheduler.
+#
+# Each mod declares the resources it reads and writes:
+#
+#   'vg:<name>'    vertex group weights
+#   'bone:<name>'  bones of the armature
+#   'sk:<name>'    shape keys
+#   'mesh'         topology, coordinates and face materials
+#
+# Names are fnmatch patterns ('vg:cf_J_Cheek*', 'sk:*'). Mod B depends on mod A if A comes first
+# and writes something B reads.
+#
+# run() does the full pass at import time and records the cost of every mod (body["extras_cost"]);
+# record() then stores a hash of the inputs of every enabled mod as they are at the end of the import
+# (body["extras_inputs"]).
+# rerun() runs one mod again, then every downstream mod whose inputs no longer match the record;
+# with no mod given, it runs every mod whose inputs were edited since the last pass. Only mods that
+# rebuild their outputs from scratch (rerun=True) are run again. Others, e.g. subdivide, are
+# reported as stale and need a re-import.
+#
+# A mod's func is either a callable (arm, body) or the name of an add_extras function taking (arm, body).
+# Names are looked up when the mod runs: add_extras imports importer, which imports this module, so
+# add_extras may still be half-initialized here.
+#
+
+class Mod:
+    def __init__(self, name, func, reads, writes, when=None, rerun=False):
+        self.name = name
+        self.func = func
+        self.reads = reads
+        self.writes = writes
+        self.when = when
+        self.rerun = rerun
+
+    def __call__(self, arm, body):
+        func = getattr(add_extras, self.func) if isinstance(self.func, str) else self.func
+        return func(arm, body)
+
+    def enabled(self, options, body):
+        return self.when is None or self.when(options, body)
+
+mods = []
+
+def register(name, func, reads, writes, when=None, rerun=False):
+    mods.append(Mod(name, func, reads, writes, when, rerun))
+
+def find_mod(name):
+    for m in mods:
+        if m.name==name:
+            return m
+    return None
+
+# Head vertex groups touched by the skull and head repaint mods
+head_groups = ['vg:cf_J_Cheek*', 'vg:cf_J_Chin*', 'vg:cf_J_Eye0*', 'vg:cf_J_Face*', 'vg:cf_J_Head_s',
+    'vg:cf_J_LowerJaw', 'vg:cf_J_Mouth*', 'vg:cf_J_Nasolabial_s', 'vg:cf_J_Nose*', 'vg:cf_J_Nostril_*']
+head_bones = [x.replace('vg:', 'bone:') for x in head_groups]
+
+def safe(o, body):
+    return o['extend_safe']
+
+def face_keys(o, body):
+    return o['extend_safe'] and not o['custom_head']
+
+register('helper_jc_bones', lambda arm, body: add_extras.add_helper_jc_bones(arm),
+    ['bone:cf_J_Leg*'], ['bone:cf_J_Leg*'], safe)
+register('spine_rear_soft', 'add_spine_rear_soft',
+    ['mesh', 'vg:cf_J_Spine0*', 'vg:cf_J_Kosi01*', 'vg:cf_J_Neck*', 'bone:cf_J_Spine0*', 'bone:cf_J_Kosi01_s', 'bone:cf_J_Neck_s'],
+    ['vg:cf_J_Spine0*', 'vg:cf_J_Kosi01*', 'vg:cf_J_Neck*', 'bone:cf_J_Spine0*', 'bone:cf_J_Kosi01*', 'bone:cf_J_Neck*'], safe)
+register('subdivide', 'subdivide',
+    ['mesh', 'vg:*', 'sk:*'], ['mesh', 'vg:*', 'sk:*'],
+    lambda o, body: o['subdivide'] and o['subdivide_mode']!='MASKED')
+register('masked_subdivision', 'add_masked_subdivision',
+    ['mesh'], ['vg:Subdivision Mask'],
+    lambda o, body: o['subdivide'] and o['subdivide_mode']=='MASKED')
+
+# Customization shape keys, off by default (the calls of add_extras.add_shape_keys(arm, body, False))
+register('mouth_blendshape', lambda arm, body: add_extras.add_mouth_blendshape(body),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Mouth*', 'vg:cf_J_CheekLow_*', 'vg:cf_J_CheekUp_*'], ['sk:better_smile'], face_keys, rerun=True)
+register('adams_apple_delete', 'adams_apple_delete',
+    ['mesh', 'sk:Basis', 'vg:cf_J_Neck_s'], ['sk:Adams apple delete'],
+    lambda o, body: face_keys(o, body) and body['Boy']>0, rerun=True)
+register('tweak_nose', lambda arm, body: add_extras.tweak_nose(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Nose_t*', 'vg:cf_J_NoseBase_s'], ['sk:Nostril pinch'], face_keys, rerun=True)
+register('eye_shape', lambda arm, body: add_extras.eye_shape(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Eye0*', 'vg:cf_J_eye_rs_*'], ['sk:Eye shape'], face_keys, rerun=True)
+register('eyelid_crease', lambda arm, body: add_extras.eyelid_crease(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Eye02_s_*'], ['sk:Eyelid crease'], face_keys, rerun=True)
+register('upper_lip', lambda arm, body: add_extras.upper_lip_shapekey(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Mouthup', 'vg:cf_J_MouthBase_s_s'], ['sk:Upper lip trough'], face_keys, rerun=True)
+register('lip_arch', lambda arm, body: add_extras.lip_arch_shapekey(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Mouthup', 'vg:cf_J_MouthLow', 'vg:cf_J_ChinTip_s', 'vg:cf_J_MouthBase_s_s'], ['sk:Lip arch'], face_keys, rerun=True)
+register('temple_depress', lambda arm, body: add_extras.temple_depress(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_FaceUp_tz', 'vg:cf_J_CheekUp_*'], ['sk:Temple depress'], face_keys, rerun=True)
+register('forehead_flatten', lambda arm, body: add_extras.forehead_flatten(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_FaceUp_tz', 'vg:cf_J_FaceUpFront_ty'], ['sk:Forehead flatten'], face_keys, rerun=True)
+register('jaw_soften', lambda arm, body: add_extras.jaw_soften(arm, body, on=False),
+    ['mesh', 'sk:Basis', 'vg:cf_J_Chin_rs', 'vg:cf_J_ChinLow', 'vg:cf_J_ChinFront_s'], ['sk:Jaw soften', 'sk:Jaw soften more'], face_keys, rerun=True)
+register('nasolabial_crease', 'nasolabial_crease',
+    ['mesh', 'sk:Basis', 'vg:cf_J_FaceLow_s_s', 'vg:cf_J_MouthBase_s_s', 'vg:cf_J_NoseBase_s', 'vg:cf_J_NoseWing_tx_*', 'vg:cf_J_Mouth_L', 'vg:cf_J_Mouth_R'],
+    ['sk:Nasolabial crease'], face_keys, rerun=True)
+
+# Reversible: splits a number of VGs and adds bones, virtually identical to the unmodified mesh with new bones in null pose
+register('skull_soft_neutral', 'add_skull_soft_neutral',
+    ['mesh'] + head_groups + head_bones, head_groups + head_bones, face_keys)
+# Irreversible (unique or fundamentally changed VGs)
+register('repaint_head', 'repaint_head',
+    ['mesh', 'vg:cf_J_Neck*'] + head_groups + head_bones, head_groups + head_bones,
+    lambda o, body: o['extend_full'] and not o['custom_head'] and 'cf_J_FaceUp_tz' in body.vertex_groups)
+# Scalp VG (for curves hair attachment)
+register('paint_scalp', 'paint_scalp',
+    ['mesh', 'vg:cf_J_FaceUp_*', 'vg:cf_J_FaceRoot_s', 'vg:cf_J_FaceLow_s*', 'vg:cf_J_Ear*', 'vg:cf_J_Chin_rs', 'vg:cf_J_CheekUp_*', 'vg:cf_J_Eye0*'],
+    ['vg:Scalp'], lambda o, body: not o['custom_head'], rerun=True)
+register('tweak_nails', 'tweak_nails',
+    ['mesh', 'sk:Basis'], ['mesh', 'sk:Nails', 'sk:Long fingernails', 'sk:Long toenails'], safe, rerun=True)
+
+def overlaps(a, b):
+    ka, _, na = a.partition(':')
+    kb, _, nb = b.partition(':')
+    return ka==kb and (fnmatch.fnmatchcase(na, nb) or fnmatch.fnmatchcase(nb, na))
+
+def depends(a, b):
+    return any(overlaps(w, r) for w in a.writes for r in b.reads)
+
+# Names of the mods that depend, directly or not, on 'name'
+def downstream(name):
+    out = set([name])
+    for m in mods[[x.name for x in mods].index(name)+1:]:
+        if any(depends(find_mod(x), m) for x in out):
+            out.add(m.name)
+    out.discard(name)
+    return out
+
+#
+# Input hashes
+#
+
+def round_bytes(a):
+    # (+0.0 folds -0.0 into 0.0)
+    return (np.round(np.asarray(a, dtype=np.float64), 5)+0.0).astype(np.float32).tobytes()
+
+# Hashes of resources in the current state of the character, computed once per resource
+class State:
+    def __init__(self, arm, body):
+        self.arm = arm
+        self.body = body
+        self.hashes = {}
+        self.weights = None
+
+    def group_weights(self):
+        if self.weights is None:
+            self.weights = mesh_cache.build_weights(None, self.body.data)
+        return self.weights
+
+    def hash_resource(self, resource):
+        kind, _, pattern = resource.partition(':')
+        h = hashlib.sha1()
+        if kind=='mesh':
+            mesh = self.body.data
+            h.update(str(mesh_cache.topology_key(mesh)).encode())
+            h.update(round_bytes(mesh_cache.read_vertex_vector(mesh, "co")))
+            mats = np.zeros([len(mesh.polygons)], dtype=np.int32)
+            mesh.polygons.foreach_get("material_index", mats)
+            h.update(mats.tobytes())
+        elif kind=='vg':
+            weights = self.group_weights()
+            for g in sorted(self.body.vertex_groups, key=lambda g: g.name):
+                if fnmatch.fnmatchcase(g.name, pattern):
+                    h.update(g.name.encode())
+                    items = sorted(weights.get(g.index, {}).items())
+                    h.update(np.array([x[0] for x in items], dtype=np.int32).tobytes())
+                    h.update(round_bytes([x[1] for x in items]))
+        elif kind=='bone':
+            for b in sorted(self.arm.data.bones, key=lambda b: b.name):
+                if fnmatch.fnmatchcase(b.name, pattern):
+                    h.update(b.name.encode())
+                    h.update((b.parent.name if b.parent is not None else '').encode())
+                    h.update(round_bytes([list(r) for r in b.matrix_local]))
+                    h.update(round_bytes(list(b.tail_local)))
+        elif kind=='sk' and self.body.data.shape_keys is not None:
+            n = len(self.body.data.vertices)
+            for k in self.body.data.shape_keys.key_blocks:
+                if fnmatch.fnmatchcase(k.name, pattern):
+                    co = np.zeros([n*3], dtype=np.float32)
+                    k.data.foreach_get("co", co)
+                    h.update(k.name.encode())
+                    h.update(round_bytes(co))
+        return h.hexdigest()
+
+    def resource(self, resource):
+        if not resource in self.hashes:
+            self.hashes[resource] = self.hash_resource(resource)
+        return self.hashes[resource]
+
+    def inputs(self, mod):
+        h = hashlib.sha1()
+        for r in mod.reads:
+            h.update(r.encode())
+            h.update(self.resource(r).encode())
+        return h.hexdigest()[:16]
+
+#
+# Running
+#
+
+def stored(body, prop):
+    return body[prop].to_dict() if prop in body else {}
+
+def detect_options(body):
+    custom_head = any(not vg in body.vertex_groups for vg in ['cf_J_CheekLow_L', 'cf_J_Nose_t', 'cf_J_Mouthup', 'cf_J_FaceUp_tz'])
+    return {'extend_safe': True, 'extend_full': False, 'subdivide': False, 'subdivide_mode': 'BAKED', 'custom_head': custom_head}
+
+def call(mod, arm, body, cost):
+    t1 = time.time()
+    mod(arm, body)
+    t2 = time.time()
+    cost[mod.name] = t2-t1
+    print("%s: %.3f s" % (mod.name, t2-t1))
+
+# Records the inputs of every enabled mod as they are now
+def record(arm, body):
+    options = stored(body, "extras_options") or detect_options(body)
+    state = State(arm, body)
+    inputs = {}
+    for m in mods:
+        if m.enabled(options, body):
+            inputs[m.name] = state.inputs(m)
+    body["extras_inputs"] = inputs
+
+def report(cost):
+    print("%-24s %10s" % ("Mod", "Time, s"))
+    for m in mods:
+        if m.name in cost:
+            print("%-24s %10.3f" % (m.name, cost[m.name]))
+
+# Full pass, at import time. 'options' holds extend_safe, extend_full, subdivide, subdivide_mode and custom_head.
+# The caller records the inputs with record() once the weights are final.
+def run(arm, body, options):
+    t1 = time.time()
+    cost = {}
+    for m in mods:
+        if m.enabled(options, body):
+            call(m, arm, body, cost)
+    body["extras_options"] = options
+    body["extras_cost"] = cost
+    t2 = time.time()
+    print("Extras done in %.3f s" % (t2-t1))
+    report(cost)
+
+# Runs 'name' (or, if None, every mod with edited inputs) and the downstream mods affected by it.
+# Returns the names of the mods that ran and of the stale mods that could not run.
+def rerun(arm, body, name=None):
+    options = stored(body, "extras_options") or detect_options(body)
+    inputs = stored(body, "extras_inputs")
+    cost = stored(body, "extras_cost")
+    if name is not None:
+        forced = find_mod(name)
+        if forced is None or not forced.rerun:
+            print("Mod", name, "can't be run again, re-import the character")
+            return [], [name]
+        candidates = downstream(name)
+    else:
+        forced = None
+        candidates = set([m.name for m in mods])
+
+    ran = []
+    stale = []
+    # no extras_cache session: reruns are for iterating on the formulas, they always evaluate them
+    with mesh_cache.MeshSnapshot(body):
+        state = State(arm, body)
+        for m in mods:
+            if not m.enabled(options, body):
+                continue
+            if m is not forced:
+                if not m.name in candidates or inputs.get(m.name)==state.inputs(m):
+                    continue
+                if not m.rerun:
+                    stale.append(m.name)
+                    continue
+            call(m, arm, body, cost)
+            ran.append(m.name)
+            state = State(arm, body)
+    if len(ran)>0:
+        body["extras_cost"] = cost
+        record(arm, body)
+    print("Extras: ran", ran, "skipped", len([m for m in mods if m.enabled(options, body)])-len(ran)-len(stale), "unchanged")
+    if len(stale)>0:
+        print("Stale mods (re-import to update):", stale)
+    return ran, stale
@@ -0,0 +1,160 @@
+import zlib
+import array
+import struct
+
+#
+# Minimal binary FBX reader, for checking a dump without importing it.
+#
+# Only the children of the top-level "Objects" node whose names are asked for are parsed (e.g. "Model");
+# everything else (geometry, textures, animation) is skipped by seeking past it, so reading the bone
+# names of a 50 MB FBX touches a few hundred KB of it. ASCII FBX files are not supported.
+#
+
+class FBXError(Exception):
+    pass
+
+class Node:
+    def __init__(self, name, props, children):
+        self.name = name
+        self.props = props
+        self.children = children
+
+    def find(self, name):
+        for x in self.children:
+            if x.name==name:
+                return x
+        return None
+
+magic = b"Kaydara FBX Binary  \x00"
+
+scalar_formats = {b'Y': '<h', b'C': '<?', b'I': '<i', b'F': '<f', b'D': '<d', b'L': '<q'}
+array_formats = {b'f': 'f', b'd': 'd', b'l': 'q', b'i': 'i', b'b': 'b'}
+
+def read_props(fp, count):
+    props = []
+    for i in range(count):
+        t = fp.read(1)
+        if t in scalar_formats:
+            fmt = scalar_formats[t]
+            props.append(struct.unpack(fmt, fp.read(struct.calcsize(fmt)))[0])
+        elif t in array_formats:
+            length, encoding, size = struct.unpack('<III', fp.read(12))
+            data = fp.read(size)
+            if encoding==1:
+                data = zlib.decompress(data)
+            a = array.array(array_formats[t])
+            a.frombytes(data)
+            props.append(a)
+        elif t==b'S':
+            size = struct.unpack('<I', fp.read(4))[0]
+            props.append(fp.read(size).decode('utf-8', 'replace'))
+        elif t==b'R':
+            size = struct.unpack('<I', fp.read(4))[0]
+            props.append(fp.read(size))
+        else:
+            raise FBXError("Unknown property type %r" % t)
+    return props
+
+class Reader:
+    def __init__(self, fp):
+        self.fp = fp
+        head = fp.read(27)
+        if len(head)<27 or not head.startswith(magic):
+            raise FBXError("Not a binary FBX file")
+        self.version = struct.unpack('<I', head[23:27])[0]
+        self.wide = self.version>=7500
+
+    # (end offset, property count, property list length, name), or None at a null record
+    def header(self):
+        if self.wide:
+            raw = self.fp.read(25)
+            if len(raw)<25:
+                return None
+            end, count, size, name_len = struct.unpack('<QQQB', raw)
+        else:
+            raw = self.fp.read(13)
+            if len(raw)<13:
+                return None
+            end, count, size, name_len = struct.unpack('<IIIB', raw)
+        if end==0:
+            return None
+        return end, count, size, self.fp.read(name_len).decode('utf-8', 'replace')
+
+    def read_node(self, end, count, size, name):
+        props = read_props(self.fp, count)
+        children = []
+        while self.fp.tell()<end:
+            h = self.header()
+            if h is None:
+                break
+            children.append(self.read_node(*h))
+        self.fp.seek(end)
+        return Node(name, props, children)
+
+    # Top-level nodes: yields (name, end offset, property count, property list length), leaves the file at
+    # the start of the node's properties. The caller either reads the node or seeks to its end.
+    def top_level(self):
+        while True:
+            h = self.header()
+            if h is None:
+                return
+            end, count, size, name = h
+            yield name, end, count, size
+            self.fp.seek(end)
+
+    def children(self, end, count, size, names):
+        self.fp.seek(size, 1)
+        out = []
+        while self.fp.tell()<end:
+            h = self.header()
+            if h is None:
+                break
+            if h[3] in names:
+                out.append(self.read_node(*h))
+            else:
+                self.fp.seek(h[0])
+        return out
+
+# Children of "Objects" with the given node names, e.g. read_objects(path, ["Model", "Pose"])
+def read_objects(path, names):
+    with open(path, "rb") as fp:
+        r = Reader(fp)
+        for name, end, count, size in r.top_level():
+            if name=="Objects":
+                return r.children(end, count, size, set(names))
+    return []
+
+# Object names are stored as "name\x00\x01Class"
+def object_name(s):
+    return s.split('\x00\x01')[0]
+
+# Names of the skeleton nodes (Model objects of type "LimbNode")
+def limb_nodes(path):
+    out = []
+    for x in read_objects(path, ["Model"]):
+        if len(x.props)>=3 and x.props[2]=="LimbNode":
+            out.append(object_name(x.props[1]))
+    return out
+
+# {name: 16 doubles of the global bind matrix, column-major} of the nodes in the bind poses
+def bind_poses(models, poses):
+    names = {x.props[0]: object_name(x.props[1]) for x in models if len(x.props)>=2}
+    out = {}
+    for p in poses:
+        if len(p.props)<3 or p.props[2]!="BindPose":
+            continue
+        for x in p.children:
+            if x.name!="PoseNode":
+                continue
+            node = x.find("Node")
+            matrix = x.find("Matrix")
+            if node is not None and matrix is not None and node.props[0] in names:
+                out[names[node.props[0]]] = list(matrix.props[0])
+    return out
+
+# (LimbNode names, bind matrices by name) in one pass over the file
+def skeleton(path):
+    objects = read_objects(path, ["Model", "Pose"])
+    models = [x for x in objects if x.name=="Model"]
+    limbs = [object_name(x.props[1]) for x in models if len(x.props)>=3 and x.props[2]=="LimbNode"]
+    return limbs, bind_poses(models, [x for x in objects if x.name=="Pose"])
@@ -1,6 +1,5 @@
 import bpy
 import os
-import bmesh
 import math
 import hashlib
 from mathutils import Matrix, Vector, Euler, Quaternion, Color
@@ -18,7 +17,7 @@ from bpy.props import (
     FloatVectorProperty
 )
 
-from . import add_extras, armature, attributes
+from . import add_extras, armature, attributes, extras_cache, extras_scheduler, mesh_cache, preflight, shape_key_store, weights
 
 class ImportException(Exception):
     def __init__(self, text):
@@ -891,17 +890,10 @@ def load_customization(arm, custfn):
 def fix_neck_loop(body):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.view_layer.objects.active = body
-    bmd = bmesh.new()
-    bmd.from_mesh(body.data)
-    bmd.verts.ensure_lookup_table()
-    bmd.edges.ensure_lookup_table()
-    v=set()
-    for x in bmd.edges:
-        if x.is_boundary:
-            if len(x.verts[0].link_faces)<=4:
-                v.add(x.verts[0].index)
-            if len(x.verts[1].link_faces)<=4:
-                v.add(x.verts[1].index)
+    snap = mesh_cache.snapshot(body)
+    # endpoints of boundary edges with at most 4 linked faces
+    boundary_verts = snap.edges()[snap.edge_face_counts()==1].reshape([-1])
+    v=set(boundary_verts[snap.vertex_face_counts()[boundary_verts]<=4].tolist())
 
     vg = body.vertex_groups['cf_J_Head_s'].index
     boundary = [(x in v) and (add_extras.get_weight(body, x, vg)>0.99) for x in range(len(body.data.vertices))]
@@ -917,6 +909,8 @@ def fix_neck_loop(body):
         bpy.ops.object.mode_set(mode='OBJECT')
 
 last_import_status='...'
+# Set to False to import dumps that fail the preflight checks anyway
+use_preflight=True
 
 def get_mean_skin_tone(body):
     mat = body["torso_mat"]
@@ -941,14 +935,15 @@ def get_mean_skin_tone(body):
     #print("Skin tone (gamma corrected):", pixel)
     return pixel
 
-def import_body(input, refactor, 
+def import_body_steps(input, refactor, 
         do_extend_safe, do_extend_full, 
         add_injector,
         add_exhaust,
         replace_teeth, subdivide, 
         c_eye, c_hair,
         name, customization,
-        reweight_clothing=False
+        reweight_clothing=False,
+        subdivide_mode='BAKED'
         ):
     #global path, fbx, suffix, dumpfilename, last_import_status, customization
     global path, last_import_status
@@ -986,6 +981,15 @@ def import_body(input, refactor,
         print('Failed to locate the FBX')
         return None
 
+    # FBX skeleton vs Unity dump, before spending a minute on an import that can't work
+    if use_preflight:
+        check = preflight.check(fbx, dumpfilename)
+        if len(check["errors"])>0:
+            last_import_status=check["errors"][0]
+            return None
+        if check["fallback"]:
+            refactor=False
+
     root_path = path
     custfile = path+'/customization'
     custfile2 = path+'/customization2'
@@ -1003,6 +1007,7 @@ def import_body(input, refactor,
             eye_color=(eye_color[0], eye_color[1], eye_color[2], 1.0)
         
     try:
+        yield 'FBX import'
         t1=time.time()
         success, arm, body = import_bodyparts(fbx)
         t2=time.time()
@@ -1012,6 +1017,7 @@ def import_body(input, refactor,
             print('Failed to import body')
             return None
 
+        yield 'Textures'
         t1=time.time()
         body=rebuild_torso(arm, body)
         t2=time.time()
@@ -1038,6 +1044,7 @@ def import_body(input, refactor,
             mod.show_on_cage = True
         bpy.context.view_layer.objects.active = arm
 
+        yield 'Armature refactor'
         t1=time.time()
         refactor = armature.reshape_armature(path, arm, body, not refactor, dumpfilename)
         t2=time.time()
@@ -1048,92 +1055,79 @@ def import_body(input, refactor,
         body.data.update()
 
         tooth = bpy.data.objects[body["o_tooth"]]
-        if refactor and replace_teeth:
-            tooth.data=bpy.data.meshes["Prefab Tooth v2"].copy()
-            tooth.data.shape_keys.key_blocks["20"].value=0.
-            tooth.data.shape_keys.key_blocks["Smaller"].value=0.
-            tooth.location=Vector([0, 15.95, -0.08])
-
-        t1=time.time()
-
-        bpy.context.view_layer.objects.active = body
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.context.view_layer.objects.active = arm
-        bpy.ops.object.mode_set(mode='POSE')
 
-        male = (body['Boy'] > 0.0)
-        if add_injector is None:
-            add_injector = male
-            for b in arm.pose.bones:
-                if 'cm_J_dan' in b.name:
-                    # has an injector, don't attempt to sew on another
-                    add_injector = False
-                    break
-        if add_injector:
-            if refactor:
-                print("Trying to attach the injector")
-                add_extras.attach_injector(arm, body)
-            else:
-                print("Can't attach the injector (fallback armature)")
-        if add_exhaust and refactor:
-            add_extras.attach_exhaust(arm, body)
-
-        custom_head = False
-        for vg in ['cf_J_CheekLow_L', 'cf_J_Nose_t', 'cf_J_Mouthup', 'cf_J_FaceUp_tz']:
-            if not vg in body.vertex_groups:
-                print(vg, "does not exist")
-                custom_head = True
-
-        # On a custom head, the UV map is typically different, and we don't know where to draw eyebrows
-        # The choice is between drawing them and hoping for the best (even though they might be on the cheeks),
-        # or hiding them.
-        if custom_head:
-            body["head_mat"].node_tree.nodes["Eyebrow scale"].outputs[0].default_value = 0.0
-
-        try:
-            body.data.use_auto_smooth = False
-        except:
-            pass
+        # NumPy views of the body mesh, shared by the attachments and the extras below
+        # (with extras_cache.use_cache, formula results of earlier imports with the same topology are reused)
+        yield 'Attachments'
+        with mesh_cache.MeshSnapshot(body) as snap, extras_cache.Session():
+            if refactor and replace_teeth:
+                tooth.data=bpy.data.meshes["Prefab Tooth v2"].copy()
+                tooth.data.shape_keys.key_blocks["20"].value=0.
+                tooth.data.shape_keys.key_blocks["Smaller"].value=0.
+                tooth.location=Vector([0, 15.95, -0.08])
 
-        if do_extend_safe:
-            add_extras.add_helper_jc_bones(arm)
-            add_extras.add_spine_rear_soft(arm, body)
+            t1=time.time()
 
-        if subdivide:
-            add_extras.subdivide(arm, body)
-
-        if not custom_head:
-            if do_extend_safe:
-                # Add a number of new customization shape keys.
-                add_extras.add_shape_keys(arm, body, False)
-
-                # Reversible mods.
-                # This splits a number of VGs and adds a number of bones, but in such a manner that, with new bones in null pose,
-                # the result should be virtually identical to unmodified mesh
-                # (slight changes are expected, because new bones are slightly offset from their parents for posing convenience,
-                # but they should be minimal).
-                add_extras.add_skull_soft_neutral(arm, body)
-
-            # Irreversible mods (unique or fundamentally changed VGs)
-            if do_extend_full and 'cf_J_FaceUp_tz' in body.vertex_groups:
-                add_extras.repaint_head(arm, body)
-
-            # Scalp VG (for curves hair attachment)
-            add_extras.paint_scalp(arm, body)
+            bpy.context.view_layer.objects.active = body
+            bpy.ops.object.mode_set(mode='EDIT')
+            bpy.ops.object.mode_set(mode='OBJECT')
+            bpy.context.view_layer.objects.active = arm
+            bpy.ops.object.mode_set(mode='POSE')
+
+            male = (body['Boy'] > 0.0)
+            if add_injector is None:
+                add_injector = male
+                for b in arm.pose.bones:
+                    if 'cm_J_dan' in b.name:
+                        # has an injector, don't attempt to sew on another
+                        add_injector = False
+                        break
+            if add_injector:
+                if refactor:
+                    print("Trying to attach the injector")
+                    add_extras.attach_injector(arm, body)
+                else:
+                    print("Can't attach the injector (fallback armature)")
+            if add_exhaust and refactor:
+                add_extras.attach_exhaust(arm, body)
+
+            custom_head = False
+            for vg in ['cf_J_CheekLow_L', 'cf_J_Nose_t', 'cf_J_Mouthup', 'cf_J_FaceUp_tz']:
+                if not vg in body.vertex_groups:
+                    print(vg, "does not exist")
+                    custom_head = True
+
+            # On a custom head, the UV map is typically different, and we don't know where to draw eyebrows
+            # The choice is between drawing them and hoping for the best (even though they might be on the cheeks),
+            # or hiding them.
+            if custom_head:
+                body["head_mat"].node_tree.nodes["Eyebrow scale"].outputs[0].default_value = 0.0
 
-        if do_extend_safe:
-            add_extras.tweak_nails(arm, body)
+            try:
+                body.data.use_auto_smooth = False
+            except:
+                pass
 
-        bpy.context.view_layer.objects.active = body
-        bpy.ops.paint.weight_paint_toggle()
-        bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.005)
-        bpy.ops.paint.weight_paint_toggle()
+            # Helper bones, subdivision, customization shape keys, head repaints, scalp and nails,
+            # in dependency order (see extras_scheduler)
+            yield 'Extras'
+            # The body may have been edited while the queue waited between stages
+            snap.touch()
+            extras_scheduler.run(arm, body, {
+                'extend_safe': do_extend_safe,
+                'extend_full': do_extend_full,
+                'subdivide': subdivide,
+                'subdivide_mode': subdivide_mode,
+                'custom_head': custom_head,
+                })
+
+        weights.clean_weights(body, arm, 0.005)
 
         t2=time.time()
         print("Tweaks done in %.3f s" % (t2-t1))
         t1=t2
 
+        yield 'Clothing'
         bpy.context.view_layer.objects.active = arm
         bpy.ops.object.mode_set(mode='OBJECT')
 
@@ -1165,8 +1159,10 @@ def import_body(input, refactor,
                 bpy.ops.object.select_all(action='DESELECT')
                 x.select_set(True)
                 bpy.ops.object.data_transfer(data_type='VGROUP_WEIGHTS', use_auto_transform=False, use_object_transform=True, layers_select_src='ALL', layers_select_dst='NAME', mix_mode='REPLACE')
+                weights.clean_weights(x, arm, 0.005, limit=weights.clothing_influence_limit, normalize=True)
             arm.data.pose_position='POSE'
 
+        yield 'Customization'
         arm["body"] = body
         arm["tooth"] = tooth
         #arm["path"] = root_path
@@ -1235,16 +1231,20 @@ def import_body(input, refactor,
         print("Attributes done in %.3f s" % (t2-t1))
         t1=t2
 
+        yield 'Wrap-up'
         # memorize coordinates and normals of all verts in T-pose
         add_extras.add_t_pos(arm, body)
 
         attributes.set_equipment(attributes.hs2object())
 
+        # drivers are set by now, so generated keys identical to Basis or to another key can go (FBX blendshapes stay)
+        shape_key_store.compact(arm, body)
+
         bpy.ops.object.mode_set(mode='OBJECT')
         bpy.context.view_layer.objects.active = body
-        bpy.ops.paint.weight_paint_toggle()
-        bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.005)
-        bpy.ops.paint.weight_paint_toggle()
+        weights.clean_weights(body, arm, 0.005)
+        # inputs of the extras as they are in the finished character, for extras_scheduler.rerun()
+        extras_scheduler.record(arm, body)
         bpy.context.view_layer.objects.active = arm
         bpy.ops.object.mode_set(mode='POSE')
 
@@ -1263,11 +1263,156 @@ def import_body(input, refactor,
     except ImportException as e:
         print(e.text)
         last_import_status=e.text
+    except GeneratorExit:
+        last_import_status='Import cancelled'
+        raise
     except:
         last_import_status='Import failed, see system console for details'
         raise
     return arm
 
+def run_steps(steps):
+    try:
+        while True:
+            next(steps)
+    except StopIteration as e:
+        return e.value
+
+def import_body(*args, **kwargs):
+    return run_steps(import_body_steps(*args, **kwargs))
+
+#
+# Stepwise import (see hs2rig_OT_import_queue in __init__.py).
+#
+# import_body_steps() yields the name of each stage before running it; an ImportJob advances it one stage
+# per step(), so the UI can redraw, show progress and take Esc in between. cancel() closes the generator and
+# removes every datablock created since the job started; a stage that raises does the same. The user may
+# work in between: the active object, its mode and the selection a stage leaves are restored before the next one. Stage durations are kept for the ETA.
+#
+
+import_stages = ['Preflight', 'FBX import', 'Textures', 'Armature refactor', 'Attachments', 'Extras', 'Clothing',
+    'Customization', 'Wrap-up']
+
+# Stage name -> recent durations
+stage_history = {}
+# Assumed duration of a stage that has never run
+default_stage_time = 5.0
+
+rollback_collections = ['objects', 'meshes', 'armatures', 'materials', 'images', 'node_groups', 'textures',
+    'actions', 'collections', 'texts', 'lights', 'cameras', 'worlds']
+
+def datablock_snapshot():
+    return {x: set(getattr(bpy.data, x)) for x in rollback_collections}
+
+def rollback(snapshot):
+    try:
+        bpy.ops.object.mode_set(mode='OBJECT')
+    except:
+        pass
+    new = []
+    for x in rollback_collections:
+        new += [y for y in getattr(bpy.data, x) if not y in snapshot[x]]
+    bpy.data.batch_remove(new)
+    print("Rolled back", len(new), "datablocks")
+
+# Active object, its mode and the selection, as a stage leaves them
+def context_state():
+    vl = bpy.context.view_layer
+    active = vl.objects.active
+    return (active.name if active is not None else None, active.mode if active is not None else 'OBJECT',
+        set([x.name for x in vl.objects if x.select_get()]))
+
+# Puts back what the user changed between two stages (the next stage relies on it)
+def restore_context(state):
+    if context_state()==state:
+        return
+    name, mode, selected = state
+    vl = bpy.context.view_layer
+    if vl.objects.active is not None and vl.objects.active.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for x in vl.objects:
+        x.select_set(x.name in selected)
+    vl.objects.active = bpy.data.objects.get(name) if name is not None else None
+    if mode!='OBJECT' and vl.objects.active is not None:
+        bpy.ops.object.mode_set(mode=mode)
+    print("Restored the import context (active object %s, %s mode)" % (name, mode))
+
+def stage_estimate(stage):
+    v = stage_history.get(stage, [])
+    return sum(v)/len(v) if len(v)>0 else default_stage_time
+
+def import_estimate():
+    return sum([stage_estimate(x) for x in import_stages])
+
+class ImportJob:
+    def __init__(self, label, kwargs, on_done=None):
+        self.label = label
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.steps = None
+        self.stage = None
+        self.stage_t0 = None
+        self.snapshot = None
+        self.context = None
+        self.result = None
+        self.done = False
+
+    # Runs one stage; returns False when the job is finished
+    def step(self):
+        if self.steps is None:
+            self.snapshot = datablock_snapshot()
+            self.steps = import_body_steps(**self.kwargs)
+            self.stage = import_stages[0]
+            self.stage_t0 = time.time()
+        try:
+            if self.context is not None:
+                restore_context(self.context)
+            next_stage = next(self.steps)
+            self.context = context_state()
+        except StopIteration as e:
+            self.result = e.value
+            next_stage = None
+        except Exception:
+            # a failed stage leaves a half-built character behind
+            self.cancel()
+            raise
+        t = time.time()
+        stage_history.setdefault(self.stage, []).append(t-self.stage_t0)
+        del stage_history[self.stage][:-10]
+        self.stage = next_stage
+        self.stage_t0 = t
+        if next_stage is None:
+            self.done = True
+            if self.on_done is not None:
+                self.on_done(self.result)
+        return not self.done
+
+    def cancel(self):
+        if self.steps is not None and not self.done:
+            self.steps.close()
+            rollback(self.snapshot)
+        self.done = True
+
+    # Fraction of the expected import time already spent
+    def progress(self):
+        if self.steps is None:
+            return 0.0
+        if self.done:
+            return 1.0
+        i = import_stages.index(self.stage) if self.stage in import_stages else 0
+        spent = sum([stage_estimate(x) for x in import_stages[:i]])
+        return min(spent/max(import_estimate(), 1e-6), 1.0)
+
+    # Expected remaining time of this job, in seconds
+    def remaining(self):
+        if self.done:
+            return 0.0
+        if self.steps is None:
+            return import_estimate()
+        i = import_stages.index(self.stage) if self.stage in import_stages else 0
+        current = max(stage_estimate(self.stage)-(time.time()-self.stage_t0), 0.0)
+        return current + sum([stage_estimate(x) for x in import_stages[i+1:]])
+
 """
 def reset_customization(arm):
     for bone in arm.pose.bones:
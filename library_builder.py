@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+#
+# Parallel character builds in headless Blender processes (character_worker.py), for "Load all presets".
+#
+# submit() queues a job; poll(), called from a bpy.app.timers callback, starts queued jobs while fewer than
+# 'workers' are running and returns the ones that have exited since the last call. Each process builds one
+# character and saves it to the import cache in its dump directory (job["library"], one file per set of
+# import options), so a crash or a runaway process costs one character, and its memory is returned to the
+# system as soon as it exits. A library is built once however many presets ask for it (Build.tags collects
+# them), and builds of the same dump directory run one after another. On Linux each process gets a data
+# size cap of memory_gb, set with prlimit() once it has started; elsewhere the cap is not enforced and only
+# the worker count limits memory use. The output of each build goes to the .log next to its library.
+#
+
+worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "character_worker.py")
+
+queued = []
+running = []
+
+class Build:
+    def __init__(self, job):
+        self.job = job
+        self.dump_dir = job["kwargs"]["input"]
+        self.library = job["library"]
+        # whatever the callers want back for each request of this library (e.g. the presets to link)
+        self.tags = []
+        self.proc = None
+        self.log = None
+        self.job_path = None
+        self.t0 = None
+        self.seconds = None
+        self.returncode = None
+
+# Caps the data size of a running process (Linux). Setting it in the child before exec (preexec_fn) is not
+# safe in a multithreaded process like Blender.
+def limit_memory(pid, memory_gb):
+    import resource
+    cap = int(memory_gb*(1<<30))
+    for x in ["RLIMIT_DATA", "RLIMIT_AS"]:
+        try:
+            resource.prlimit(pid, getattr(resource, x), (cap, cap))
+            return True
+        except (AttributeError, ValueError, OSError):
+            pass
+    return False
+
+def launch(build, blender, memory_gb):
+    fd, build.job_path = tempfile.mkstemp(prefix="hs2_build_", suffix=".json")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(build.job, fp, default=list)
+    build.log = open(os.path.splitext(build.library)[0]+".log", "w")
+    args = [blender, "--background", "--factory-startup", "--python", worker_script, "--", build.job_path]
+    build.proc = subprocess.Popen(args, stdout=build.log, stderr=subprocess.STDOUT)
+    build.t0 = time.time()
+    if memory_gb is not None and memory_gb>0 and sys.platform.startswith("linux"):
+        if not limit_memory(build.proc.pid, memory_gb):
+            print("Failed to cap the memory of the build for", build.dump_dir)
+
+def finish(build):
+    build.seconds = time.time()-build.t0
+    build.log.close()
+    try:
+        os.remove(build.job_path)
+    except:
+        pass
+
+# Queues a build of job["library"], or adds 'tag' to the build of it that is already queued or running
+def submit(job, tag=None):
+    for b in queued+running:
+        if b.library==job["library"]:
+            break
+    else:
+        b = Build(job)
+        queued.append(b)
+    if tag is not None:
+        b.tags.append(tag)
+    return b
+
+def busy():
+    return len(queued)+len(running)>0
+
+def poll(blender, workers=2, memory_gb=None):
+    done = []
+    for b in list(running):
+        b.returncode = b.proc.poll()
+        if b.returncode is not None:
+            finish(b)
+            running.remove(b)
+            done.append(b)
+            print("Built %s in %.1f s%s" % (b.library, b.seconds, "" if b.returncode==0 else
+                " (failed with code %d, see the .log next to it)" % b.returncode))
+    while len(running)<max(1, workers):
+        # one build per dump directory at a time
+        busy_dirs = set([x.dump_dir for x in running])
+        ready = [x for x in queued if not x.dump_dir in busy_dirs]
+        if len(ready)==0:
+            break
+        b = ready[0]
+        queued.remove(b)
+        try:
+            launch(b, blender, memory_gb)
+            running.append(b)
+        except Exception as e:
+            print("Failed to start a build for", b.dump_dir, ":", e)
+            b.returncode = -1
+            done.append(b)
+    return done
+
+def cancel():
+    for b in running:
+        b.proc.kill()
+        b.proc.wait()
+        finish(b)
+    running.clear()
+    queued.clear()
@@ -0,0 +1,376 @@
+import bpy
+import hashlib
+import numpy as np
+import time
+
+from . import spatial
+
+#
+# Per-vertex UV cache.
+#
+# Mods used to fetch a vertex's UV with bm.verts[x].link_loops[0][lay].uv, which needs a bmesh copy
+# of the whole body. Here the loop layer is read once with foreach_get, together with the loop->vertex map.
+#
+# The representative UV of a vertex is the UV of its lowest-indexed loop. Vertices without loops get (0,0).
+# For seam-aware code, all loop UVs of a vertex are available, ordered by loop index (so the first one
+# is always the representative.)
+#
+# Entries are keyed by mesh and dropped when the topology (vertex/edge/loop/face counts) changes.
+# Code that edits UVs in place must call invalidate_uvs().
+#
+
+uv_cache = {}
+
+def topology_key(mesh):
+    return (len(mesh.vertices), len(mesh.edges), len(mesh.loops), len(mesh.polygons))
+
+def read_uv_layer(mesh, layer):
+    nv = len(mesh.vertices)
+    nl = len(mesh.loops)
+    loop_verts = np.zeros([nl], dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    uvs = np.zeros([nl*2], dtype=np.float32)
+    mesh.uv_layers[layer].data.foreach_get("uv", uvs)
+    uvs = uvs.reshape([-1,2])
+
+    # stable sort keeps loops of each vertex in loop index order
+    order = np.argsort(loop_verts, kind='stable')
+    counts = np.bincount(loop_verts, minlength=nv)
+    offsets = np.zeros([nv+1], dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    loop_uvs = uvs[order]
+
+    vert_uvs = np.zeros([nv,2], dtype=np.float32)
+    has_loops = counts>0
+    vert_uvs[has_loops] = loop_uvs[offsets[:-1][has_loops]]
+    return vert_uvs, offsets, loop_uvs
+
+def get_uv_entry(mesh, layer):
+    if isinstance(mesh, bpy.types.Object):
+        mesh = mesh.data
+    key = (mesh.as_pointer(), layer)
+    topo = topology_key(mesh)
+    if key in uv_cache and uv_cache[key][0]==topo:
+        return uv_cache[key][1]
+    entry = read_uv_layer(mesh, layer)
+    uv_cache[key] = (topo, entry)
+    return entry
+
+# (N,2) array of representative UVs, one per vertex
+def vertex_uvs(mesh, layer='uv1'):
+    return get_uv_entry(mesh, layer)[0]
+
+# (offsets, loop_uvs): UVs of all loops of vertex x are loop_uvs[offsets[x]:offsets[x+1]]
+def vertex_loop_uvs(mesh, layer='uv1'):
+    entry = get_uv_entry(mesh, layer)
+    return entry[1], entry[2]
+
+def invalidate_uvs(mesh=None):
+    if mesh is None:
+        uv_cache.clear()
+        return
+    if isinstance(mesh, bpy.types.Object):
+        mesh = mesh.data
+    ptr = mesh.as_pointer()
+    for key in [k for k in uv_cache if k[0]==ptr]:
+        del uv_cache[key]
+
+#
+# Mesh snapshot.
+#
+# A snapshot lazily materializes NumPy views of an object's mesh (coordinates, normals, UVs, the
+# vertex group weight index, the edge list, vertex adjacency, ...) and shares them between all mods
+# that run while it is open:
+#
+#   with mesh_cache.MeshSnapshot(body) as snap:
+#       add_extras.add_shape_keys(arm, body, False)
+#       ...
+#
+# Code further down the call chain picks up the open snapshot with snapshot(obj). Outside of a 'with'
+# block, snapshot(obj) returns a throwaway one, so every function still works when called on its own.
+#
+# Views are only valid while the object is in OBJECT mode. They are rebuilt automatically after
+# a topology change. Any other write to the mesh must be followed by touch() with the names of the
+# views that went stale. set_weight / add_weight in add_extras update the weight index in place.
+#
+
+open_snapshots = {}
+
+class MeshSnapshot:
+    def __init__(self, obj):
+        self.obj = obj
+        self.views = {}
+        self.topology = None
+        self.builds = {}
+        self.hits = {}
+        self.t_build = 0.0
+
+    def __enter__(self):
+        open_snapshots[self.obj.as_pointer()] = self
+        return self
+
+    def __exit__(self, *args):
+        try:
+            del open_snapshots[self.obj.as_pointer()]
+        except:
+            pass
+        self.report()
+        return False
+
+    def report(self):
+        built = sum(self.builds.values())
+        avoided = sum(self.hits.values())
+        print("Mesh snapshot of %s: %d views built in %.3f s, %d full-mesh conversions avoided" % (self.obj.name, built, self.t_build, avoided))
+        for name in sorted(self.builds):
+            print("    %-16s built %3d, reused %5d" % (name, self.builds[name], self.hits.get(name, 0)))
+
+    def touch(self, *names):
+        if len(names)==0:
+            self.views.clear()
+            invalidate_uvs(self.obj.data)
+            return
+        for name in names:
+            if name in self.views:
+                del self.views[name]
+            # derived views
+            for dep in view_deps.get(name, []):
+                if dep in self.views:
+                    del self.views[dep]
+            if name in ['uvs', 'loop_uvs']:
+                invalidate_uvs(self.obj.data)
+
+    def get(self, name):
+        mesh = self.obj.data
+        topo = (mesh.as_pointer(),) + topology_key(mesh)
+        if topo!=self.topology:
+            self.views.clear()
+            self.topology = topo
+        if name in self.views:
+            self.hits[name] = self.hits.get(name, 0)+1
+            return self.views[name]
+        t1 = time.time()
+        self.views[name] = view_builders[name](self, mesh)
+        self.t_build += time.time()-t1
+        self.builds[name] = self.builds.get(name, 0)+1
+        return self.views[name]
+
+    def co(self):
+        return self.get('co')
+
+    def undeformed_co(self):
+        return self.get('undeformed_co')
+
+    def normals(self):
+        return self.get('normals')
+
+    # co() transformed by the object's matrix_world
+    def world_co(self):
+        return self.get('world_co')
+
+    # spatial.PointIndex over world_co()
+    def world_index(self):
+        return self.get('world_index')
+
+    def uvs(self):
+        return self.get('uvs')
+
+    # (offsets, loop_uvs), see vertex_loop_uvs()
+    def loop_uvs(self):
+        return self.get('loop_uvs')
+
+    # spatial.GridIndex over uvs()
+    def uv_grid(self):
+        return self.get('uv_grid')
+
+    # (E,2) vertex indices
+    def edges(self):
+        return self.get('edges')
+
+    # (offsets, neighbours): neighbours of vertex x are neighbours[offsets[x]:offsets[x+1]]
+    def adjacency(self):
+        return self.get('adjacency')
+
+    def loop_verts(self):
+        return self.get('loop_verts')
+
+    def loop_edges(self):
+        return self.get('loop_edges')
+
+    def face_materials(self):
+        return self.get('face_materials')
+
+    # index of the face each loop belongs to
+    def loop_faces(self):
+        return self.get('loop_faces')
+
+    # number of faces linked to each edge (1 = boundary edge)
+    def edge_face_counts(self):
+        return self.get('edge_face_counts')
+
+    # number of faces linked to each vertex
+    def vertex_face_counts(self):
+        return self.get('vertex_face_counts')
+
+    # hex digest of the face index array and the UVs, identifies meshes with the same topology
+    def fingerprint(self):
+        return self.get('fingerprint')
+
+    # {group index: {vertex: weight}}
+    def weights(self):
+        return self.get('weights')
+
+    # hex digest of the fingerprint, undeformed positions, normals and weights (extras_cache keys of the
+    # formulas that read the mesh through 'body')
+    def digest(self):
+        return self.get('digest')
+
+    # Equivalent of add_extras.vgroup(): sorted list of verts with weight > min_wt in any of 'ids'
+    def members(self, ids, min_wt):
+        index = self.weights()
+        v = set()
+        for id in ids:
+            if id in index:
+                v.update([x for x, w in index[id].items() if w>min_wt])
+        return sorted(v)
+
+    def weight_written(self, vertex, group, weight):
+        if 'weights' in self.views:
+            self.views['weights'].setdefault(group, {})[vertex] = weight
+        self.views.pop('digest', None)
+
+def read_vertex_vector(mesh, attr):
+    out = np.zeros([len(mesh.vertices)*3], dtype=np.float32)
+    mesh.vertices.foreach_get(attr, out)
+    return out.reshape([-1,3])
+
+def build_world_co(snap, mesh):
+    m = np.array(snap.obj.matrix_world, dtype=np.float32)
+    return snap.co() @ m[:3,:3].T + m[:3,3]
+
+def build_edges(snap, mesh):
+    out = np.zeros([len(mesh.edges)*2], dtype=np.int32)
+    mesh.edges.foreach_get("vertices", out)
+    return out.reshape([-1,2])
+
+def build_adjacency(snap, mesh):
+    edges = snap.edges()
+    nv = len(mesh.vertices)
+    src = np.concatenate([edges[:,0], edges[:,1]])
+    dst = np.concatenate([edges[:,1], edges[:,0]])
+    order = np.argsort(src, kind='stable')
+    offsets = np.zeros([nv+1], dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=nv), out=offsets[1:])
+    return offsets, dst[order]
+
+def build_loop_attr(mesh, attr):
+    out = np.zeros([len(mesh.loops)], dtype=np.int32)
+    mesh.loops.foreach_get(attr, out)
+    return out
+
+def build_face_materials(snap, mesh):
+    out = np.zeros([len(mesh.polygons)], dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", out)
+    return out
+
+def build_loop_faces(snap, mesh):
+    totals = np.zeros([len(mesh.polygons)], dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", totals)
+    return np.repeat(np.arange(len(totals), dtype=np.int32), totals)
+
+def build_fingerprint(snap, mesh):
+    h = hashlib.sha1()
+    h.update(str(topology_key(mesh)).encode())
+    h.update(snap.loop_verts().astype(np.int32).tobytes())
+    h.update(np.bincount(snap.loop_faces(), minlength=len(mesh.polygons)).astype(np.int32).tobytes())
+    # (+0.0 folds -0.0 into 0.0)
+    h.update((np.round(snap.loop_uvs()[1], 4)+0.0).astype(np.float32).tobytes())
+    return h.hexdigest()
+
+# Hash of the per-character inputs of the formulas: fingerprint, undeformed positions, normals and weights
+def build_digest(snap, mesh):
+    h = hashlib.sha1()
+    h.update(snap.fingerprint().encode())
+    h.update((np.round(snap.undeformed_co(), 4)+0.0).astype(np.float32).tobytes())
+    h.update((np.round(snap.normals(), 4)+0.0).astype(np.float32).tobytes())
+    h.update(str([g.name for g in snap.obj.vertex_groups]).encode())
+    index = snap.weights()
+    for g in sorted(index):
+        verts = np.fromiter(index[g].keys(), dtype=np.int64, count=len(index[g]))
+        wts = np.fromiter(index[g].values(), dtype=np.float64, count=len(index[g]))
+        order = np.argsort(verts)
+        h.update(np.int64(g).tobytes())
+        h.update(verts[order].tobytes())
+        h.update(np.round(wts[order], 4).astype(np.float32).tobytes())
+    return h.hexdigest()
+
+def build_weights(snap, mesh):
+    index = {}
+    for v in mesh.vertices:
+        for g in v.groups:
+            if not g.group in index:
+                index[g.group] = {}
+            index[g.group][v.index] = g.weight
+    return index
+
+view_builders = {
+    'co': lambda snap, mesh: read_vertex_vector(mesh, "co"),
+    'undeformed_co': lambda snap, mesh: read_vertex_vector(mesh, "undeformed_co"),
+    'normals': lambda snap, mesh: read_vertex_vector(mesh, "normal"),
+    'world_co': build_world_co,
+    'world_index': lambda snap, mesh: spatial.PointIndex(snap.world_co()),
+    'uvs': lambda snap, mesh: vertex_uvs(mesh),
+    'loop_uvs': lambda snap, mesh: vertex_loop_uvs(mesh),
+    'uv_grid': lambda snap, mesh: spatial.GridIndex(snap.uvs()),
+    'edges': build_edges,
+    'adjacency': build_adjacency,
+    'loop_verts': lambda snap, mesh: build_loop_attr(mesh, "vertex_index"),
+    'loop_edges': lambda snap, mesh: build_loop_attr(mesh, "edge_index"),
+    'face_materials': build_face_materials,
+    'loop_faces': build_loop_faces,
+    'edge_face_counts': lambda snap, mesh: np.bincount(snap.loop_edges(), minlength=len(mesh.edges)),
+    'vertex_face_counts': lambda snap, mesh: np.bincount(snap.loop_verts(), minlength=len(mesh.vertices)),
+    'weights': build_weights,
+    'fingerprint': build_fingerprint,
+    'digest': build_digest,
+}
+
+# views computed from other views go stale together with them
+view_deps = {
+    'co': ['world_co', 'world_index'],
+    'world_co': ['world_index'],
+    'undeformed_co': ['digest'],
+    'normals': ['digest'],
+    'weights': ['digest'],
+    'uvs': ['loop_uvs', 'fingerprint', 'uv_grid', 'digest'],
+    'loop_uvs': ['uvs', 'fingerprint', 'uv_grid', 'digest'],
+}
+
+# Connected component labels (the lowest vertex index in each component) of a graph given as an (E,2) edge array
+def connected_components(n, edges):
+    labels = np.arange(n)
+    while True:
+        old = labels
+        m = np.minimum(labels[edges[:,0]], labels[edges[:,1]])
+        labels = labels.copy()
+        np.minimum.at(labels, edges[:,0], m)
+        np.minimum.at(labels, edges[:,1], m)
+        # pointer jumping
+        labels = labels[labels]
+        if (labels==old).all():
+            return labels
+
+def snapshot(obj):
+    ptr = obj.as_pointer()
+    if ptr in open_snapshots:
+        return open_snapshots[ptr]
+    return MeshSnapshot(obj)
+
+def open_snapshot(obj):
+    return open_snapshots.get(obj.as_pointer(), None)
+
+def touch(obj, *names):
+    snap = open_snapshot(obj)
+    if snap is not None:
+        snap.touch(*names)
+    elif len(names)==0 or 'uvs' in names or 'loop_uvs' in names:
+        invalidate_uvs(obj.data)
@@ -0,0 +1,156 @@
+import math
+import time
+
+try:
+    from . import fbx_reader
+except ImportError:
+    import fbx_reader
+
+#
+# Import preflight: cross-checks the FBX skeleton against the Unity dump before anything is imported.
+#
+# The dump is read line by line (GameObject names and localToWorld matrices), the FBX only for its
+# LimbNode names and bind pose (fbx_reader). check() returns
+#
+#   errors      the import would produce a broken rig; import_body() stops with the first one as its status
+#                 - the dump is not a character dump (wrong node exported) or cannot be read
+#                 - the FBX has no skeleton
+#                 - FBX bones that are not in the dump (dump of another character)
+#                 - a root height offset between the dump and the FBX (high heels)
+#                 - non-finite or degenerate matrices on the core bones
+#   fallback    the rig is reshaped with reshape_armature_fallback(): no cf_J_CheekLow_L (custom head),
+#               or degenerate bind matrices in the FBX
+#   warnings    implausible bone scales elsewhere, dump bones missing from the FBX skeleton
+#
+
+# Hips height above the root, as a fraction of the hips-to-neck distance, that the dump and the FBX may disagree by
+heel_tolerance = 0.03
+# Scales of the core bones outside this range are errors, of other cf_J_ bones warnings
+core_scale_range = (0.2, 5.0)
+scale_range = (1e-3, 20.0)
+# This many FBX bones absent from the dump means the dump is of another character
+max_unknown_bones = 0
+
+core_bones = ['cf_J_Hips', 'cf_J_Spine01', 'cf_J_Neck', 'cf_J_Head']
+custom_head_bone = 'cf_J_CheekLow_L'
+
+# {name: localToWorld rows} of cf_ objects, names of all GameObjects, first line
+def read_dump(path):
+    matrices = {}
+    names = set()
+    name = ''
+    first = None
+    rows = None
+    with open(path, "r", errors="replace") as fp:
+        for line in fp:
+            x = line.strip()
+            if first is None:
+                first = x
+                if 'cf_J_Root' in x:
+                    x = 'cf_J_Root--UnityEngine.GameObject'
+                elif 'CommonSpace' in x:
+                    x = 'CommonSpace--UnityEngine.GameObject'
+            if rows is not None:
+                rows.append([float(y) for y in x.split()[-4:]])
+                if len(rows)==4:
+                    matrices[name] = rows
+                    rows = None
+            elif x.endswith('--UnityEngine.GameObject'):
+                name = x.split('-')[0]
+                names.add(name)
+            elif x.startswith('@localToWorldMatrix<Matrix4x4>') and name.startswith('cf_'):
+                rows = [[float(y) for y in x.split()[-4:]]]
+    return matrices, names, first or ''
+
+def dump_position(m):
+    return [m[0][3], m[1][3], m[2][3]]
+
+# FBX matrices are column-major
+def fbx_position(m):
+    return [m[12], m[13], m[14]]
+
+def dump_scales(m):
+    return [math.sqrt(sum(m[i][j]**2 for i in range(3))) for j in range(3)]
+
+def fbx_scales(m):
+    return [math.sqrt(sum(m[4*j+i]**2 for i in range(3))) for j in range(3)]
+
+def distance(a, b):
+    return math.sqrt(sum((x-y)**2 for x, y in zip(a, b)))
+
+def finite(m):
+    return all(math.isfinite(x) for x in (m if not isinstance(m[0], list) else sum(m, [])))
+
+# Hips height above the root divided by the hips-to-neck distance, or None without those bones
+def hips_ratio(pos):
+    if not all(x in pos for x in ['cf_J_Root', 'cf_J_Hips', 'cf_J_Neck']):
+        return None
+    torso = distance(pos['cf_J_Hips'], pos['cf_J_Neck'])
+    if torso<1e-6:
+        return None
+    return distance(pos['cf_J_Root'], pos['cf_J_Hips'])/torso
+
+def check(fbx, dumpfilename, verbose=True):
+    t1 = time.time()
+    errors = []
+    warnings = []
+    fallback = False
+
+    try:
+        matrices, names, first = read_dump(dumpfilename)
+    except Exception as e:
+        return {"errors": ["Failed to read the Unity dump: %s" % e], "warnings": [], "fallback": False}
+    if not ('cf_J_Root' in first or 'CommonSpace' in first) or not 'cf_J_Hips' in matrices:
+        errors.append("The Unity dump is not a character dump (wrong node exported?)")
+
+    try:
+        limbs, binds = fbx_reader.skeleton(fbx)
+    except Exception as e:
+        return {"errors": errors+["Failed to read the FBX: %s" % e], "warnings": warnings, "fallback": False}
+    limbs = set(limbs)
+    if len(limbs)==0:
+        errors.append("No armatures found in the FBX")
+
+    unknown = sorted([x for x in limbs if x.startswith('cf_') and not x in names])
+    if len(matrices)>0 and len(unknown)>max_unknown_bones:
+        errors.append("%d FBX bones are not in the Unity dump (%s), dump of another character?" % (len(unknown), ", ".join(unknown[:3])))
+    missing = [x for x in matrices if x.startswith('cf_J_') and not x in limbs and not x=='cf_J_Root']
+    if len(limbs)>0 and len(missing)>0:
+        warnings.append("%d dump bones are not in the FBX skeleton" % len(missing))
+
+    if len(limbs)>0 and not custom_head_bone in limbs:
+        warnings.append("No %s, custom head mesh suspected, using the fallback rig" % custom_head_bone)
+        fallback = True
+
+    for x in core_bones:
+        if x in matrices:
+            m = matrices[x]
+            if not finite(m):
+                errors.append("Non-finite matrix of %s in the Unity dump" % x)
+            elif any(s<core_scale_range[0] or s>core_scale_range[1] for s in dump_scales(m)):
+                errors.append("Implausible scale of %s in the Unity dump (%.3f %.3f %.3f)" % ((x,)+tuple(dump_scales(m))))
+    odd = [x for x in matrices if x.startswith('cf_J_') and not x in core_bones and finite(matrices[x])
+        and any(s>1e-6 and (s<scale_range[0] or s>scale_range[1]) for s in dump_scales(matrices[x]))]
+    if len(odd)>0:
+        warnings.append("Implausible scales on %d bones (%s)" % (len(odd), ", ".join(odd[:3])))
+
+    damaged = [x for x in binds if x.startswith('cf_') and (not finite(binds[x]) or min(fbx_scales(binds[x]))<1e-6)]
+    if len(damaged)>0:
+        warnings.append("Degenerate bind matrices in the FBX (%s), using the fallback rig" % ", ".join(damaged[:3]))
+        fallback = True
+
+    # High heels lift the hips in the dump but not in the FBX bind pose (or the other way around)
+    r1 = hips_ratio({x: dump_position(matrices[x]) for x in matrices if finite(matrices[x])})
+    r2 = hips_ratio({x: fbx_position(binds[x]) for x in binds if finite(binds[x])})
+    if r1 is not None and r2 is not None and abs(r1-r2)>heel_tolerance:
+        errors.append("Root height offset between the Unity dump and the FBX (%.1f%% of the torso), high heels? Remove the shoes and export again" % (100.0*(r1-r2)))
+
+    t2 = time.time()
+    if not verbose:
+        return {"errors": errors, "warnings": warnings, "fallback": fallback}
+    print("Preflight: %d errors, %d warnings%s in %.3f s" % (len(errors), len(warnings), ", fallback rig" if fallback else "", t2-t1))
+    for x in errors:
+        print("    Error:", x)
+    for x in warnings:
+        print("    Warning:", x)
+    return {"errors": errors, "warnings": warnings, "fallback": fallback}
@@ -0,0 +1,50 @@
+import os
+import json
+
+#
+# Append-only journal of preset edits (assets/hs2blender.journal), one JSON record per line:
+#
+#   {"op": "field", "uuid": ..., "field": ..., "value": ...}    one preset field (name, colors, attribute, customization)
+#   {"op": "add", "id": ..., "preset": {...}}                   new preset, in the hs2blender.json format
+#   {"op": "delete", "uuid": ...}
+#   {"op": "favorite", "uuid": ..., "on": true}
+#   {"op": "setting", "key": ..., "value": ...}
+#
+# Each edit costs one short append. The records are applied to the preset store (compaction) by the
+# debounced autosave, by "Save presets", and by load_presets() if Blender went down before either of those.
+#
+
+journal_path = os.path.dirname(__file__)+"/assets/hs2blender.journal"
+
+def append(record):
+    try:
+        with open(journal_path, "a") as fp:
+            fp.write(json.dumps(record)+"\n")
+    except Exception as e:
+        print("Failed to write the preset journal:", e)
+
+# Records in order; a torn last line (crash during a write) is ignored
+def read():
+    out = []
+    try:
+        with open(journal_path, "r") as fp:
+            for line in fp:
+                try:
+                    out.append(json.loads(line))
+                except:
+                    pass
+    except:
+        pass
+    return out
+
+def clear():
+    try:
+        os.remove(journal_path)
+    except:
+        pass
+
+def size():
+    try:
+        return os.path.getsize(journal_path)
+    except:
+        return 0
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import preflight, preset_store
+except ImportError:
+    # run as a script (see the end of the file)
+    import preflight, preset_store
+
+#
+# Preset library health check.
+#
+# Checks every preset's dump directory the way import_body() would use it, without Blender:
+#   - exactly one Unity dump (.txt other than pose_*.txt) and one FBX
+#   - Textures/ with the main textures of skin_head, skin_body and eye (errors) and the converted
+#     skin bump maps (warnings: the importer runs without them, with flat skin)
+#   - the preflight checks of the FBX skeleton against the dump (preflight.py: bone sets, custom head,
+#     high heels, scales)
+#   - file sizes are not obviously truncated
+#
+# Directories are checked on a thread pool. Results are cached in assets/preset_scan.json, keyed by
+# the directory and the modification times of it, its Textures/ folder and its dumps and FBX files (signature()),
+# so a rescan only reads the dumps that were added, moved or re-exported.
+#
+# Command line, without Blender:
+#   python preset_scanner.py [--db assets/hs2blender.db] [--force] [--workers N] [dump dirs...]
+#
+
+cache_path = os.path.dirname(os.path.abspath(__file__))+"/assets/preset_scan.json"
+
+min_fbx_size = 1<<20
+min_dump_size = 64<<10
+min_texture_size = 64
+
+required_textures = [('skin_head', 'MainTex'), ('skin_body', 'MainTex'), ('eye', 'MainTex')]
+optional_textures = [('skin_head', 'BumpMap_converted'), ('skin_body', 'BumpMap_converted')]
+
+# Bumped when check() changes, so results cached by an older version are redone
+check_version = 2
+
+# normalized dump dir -> {"signature", "version", "status", "problems"}
+results = {}
+cache_loaded = False
+
+def norm(path):
+    return os.path.normpath(os.path.abspath(path))
+
+def load_cache():
+    global cache_loaded
+    cache_loaded = True
+    try:
+        with open(cache_path, "r") as fp:
+            results.update(json.load(fp))
+    except:
+        pass
+
+def save_cache():
+    try:
+        with open(cache_path, "w") as fp:
+            json.dump(results, fp)
+    except Exception as e:
+        print("Failed to write the preset scan cache:", e)
+
+# Modification times of the directory and its Textures/ folder, and names, sizes and modification times of
+# the dumps and FBX files (re-exporting over them doesn't change the directory's time)
+def signature(path):
+    out = []
+    for x in [path, os.path.join(path, "Textures")]:
+        try:
+            out.append(os.stat(x).st_mtime)
+        except OSError:
+            out.append(None)
+    try:
+        for x in sorted(os.listdir(path)):
+            if x.endswith('.txt') or x.endswith('.fbx'):
+                st = os.stat(os.path.join(path, x))
+                out.append([x, st.st_size, st.st_mtime])
+    except OSError:
+        pass
+    return out
+
+# Same match as importer.find_tex()
+def find_texture(files, x1, x2):
+    for y in files:
+        if (x1+'_' in y) and y.endswith("_"+x2+".png"):
+            return y
+    return None
+
+def check(path):
+    errors = []
+    warnings = []
+    if not os.path.isdir(path):
+        return "Error", ["Directory not found"]
+    files = os.listdir(path)
+    dumps = [x for x in files if x.endswith('.txt') and not x.startswith('pose_')]
+    fbxs = [x for x in files if x.endswith('.fbx')]
+    if len(dumps)==0:
+        errors.append("No Unity dump")
+    elif len(dumps)>1:
+        # import_body() would silently take the first one listed, which may not be the latest export
+        errors.append("%d Unity dumps (%s), remove all but one" % (len(dumps), ", ".join(sorted(dumps))))
+    if len(fbxs)==0:
+        errors.append("No FBX")
+    elif len(fbxs)>1:
+        warnings.append("%d FBX files, %s would be used" % (len(fbxs), fbxs[0]))
+
+    tex_dir = os.path.join(path, "Textures")
+    if not os.path.isdir(tex_dir):
+        errors.append("No Textures folder")
+    else:
+        textures = os.listdir(tex_dir)
+        for x1, x2 in required_textures+optional_textures:
+            y = find_texture(textures, x1, x2)
+            if y is None:
+                (errors if (x1, x2) in required_textures else warnings).append("Missing texture %s %s" % (x1, x2))
+            elif os.path.getsize(os.path.join(tex_dir, y))<min_texture_size:
+                errors.append("Truncated texture %s" % y)
+
+    if len(dumps)>0 and os.path.getsize(os.path.join(path, dumps[0]))<min_dump_size:
+        errors.append("Unity dump is only %d bytes" % os.path.getsize(os.path.join(path, dumps[0])))
+    if len(fbxs)>0 and os.path.getsize(os.path.join(path, fbxs[0]))<min_fbx_size:
+        errors.append("FBX is only %d bytes" % os.path.getsize(os.path.join(path, fbxs[0])))
+    if len(dumps)>0 and len(fbxs)>0:
+        r = preflight.check(os.path.join(path, fbxs[0]), os.path.join(path, dumps[0]), verbose=False)
+        errors += r["errors"]
+        warnings += r["warnings"]
+
+    if len(errors)>0:
+        return "Error", errors+warnings
+    if len(warnings)>0:
+        return "Warning", warnings
+    return "OK", []
+
+def scan_one(path, force):
+    key = norm(path)
+    sig = signature(key)
+    cached = results.get(key)
+    if not force and cached is not None and cached["signature"]==sig and cached.get("version")==check_version:
+        return key, cached, False
+    try:
+        status, problems = check(key)
+    except Exception as e:
+        status, problems = "Error", ["Scan failed: %s" % e]
+    return key, {"signature": sig, "version": check_version, "status": status, "problems": problems}, True
+
+# Checks the given dump directories; returns {normalized path: result}
+def scan(paths, workers=None, force=False):
+    if not cache_loaded:
+        load_cache()
+    t1 = time.time()
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1)*4)
+    out = {}
+    checked = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for key, r, fresh in pool.map(lambda x: scan_one(x, force), set(paths)):
+            results[key] = r
+            out[key] = r
+            checked += fresh
+    save_cache()
+    t2 = time.time()
+    counts = summary(out)
+    print("Scanned %d preset dirs (%d checked, %d cached): %d OK, %d warnings, %d errors in %.3f s" %
+        (len(out), checked, len(out)-checked, counts["OK"], counts["Warning"], counts["Error"], t2-t1))
+    return out
+
+def summary(res):
+    counts = {"OK": 0, "Warning": 0, "Error": 0}
+    for r in res.values():
+        counts[r["status"]] += 1
+    return counts
+
+# Cached result for one dump directory, None if it was never scanned, status "Stale" if it changed since
+# (or was checked by an older check_version)
+def status(path):
+    if not cache_loaded:
+        load_cache()
+    if len(path)==0:
+        return None
+    key = norm(path)
+    r = results.get(key)
+    if r is None:
+        return r
+    if r.get("version")!=check_version:
+        return {"signature": r["signature"], "status": "Stale", "problems": ["scanned by an older version of the checks, scan again"]}
+    if r["signature"]==json.loads(json.dumps(signature(key))):
+        return r
+    return {"signature": r["signature"], "status": "Stale", "problems": ["changed since the last scan, scan again"]}
+
+# Same as Preset.get_path()
+def preset_dir(waifus_path, path):
+    if len(path)>0:
+        if path[0]!='/':
+            return waifus_path+path
+        return path[1:]
+    return ""
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Check HS2 preset dump directories")
+    parser.add_argument("dirs", nargs="*", help="dump directories (default: all presets in the database)")
+    parser.add_argument("--db", default=os.path.dirname(os.path.abspath(__file__))+"/assets/hs2blender.db")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="ignore cached results")
+    args = parser.parse_args(argv)
+
+    names = {}
+    dirs = args.dirs
+    if len(dirs)==0:
+        conn = preset_store.open_store(args.db)
+        waifus_path = preset_store.get_setting(conn, "waifus_path", "")
+        for d in preset_store.all_presets(conn).values():
+            x = preset_dir(waifus_path, d["path"])
+            dirs.append(x)
+            names[norm(x)] = d["name"]
+    out = scan(dirs, workers=args.workers, force=args.force)
+    for key in sorted(out):
+        r = out[key]
+        if r["status"]!="OK":
+            print("%-8s %s (%s)" % (r["status"], names.get(key, key), key))
+            for x in r["problems"]:
+                print("         " + x)
+    return 1 if summary(out)["Error"]>0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,179 @@
+import os
+import json
+import uuid
+import sqlite3
+
+#
+# Preset store on SQLite (assets/hs2blender.db).
+#
+# Tables:
+#   settings(key, value)                          waifus_path
+#   presets(id, uuid, name, path, eye_color, hair_color)
+#   favorites(uuid)
+#   customizations(uuid, customization)
+#   attributes(uuid, name, value)                 material attributes and shape key values, as JSON
+#
+# create_from_json() builds the store from hs2blender.json in a temporary file and renames it into place, so a
+# failed import leaves no empty store behind; backup() copies the store to hs2blender.db.bak at startup.
+#
+# Presets are indexed by uuid and name. put_preset() / delete_preset() update one preset in a single
+# transaction, so a save only writes what changed. Presets go in and come out as plain dicts in the
+# hs2blender.json format ({"name", "path", "eye_color", "hair_color", "uuid", ...}), and
+# import_json_file() / export_json_file() convert from and to that file.
+#
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS presets (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE, name TEXT, path TEXT, eye_color TEXT, hair_color TEXT)",
+    "CREATE INDEX IF NOT EXISTS presets_name ON presets (name)",
+    "CREATE TABLE IF NOT EXISTS favorites (uuid TEXT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS customizations (uuid TEXT PRIMARY KEY, customization TEXT)",
+    "CREATE TABLE IF NOT EXISTS attributes (uuid TEXT NOT NULL, name TEXT NOT NULL, value TEXT, PRIMARY KEY (uuid, name))",
+]
+
+core_fields = ["name", "path", "eye_color", "hair_color", "uuid"]
+
+def open_store(path):
+    conn = sqlite3.connect(path)
+    with conn:
+        for x in schema:
+            conn.execute(x)
+    return conn
+
+# Number of presets in the store at 'path', 0 if there is none (without creating it)
+def stored_preset_count(path):
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM presets").fetchone()[0]
+    except sqlite3.Error:
+        return 0
+    finally:
+        conn.close()
+
+def create_from_json(path, json_path):
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = open_store(tmp_path)
+    try:
+        import_json_file(conn, json_path)
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+def backup(conn, path):
+    dest = sqlite3.connect(path)
+    try:
+        conn.backup(dest)
+    finally:
+        dest.close()
+
+def get_setting(conn, key, default=None):
+    row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+def set_setting(conn, key, value):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+def write_preset(conn, id, d):
+    uid = d["uuid"]
+    conn.execute("DELETE FROM presets WHERE id=? OR uuid=?", (id, uid))
+    conn.execute("INSERT INTO presets (id, uuid, name, path, eye_color, hair_color) VALUES (?, ?, ?, ?, ?, ?)",
+        (id, uid, d["name"], d["path"], json.dumps(list(d["eye_color"])), json.dumps(list(d["hair_color"]))))
+    conn.execute("DELETE FROM customizations WHERE uuid=?", (uid,))
+    if d.get("customization") is not None:
+        conn.execute("INSERT INTO customizations (uuid, customization) VALUES (?, ?)", (uid, d["customization"]))
+    conn.execute("DELETE FROM attributes WHERE uuid=?", (uid,))
+    conn.executemany("INSERT INTO attributes (uuid, name, value) VALUES (?, ?, ?)",
+        [(uid, x, json.dumps(d[x])) for x in d if not x in core_fields and x!="customization"])
+
+# Adds or replaces one preset
+def put_preset(conn, id, d):
+    with conn:
+        write_preset(conn, id, d)
+
+def delete_preset(conn, uid):
+    with conn:
+        conn.execute("DELETE FROM presets WHERE uuid=?", (uid,))
+        conn.execute("DELETE FROM customizations WHERE uuid=?", (uid,))
+        conn.execute("DELETE FROM attributes WHERE uuid=?", (uid,))
+        conn.execute("DELETE FROM favorites WHERE uuid=?", (uid,))
+
+def set_favorite(conn, uid, on):
+    with conn:
+        if on:
+            conn.execute("INSERT OR IGNORE INTO favorites (uuid) VALUES (?)", (uid,))
+        else:
+            conn.execute("DELETE FROM favorites WHERE uuid=?", (uid,))
+
+def favorites(conn):
+    return set([x[0] for x in conn.execute("SELECT uuid FROM favorites")])
+
+def row_to_preset(conn, row):
+    id, uid, name, path, eye_color, hair_color = row
+    d = {"name": name, "path": path, "eye_color": json.loads(eye_color), "hair_color": json.loads(hair_color), "uuid": uid}
+    c = conn.execute("SELECT customization FROM customizations WHERE uuid=?", (uid,)).fetchone()
+    if c is not None:
+        d["customization"] = c[0]
+    for name, value in conn.execute("SELECT name, value FROM attributes WHERE uuid=?", (uid,)):
+        d[name] = json.loads(value)
+    return d
+
+preset_columns = "id, uuid, name, path, eye_color, hair_color"
+
+def get_preset(conn, uid):
+    row = conn.execute("SELECT "+preset_columns+" FROM presets WHERE uuid=?", (uid,)).fetchone()
+    return None if row is None else row_to_preset(conn, row)
+
+def find_by_name(conn, name):
+    return [row_to_preset(conn, row) for row in conn.execute("SELECT "+preset_columns+" FROM presets WHERE name=?", (name,))]
+
+# {id: preset dict} of all presets, read with one query per table
+def all_presets(conn):
+    custom = dict(conn.execute("SELECT uuid, customization FROM customizations"))
+    attrs = {}
+    for uid, name, value in conn.execute("SELECT uuid, name, value FROM attributes"):
+        attrs.setdefault(uid, {})[name] = json.loads(value)
+    out = {}
+    for id, uid, name, path, eye_color, hair_color in conn.execute("SELECT "+preset_columns+" FROM presets ORDER BY id"):
+        d = {"name": name, "path": path, "eye_color": json.loads(eye_color), "hair_color": json.loads(hair_color), "uuid": uid}
+        if uid in custom:
+            d["customization"] = custom[uid]
+        d.update(attrs.get(uid, {}))
+        out[id] = d
+    return out
+
+#
+# hs2blender.json format
+#
+
+def import_json(conn, cfg):
+    with conn:
+        for x in ["presets", "customizations", "attributes", "favorites"]:
+            conn.execute("DELETE FROM "+x)
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ("waifus_path", cfg.get("waifus_path", "")))
+        for id, d in cfg.get("presets", {}).items():
+            if isinstance(d, list):
+                d = {"name": d[0], "path": d[1], "eye_color": d[2], "hair_color": d[3]}
+            if not "uuid" in d:
+                d["uuid"] = str(uuid.uuid4())
+            write_preset(conn, int(id), d)
+        conn.executemany("INSERT OR IGNORE INTO favorites (uuid) VALUES (?)", [(x,) for x in cfg.get("favorites", [])])
+
+def export_json(conn):
+    return {
+        "waifus_path": get_setting(conn, "waifus_path", ""),
+        "presets": {str(id): d for id, d in all_presets(conn).items()},
+        "favorites": sorted(favorites(conn)),
+    }
+
+def import_json_file(conn, path):
+    with open(path, "r") as fp:
+        import_json(conn, json.load(fp))
+
+def export_json_file(conn, path):
+    with open(path, "w") as fp:
+        json.dump(export_json(conn), fp, indent=4)
@@ -0,0 +1,66 @@
+import numpy as np
+
+#
+# Vertex regions declared as data.
+#
+# A region is a dict with a 'type' and its parameters:
+#
+#   {'type': 'sphere', 'center': (x, y, z), 'radius': r}       |co - center| < r
+#   {'type': 'box', 'min': (x, y, z), 'max': (x, y, z)}        min <= co < max, None = unbounded
+#   {'type': 'half_space', 'normal': (x, y, z), 'offset': d}   co . normal > d
+#   {'type': 'materials', 'materials': [...]}                  vertex of a face using one of the materials
+#
+# A rule list [(value, region), ...] assigns each vertex the value of the first region containing it.
+#
+
+def sphere_mask(region, co, vertex_materials):
+    d = co - np.array(region['center'], dtype=np.float32)
+    return (d*d).sum(axis=1) < region['radius']**2
+
+def box_mask(region, co, vertex_materials):
+    mask = np.ones([co.shape[0]], dtype=bool)
+    for axis in range(3):
+        if region['min'][axis] is not None:
+            mask &= co[:,axis] >= region['min'][axis]
+        if region['max'][axis] is not None:
+            mask &= co[:,axis] < region['max'][axis]
+    return mask
+
+def half_space_mask(region, co, vertex_materials):
+    return co @ np.array(region['normal'], dtype=np.float32) > region['offset']
+
+def materials_mask(region, co, vertex_materials):
+    return vertex_materials(region['materials'])
+
+region_masks = {
+    'sphere': sphere_mask,
+    'box': box_mask,
+    'half_space': half_space_mask,
+    'materials': materials_mask,
+}
+
+# co: (N,3) array
+# vertex_materials: function taking a list of materials, returning the (N,) bool mask of vertices that use them
+def region_mask(region, co, vertex_materials):
+    return region_masks[region['type']](region, co, vertex_materials)
+
+def classify(rules, default, co, vertex_materials):
+    out = np.full([co.shape[0]], default)
+    decided = np.zeros([co.shape[0]], dtype=bool)
+    for value, region in rules:
+        mask = region_mask(region, co, vertex_materials) & ~decided
+        out[mask] = value
+        decided |= mask
+    return out
+
+# Vertex mask for faces whose material is in 'materials', from the snapshot's loop and face views.
+# Strings name custom properties of obj holding the material (e.g. 'eye_mat').
+def mesh_vertex_materials(obj, snap):
+    def vertex_materials(materials):
+        materials = [obj[m] if isinstance(m, str) else m for m in materials]
+        slots = [i for i, slot in enumerate(obj.material_slots) if slot.material in materials]
+        mask = np.zeros([len(obj.data.vertices)], dtype=bool)
+        loop_verts = snap.loop_verts()
+        mask[loop_verts[np.isin(snap.face_materials()[snap.loop_faces()], slots)]] = True
+        return mask
+    return vertex_materials
@@ -0,0 +1,216 @@
+import bpy
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+from . import mesh_cache
+
+#
+# Shape key compaction.
+#
+# Blender stores every shape key as a dense float32 copy of all vertex coordinates, while the generated keys
+# ('Eye shape', 'Nails', 'Temple depress', ...) move a few hundred to a few thousand vertices.
+#
+#   compact(arm, body)                  drops generated keys identical to their relative key or to an earlier key
+#   compact(arm, body, bake_keys=True)  also moves the generated keys that are off (value 0) into a compressed
+#                                       sidecar, <dump dir>/shape_keys_<body>.npz, as (vertex indices, deltas)
+#   restore(body, names)                brings baked keys back (attributes.push_mat_attributes does it on demand)
+#
+# Only the keys this add-on generates (generated_keys) are dropped or baked; the FBX blendshapes stay as
+# they are, whatever their data. Keys with drivers and keys other keys are relative to are never touched.
+#
+
+delta_eps = 1e-5
+
+generated_keys = ['better_smile', 'Adams apple delete', 'Nostril pinch', 'Eye shape', 'Eyelid crease', 'Upper lip trough',
+    'Lip arch', 'Temple depress', 'Forehead flatten', 'Jaw soften', 'Jaw soften more', 'Nasolabial crease',
+    'Nails', 'Long fingernails', 'Long toenails']
+
+def key_coords(key, n):
+    co = np.zeros([n*3], dtype=np.float32)
+    key.data.foreach_get("co", co)
+    return co.reshape([-1,3])
+
+# Dense shape key data of the mesh, in MB
+def key_memory(body):
+    if body.data.shape_keys is None:
+        return 0.0
+    return len(body.data.shape_keys.key_blocks)*len(body.data.vertices)*12/1048576.0
+
+def protected_keys(body):
+    keys = body.data.shape_keys
+    out = set([keys.reference_key.name])
+    for k in keys.key_blocks:
+        if k.relative_key!=k:
+            out.add(k.relative_key.name)
+    if keys.animation_data is not None:
+        for d in keys.animation_data.drivers:
+            if d.data_path.startswith('key_blocks["'):
+                out.add(d.data_path.split('"')[1])
+    return out
+
+# (name, moved vertices, largest offset) for every key, relative to its relative key
+def key_stats(body):
+    if body.data.shape_keys is None:
+        return []
+    n = len(body.data.vertices)
+    keys = body.data.shape_keys
+    coords = {}
+    out = []
+    for k in keys.key_blocks:
+        if k==keys.reference_key:
+            continue
+        for x in [k, k.relative_key]:
+            if not x.name in coords:
+                coords[x.name] = key_coords(x, n)
+        d = np.abs(coords[k.name]-coords[k.relative_key.name]).max(axis=1)
+        out.append((k.name, int((d>delta_eps).sum()), float(d.max()) if n>0 else 0.0))
+    return out
+
+def report(body):
+    n = len(body.data.vertices)
+    print("%-28s %10s %8s %12s" % ("Shape key", "Moved", "%", "Max offset"))
+    for name, moved, largest in key_stats(body):
+        print("%-28s %10d %8.2f %12.6f" % (name, moved, 100.0*moved/max(n, 1), largest))
+
+# Removes generated keys with no offsets and generated keys identical to an earlier key with the same relative key
+def drop_redundant(body):
+    keys = body.data.shape_keys
+    if keys is None:
+        return []
+    n = len(body.data.vertices)
+    protected = protected_keys(body)
+    seen = {}
+    drop = []
+    for k in keys.key_blocks:
+        if k==keys.reference_key:
+            continue
+        co = key_coords(k, n)
+        delta = co-key_coords(k.relative_key, n)
+        droppable = k.name in generated_keys and not k.name in protected
+        if droppable and np.abs(delta).max(initial=0.0)<=delta_eps:
+            drop.append(k.name)
+            continue
+        h = (k.relative_key.name, hashlib.sha1((np.round(delta, 4)+0.0).tobytes()).hexdigest())
+        if h in seen and droppable and np.abs(co-key_coords(keys.key_blocks[seen[h]], n)).max(initial=0.0)<=delta_eps:
+            drop.append(k.name)
+            continue
+        seen.setdefault(h, k.name)
+    for name in drop:
+        body.shape_key_remove(key=keys.key_blocks[name])
+    return drop
+
+def topology_hash(body):
+    return hashlib.sha1(str(mesh_cache.topology_key(body.data)).encode()).hexdigest()
+
+def sidecar_path(arm, body):
+    if "shape_key_sidecar" in body:
+        return body["shape_key_sidecar"]
+    if arm is None or not "dump_dir" in arm:
+        return None
+    return os.path.join(arm["dump_dir"], "shape_keys_%s.npz" % bpy.path.clean_name(body.name))
+
+def read_sidecar(path):
+    try:
+        with np.load(path) as f:
+            return {x: f[x] for x in f.files}
+    except:
+        return {}
+
+# Moves generated keys that are off into the sidecar; returns the baked names
+def bake(arm, body, names=None):
+    keys = body.data.shape_keys
+    path = sidecar_path(arm, body)
+    if keys is None or path is None:
+        return []
+    protected = protected_keys(body)
+    if names is None:
+        names = [x for x in generated_keys if x in keys.key_blocks and keys.key_blocks[x].value==0.0]
+    names = [x for x in names if x in keys.key_blocks and not x in protected]
+    if len(names)==0:
+        return []
+
+    n = len(body.data.vertices)
+    entries = read_sidecar(path)
+    meta = json.loads(str(entries["meta"])) if "meta" in entries else {}
+    if entries.get("topology", None) is not None and str(entries["topology"])!=topology_hash(body):
+        entries = {}
+        meta = {}
+    for name in names:
+        k = keys.key_blocks[name]
+        delta = key_coords(k, n)-key_coords(k.relative_key, n)
+        idx = np.nonzero(np.abs(delta).max(axis=1)>delta_eps)[0]
+        entries["idx_"+name] = idx.astype(np.int32)
+        entries["delta_"+name] = delta[idx]
+        meta[name] = {'relative_key': k.relative_key.name, 'slider_min': k.slider_min, 'slider_max': k.slider_max,
+            'interpolation': k.interpolation, 'vertex_group': k.vertex_group, 'mute': k.mute}
+    entries["meta"] = np.array(json.dumps(meta))
+    entries["topology"] = np.array(topology_hash(body))
+    try:
+        np.savez_compressed(path, **entries)
+    except Exception as e:
+        print("Failed to write the shape key sidecar:", e)
+        return []
+    body["shape_key_sidecar"] = path
+    for name in names:
+        body.shape_key_remove(key=keys.key_blocks[name])
+    body["shape_keys_baked"] = sorted(set(baked_keys(body)+names))
+    return names
+
+# Names of the baked keys that are not in the mesh
+def baked_keys(body):
+    if body.data.shape_keys is None:
+        return []
+    return [x for x in body.get("shape_keys_baked", []) if not x in body.data.shape_keys.key_blocks]
+
+# Recreates baked keys (all of them if names is None); returns the restored names
+def restore(body, names=None):
+    if not "shape_key_sidecar" in body or body.data.shape_keys is None:
+        return []
+    entries = read_sidecar(body["shape_key_sidecar"])
+    if not "meta" in entries:
+        return []
+    if str(entries["topology"])!=topology_hash(body):
+        print("Shape key sidecar", body["shape_key_sidecar"], "does not match the mesh")
+        return []
+    meta = json.loads(str(entries["meta"]))
+    keys = body.data.shape_keys
+    n = len(body.data.vertices)
+    restored = []
+    for name in (meta if names is None else names):
+        if not name in meta or name in keys.key_blocks:
+            continue
+        m = meta[name]
+        rel = keys.key_blocks[m['relative_key']] if m['relative_key'] in keys.key_blocks else keys.reference_key
+        co = key_coords(rel, n)
+        co[entries["idx_"+name]] += entries["delta_"+name]
+        sk = body.shape_key_add(name=name, from_mix=False)
+        sk.data.foreach_set("co", co.reshape([-1]))
+        sk.relative_key = rel
+        sk.slider_min = m['slider_min']
+        sk.slider_max = m['slider_max']
+        sk.interpolation = m['interpolation']
+        sk.vertex_group = m['vertex_group']
+        sk.mute = m['mute']
+        sk.value = 0.0
+        restored.append(name)
+    body["shape_keys_baked"] = baked_keys(body)
+    return restored
+
+# Reports moved vertex counts, drops redundant keys and optionally bakes the generated keys that are off.
+# The key memory before and after is kept in body["shape_key_memory"] for the panel.
+def compact(arm, body, bake_keys=False):
+    if body.data.shape_keys is None:
+        return
+    t1 = time.time()
+    before = key_memory(body)
+    report(body)
+    dropped = drop_redundant(body)
+    baked = bake(arm, body) if bake_keys else []
+    after = key_memory(body)
+    body["shape_key_memory"] = (before, after)
+    t2 = time.time()
+    print("Shape keys: dropped", dropped, "baked", baked)
+    print("Shape key data %.1f MB -> %.1f MB in %.3f s" % (before, after, t2-t1))
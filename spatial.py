@@ -0,0 +1,125 @@
+import mathutils
+import numpy as np
+
+#
+# Nearest-neighbour queries over a fixed point set.
+#
+# Built on mathutils.kdtree, so memory stays linear in the number of points and every query is
+# O(log N), instead of the (N, M, 3) difference arrays the callers used to allocate.
+# Points can be 3D positions or 2D UVs (padded with z=0).
+# 'ids' maps tree slots back to the caller's indices (e.g. vertex indices of a subset);
+# several slots may share an id, which is how per-loop UVs of one vertex are stored.
+#
+
+def as_points(points):
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim==1:
+        points = points.reshape([1,-1])
+    if points.shape[1]==2:
+        points = np.concatenate([points, np.zeros([points.shape[0],1])], axis=1)
+    return points
+
+class PointIndex:
+    def __init__(self, points, ids=None):
+        points = as_points(points)
+        self.size = points.shape[0]
+        if ids is None:
+            self.ids = np.arange(self.size, dtype=np.int64)
+        else:
+            self.ids = np.asarray(ids, dtype=np.int64)
+        self.tree = mathutils.kdtree.KDTree(self.size)
+        for i in range(self.size):
+            self.tree.insert(points[i], i)
+        self.tree.balance()
+
+    # (ids, distances) of the nearest point to each query; -1 / inf if the index is empty
+    def nearest(self, queries):
+        queries = as_points(queries)
+        if self.size==0:
+            return np.full([queries.shape[0]], -1, dtype=np.int64), np.full([queries.shape[0]], np.inf, dtype=np.float64)
+        slots = np.zeros([queries.shape[0]], dtype=np.int64)
+        dists = np.zeros([queries.shape[0]], dtype=np.float64)
+        for i in range(queries.shape[0]):
+            co, index, dist = self.tree.find(queries[i])
+            slots[i] = index
+            dists[i] = dist
+        return self.ids[slots], dists
+
+    # (ids, distances), both (Q, k), nearest first. Rows are padded with -1 / inf if the index has fewer than k points
+    def knn(self, queries, k):
+        queries = as_points(queries)
+        ids = np.full([queries.shape[0], k], -1, dtype=np.int64)
+        dists = np.full([queries.shape[0], k], np.inf, dtype=np.float64)
+        for i in range(queries.shape[0] if self.size>0 else 0):
+            found = self.tree.find_n(queries[i], k)
+            for j, (co, index, dist) in enumerate(found):
+                ids[i,j] = self.ids[index]
+                dists[i,j] = dist
+        return ids, dists
+
+    # list of id arrays, one per query, sorted by distance
+    def within(self, queries, radius):
+        queries = as_points(queries)
+        out = []
+        for i in range(queries.shape[0]):
+            if self.size==0:
+                out.append(np.zeros([0], dtype=np.int64))
+                continue
+            found = self.tree.find_range(queries[i], radius)
+            found.sort(key=lambda z: z[2])
+            out.append(self.ids[[z[1] for z in found]] if len(found)>0 else np.zeros([0], dtype=np.int64))
+        return out
+
+    # (Q,) bool: does each query have a point within 'radius'
+    def any_within(self, queries, radius):
+        ids, dists = self.nearest(queries)
+        return dists<radius
+
+# Index over a subset of mesh vertices, given their coordinates as an (N,3) array
+def vertex_index(cos, subset=None):
+    if subset is None:
+        return PointIndex(cos)
+    subset = np.asarray(subset, dtype=np.int64)
+    return PointIndex(cos[subset], subset)
+
+# Index over the loop UVs of a subset of mesh vertices (see mesh_cache.vertex_loop_uvs), every
+# loop UV of a vertex is stored under that vertex's id, so seams don't hide a match.
+def loop_uv_index(offsets, loop_uvs, subset):
+    subset = np.asarray(subset, dtype=np.int64)
+    counts = offsets[subset+1]-offsets[subset]
+    ids = np.repeat(subset, counts)
+    firsts = np.zeros([len(subset)], dtype=np.int64)
+    np.cumsum(counts[:-1], out=firsts[1:])
+    slots = np.repeat(offsets[subset], counts) + np.arange(len(ids)) - np.repeat(firsts, counts)
+    return PointIndex(loop_uvs[slots], ids)
+
+# Uniform grid over 2D points (e.g. per-vertex UVs), for rectangle queries
+class GridIndex:
+    def __init__(self, points, cell=0.01):
+        self.points = np.asarray(points, dtype=np.float64)[:,:2]
+        self.cell = cell
+        cells = np.floor(self.points/cell).astype(np.int64)
+        self.origin = cells.min(axis=0) if len(cells)>0 else np.zeros([2], dtype=np.int64)
+        cells -= self.origin
+        self.shape = cells.max(axis=0)+1 if len(cells)>0 else np.ones([2], dtype=np.int64)
+        codes = cells[:,0]*self.shape[1] + cells[:,1]
+        self.order = np.argsort(codes, kind='stable')
+        self.codes = codes[self.order]
+
+    # Sorted ids of the points with u0 <= u <= u1 and v0 <= v <= v1
+    def in_rect(self, rect):
+        lo = np.floor(np.array(rect[:2])/self.cell).astype(np.int64) - self.origin
+        hi = np.floor(np.array(rect[2:])/self.cell).astype(np.int64) - self.origin
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, self.shape-1)
+        if (lo>hi).any():
+            return np.zeros([0], dtype=np.int64)
+        found = []
+        for ix in range(lo[0], hi[0]+1):
+            a = np.searchsorted(self.codes, ix*self.shape[1]+lo[1], 'left')
+            b = np.searchsorted(self.codes, ix*self.shape[1]+hi[1], 'right')
+            found.append(self.order[a:b])
+        ids = np.concatenate(found)
+        p = self.points[ids]
+        keep = (p[:,0]>=rect[0]) & (p[:,0]<=rect[2]) & (p[:,1]>=rect[1]) & (p[:,1]<=rect[3])
+        return np.sort(ids[keep])
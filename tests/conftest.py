@@ -0,0 +1,99 @@
+import os
+import sys
+import types
+import importlib.util
+from unittest import mock
+
+import numpy as np
+import pytest
+
+#
+# The add-on outside of Blender: bpy, bmesh and mathutils are stubbed, so modules can be imported and the
+# bpy-independent ones (spatial, catmull_clark, regions, preset_store, preset_journal, ...) tested with plain numpy.
+#
+#   python -m pytest -q
+#
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Blender imports the add-on under the name of its directory
+package_name = os.path.basename(package_dir)
+
+# Any attribute is a MagicMock
+class StubModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = mock.MagicMock(name=self.__name__+"."+name)
+        setattr(self, name, value)
+        return value
+
+# Any attribute is a fresh class, so add-on classes can derive from Operator, Panel, PropertyGroup, ...
+class TypesModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = type(name, (), {})
+        setattr(self, name, value)
+        return value
+
+# Brute-force stand-in for mathutils.kdtree.KDTree, same results as the real one
+class KDTree:
+    def __init__(self, size):
+        self.points = []
+        self.indices = []
+
+    def insert(self, co, index):
+        self.points.append([float(x) for x in co])
+        self.indices.append(index)
+
+    def balance(self):
+        self.array = np.array(self.points, dtype=np.float64).reshape([-1,3])
+
+    def found(self, co, order):
+        d = np.linalg.norm(self.array-np.asarray(co, dtype=np.float64)[:3], axis=1)
+        return [(tuple(self.array[i]), self.indices[i], float(d[i])) for i in order(d)]
+
+    def find(self, co):
+        if len(self.points)==0:
+            return None, None, None
+        return self.found(co, lambda d: [int(np.argmin(d))])[0]
+
+    def find_n(self, co, n):
+        return self.found(co, lambda d: np.argsort(d, kind='stable')[:n])
+
+    def find_range(self, co, radius):
+        return self.found(co, lambda d: np.nonzero(d<=radius)[0])
+
+def install_stubs():
+    bpy = StubModule("bpy")
+    bpy.types = TypesModule("bpy.types")
+    bpy.props = StubModule("bpy.props")
+    bpy.app = StubModule("bpy.app")
+    bpy.app.background = True
+    bpy.app.version = (4, 0, 0)
+    mathutils = StubModule("mathutils")
+    mathutils.kdtree = types.ModuleType("mathutils.kdtree")
+    mathutils.kdtree.KDTree = KDTree
+    for x in [bpy, bpy.types, bpy.props, bpy.app, mathutils, mathutils.kdtree, StubModule("bmesh")]:
+        sys.modules.setdefault(x.__name__, x)
+
+# Before pytest itself imports the add-on's __init__.py (the repo root is the package)
+install_stubs()
+
+def load_addon():
+    if package_name in sys.modules:
+        return sys.modules[package_name]
+    spec = importlib.util.spec_from_file_location(package_name, os.path.join(package_dir, "__init__.py"),
+        submodule_search_locations=[package_dir])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[package_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[package_name]
+        raise
+    return module
+
+@pytest.fixture(scope="session")
+def addon():
+    return load_addon()
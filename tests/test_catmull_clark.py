@@ -0,0 +1,59 @@
+import importlib
+
+import numpy as np
+import pytest
+
+from conftest import package_name
+
+@pytest.fixture
+def catmull_clark(addon):
+    return importlib.import_module(package_name+".catmull_clark")
+
+@pytest.fixture
+def quad_grid(addon):
+    return importlib.import_module(package_name+".benchmark").quad_grid
+
+def grid_positions(grid):
+    n = grid+1
+    x, y = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    return np.stack([y.reshape([-1]), x.reshape([-1]), np.zeros([n*n])], axis=1).astype(np.float32)
+
+def test_single_quad(catmull_clark, quad_grid):
+    op = catmull_clark.build_operator(*quad_grid(1))
+    assert op.shape==(4+4+1, 4)
+    co = grid_positions(1)
+    out = op.apply(co)
+    # boundary_smooth='ALL': corners move to (6 v + both neighbours) / 8, edge points are midpoints,
+    # the face point is the centroid
+    assert np.allclose(out[:4], [[0.125,0.125,0], [0.875,0.125,0], [0.125,0.875,0], [0.875,0.875,0]])
+    # (edges: bottom, top, left, right)
+    assert np.allclose(out[4:8], [[0.5,0,0], [0.5,1,0], [0,0.5,0], [1,0.5,0]])
+    assert np.allclose(out[8], [0.5,0.5,0])
+
+def test_rows_are_affine(catmull_clark, quad_grid):
+    nv, nf, edges, loop_verts, loop_edges, loop_faces = quad_grid(6)
+    op = catmull_clark.build_operator(nv, nf, edges, loop_verts, loop_edges, loop_faces)
+    sums = np.bincount(op.rows, weights=op.vals, minlength=op.shape[0])
+    assert np.allclose(sums, 1.0)
+    assert (op.vals>0).all()
+
+def test_flat_grid_is_reproduced(catmull_clark, quad_grid):
+    # A regular planar grid subdivides into the grid of half the spacing, except for the corners
+    # (boundary_smooth='ALL' rounds them off)
+    nv, nf, edges, loop_verts, loop_edges, loop_faces = quad_grid(4)
+    op = catmull_clark.build_operator(nv, nf, edges, loop_verts, loop_edges, loop_faces)
+    co = grid_positions(4)
+    out = op.apply(co)
+    corners = [0, 4, 20, 24]
+    assert np.allclose(np.delete(out[:nv], corners, axis=0), np.delete(co, corners, axis=0))
+    assert np.allclose(out[0], [0.125,0.125,0])
+    assert np.allclose(out[nv:nv+len(edges)], 0.5*(co[edges[:,0]]+co[edges[:,1]]))
+    face_centers = co[loop_verts].reshape([-1,4,3]).mean(axis=1)
+    assert np.allclose(out[nv+len(edges):], face_centers)
+
+def test_linear_in_positions(catmull_clark, quad_grid):
+    op = catmull_clark.build_operator(*quad_grid(3))
+    rng = np.random.default_rng(0)
+    a = rng.random([op.shape[1], 3]).astype(np.float32)
+    b = rng.random([op.shape[1], 3]).astype(np.float32)
+    assert np.allclose(op.apply(a+2*b), op.apply(a)+2*op.apply(b), atol=1e-5)
@@ -0,0 +1,92 @@
+import importlib
+import types
+
+import numpy as np
+import pytest
+
+from conftest import package_name
+
+@pytest.fixture
+def extras_cache(addon, tmp_path, monkeypatch):
+    module = importlib.import_module(package_name+".extras_cache")
+    monkeypatch.setattr(module, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(module, "use_cache", True)
+    module.loaded.clear()
+    return module
+
+# A mesh snapshot with its views filled in, open for a stand-in object
+def fake_body(mesh_cache, co, normals, edges, fingerprint="f"*40):
+    nv = len(co)
+    data = types.SimpleNamespace(vertices=[None]*nv, edges=[None]*len(edges), loops=[], polygons=[])
+    data.as_pointer = lambda: id(data)
+    body = types.SimpleNamespace(data=data, name="body", as_pointer=lambda: id(body))
+    snap = mesh_cache.MeshSnapshot(body)
+    snap.topology = (id(data),) + mesh_cache.topology_key(data)
+    edges = np.asarray(edges, dtype=np.int64)
+    src = np.concatenate([edges[:,0], edges[:,1]])
+    dst = np.concatenate([edges[:,1], edges[:,0]])
+    order = np.argsort(src, kind='stable')
+    offsets = np.zeros([nv+1], dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=nv), out=offsets[1:])
+    snap.views.update({
+        'co': np.asarray(co, dtype=np.float32),
+        'undeformed_co': np.asarray(co, dtype=np.float32),
+        'normals': np.asarray(normals, dtype=np.float32),
+        'adjacency': (offsets, dst[order]),
+        'fingerprint': fingerprint,
+        })
+    return body, snap
+
+def test_formula_reads(extras_cache):
+    assert extras_cache.formula_reads(lambda uv, **kwargs: uv[0]) == set()
+    assert extras_cache.formula_reads(lambda co, **kwargs: co[2]) == {'co'}
+    assert extras_cache.formula_reads(lambda **kwargs: kwargs['norm'][2]) == {'norm'}
+    body = None
+    def helper(vert):
+        return body
+    assert extras_cache.formula_reads(lambda vert, **kwargs: helper(vert)) == {'body'}
+
+def test_shared_by_topology(extras_cache, addon):
+    mesh_cache = importlib.import_module(package_name+".mesh_cache")
+    edges = [[0,1], [1,2], [2,0]]
+    uv_formula = lambda uv, **kwargs: uv[0]
+    co_formula = lambda co, **kwargs: co[2]
+    verts = [0, 1, 2]
+
+    body1, snap1 = fake_body(mesh_cache, [[0,0,0], [1,0,0], [0,1,0]], [[0,0,1]]*3, edges)
+    with snap1, extras_cache.Session():
+        key = extras_cache.entry_key(body1, 'vgroup', 'a', 'vg', uv_formula, verts)
+        assert extras_cache.lookup(key, verts) is None
+        extras_cache.store(key, verts, [0.1, 0.2, 0.3])
+        key = extras_cache.entry_key(body1, 'vgroup', 'b', 'vg', co_formula, verts)
+        extras_cache.store(key, verts, [0.0, 0.0, 0.0])
+    extras_cache.loaded.clear()
+
+    # another character with the same topology, another shape
+    body2, snap2 = fake_body(mesh_cache, [[0,0,1], [2,0,1], [0,2,1]], [[0,0,1]]*3, edges)
+    with snap2, extras_cache.Session():
+        key = extras_cache.entry_key(body2, 'vgroup', 'a', 'vg', uv_formula, verts)
+        assert np.allclose(extras_cache.lookup(key, verts), [0.1, 0.2, 0.3])
+        key = extras_cache.entry_key(body2, 'vgroup', 'b', 'vg', co_formula, verts)
+        assert extras_cache.lookup(key, verts) is None
+        # another vertex set
+        key = extras_cache.entry_key(body2, 'vgroup', 'a', 'vg', uv_formula, verts[:2])
+        assert extras_cache.lookup(key, verts[:2]) is None
+
+def test_offsets_follow_the_rest_shape(extras_cache, addon):
+    mesh_cache = importlib.import_module(package_name+".mesh_cache")
+    edges = [[0,1], [1,2], [2,0]]
+    formula = lambda uv, norm, **kwargs: norm*0.1
+    verts = [0, 1, 2]
+
+    body1, snap1 = fake_body(mesh_cache, [[0,0,0], [1,0,0], [0,1,0]], [[0,0,1]]*3, edges)
+    with snap1, extras_cache.Session():
+        key = extras_cache.entry_key(body1, 'shape_key', 'k', 'vg', formula, verts)
+        extras_cache.store_offsets(body1, key, verts, np.array([[0,0,0.1]]*3))
+
+    # the same triangle turned on its side: the offsets turn with it
+    body2, snap2 = fake_body(mesh_cache, [[0,0,0], [0,0,1], [0,1,0]], [[1,0,0]]*3, edges)
+    with snap2, extras_cache.Session():
+        key = extras_cache.entry_key(body2, 'shape_key', 'k', 'vg', formula, verts)
+        offsets = extras_cache.lookup_offsets(body2, key, verts)
+        assert np.allclose(offsets, [[0.1,0,0]]*3, atol=1e-6)
@@ -0,0 +1,25 @@
+import importlib
+import sys
+
+from conftest import load_addon, package_name
+
+modules = ["add_extras", "armature", "attributes", "benchmark", "catmull_clark", "character_library", "dump_watcher",
+    "extras_cache", "extras_scheduler", "fbx_reader", "importer", "library_builder", "mesh_cache", "preflight",
+    "preset_journal", "preset_scanner", "preset_store", "regions", "shape_key_store", "solve_for_deform",
+    "spatial", "weights"]
+
+def test_addon_imports():
+    addon = load_addon()
+    assert callable(addon.register)
+    assert callable(addon.unregister)
+
+def test_modules_import():
+    load_addon()
+    for x in modules:
+        assert importlib.import_module(package_name+"."+x) is sys.modules[package_name+"."+x]
+
+def test_extras_registry(addon):
+    extras_scheduler = importlib.import_module(package_name+".extras_scheduler")
+    assert len(extras_scheduler.mods)>0
+    names = [m.name for m in extras_scheduler.mods]
+    assert len(names)==len(set(names))
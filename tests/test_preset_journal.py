@@ -0,0 +1,87 @@
+import importlib
+import os
+
+import pytest
+
+from conftest import package_name
+
+# The add-on's preset state on a temporary store and journal
+@pytest.fixture
+def presets(addon, tmp_path, monkeypatch):
+    preset_store = importlib.import_module(package_name+".preset_store")
+    preset_journal = importlib.import_module(package_name+".preset_journal")
+    monkeypatch.setattr(preset_journal, "journal_path", str(tmp_path/"hs2blender.journal"))
+    db_path = str(tmp_path/"hs2blender.db")
+    conn = preset_store.open_store(db_path)
+    for i, name in enumerate(["A", "B", "C"]):
+        preset_store.put_preset(conn, i, {"name": name, "path": "dump_"+name, "eye_color": [0.0, 0.0, 0.8],
+            "hair_color": [0.8, 0.8, 0.5], "uuid": "uuid-"+name, "Fat": 0.0})
+    preset_store.set_favorite(conn, "uuid-A", True)
+    monkeypatch.setattr(addon, "preset_db", conn)
+    monkeypatch.setattr(addon, "preset_map", {x: addon.convert_preset_from_dict(d) for x, d in preset_store.all_presets(conn).items()})
+    monkeypatch.setattr(addon, "preset_favorites", preset_store.favorites(conn))
+    monkeypatch.setattr(addon, "presets_loaded", True)
+    monkeypatch.setattr(addon, "waifus_path", "/dumps/")
+    monkeypatch.setattr(addon, "pending_records", [])
+    monkeypatch.setattr(addon, "store_stale", False)
+    addon.presets_changed()
+    yield addon, preset_store, preset_journal, db_path
+    conn.close()
+    addon.presets_changed()
+
+def stored(preset_store, db_path):
+    conn = preset_store.open_store(db_path)
+    try:
+        return {d["uuid"]: d for d in preset_store.all_presets(conn).values()}, preset_store.favorites(conn)
+    finally:
+        conn.close()
+
+def test_replay_after_crash(presets):
+    addon, preset_store, preset_journal, db_path = presets
+    # records written by a session that ended before its autosave, the last one torn
+    new = addon.Preset("D", "dump_D", [0.1, 0.1, 0.1], [0.2, 0.2, 0.2], "uuid-D").as_dict()
+    for r in [{"op": "field", "uuid": "uuid-A", "field": "name", "value": "A renamed"},
+            {"op": "field", "uuid": "uuid-B", "field": "Fat", "value": 0.5},
+            {"op": "delete", "uuid": "uuid-C"},
+            {"op": "add", "id": 3, "preset": new},
+            {"op": "favorite", "uuid": "uuid-A", "on": False},
+            {"op": "favorite", "uuid": "uuid-D", "on": True},
+            {"op": "setting", "key": "waifus_path", "value": "/other/"}]:
+        preset_journal.append(r)
+    with open(preset_journal.journal_path, "a") as fp:
+        fp.write('{"op": "field", "uuid": "uuid-B", "fie')
+
+    assert addon.replay_journal()==7
+    assert addon.preset_map[0].name=="A renamed"
+    assert addon.preset_map[1]["Fat"]==0.5
+    assert not 2 in addon.preset_map
+    assert addon.preset_map[3].name=="D"
+    assert addon.preset_favorites=={"uuid-D"}
+    assert addon.waifus_path=="/other/"
+
+    addon.flush_presets()
+    assert not os.path.exists(preset_journal.journal_path)
+    assert addon.pending_records==[]
+    presets, favorites = stored(preset_store, db_path)
+    assert sorted(presets)==["uuid-A", "uuid-B", "uuid-D"]
+    assert presets["uuid-A"]["name"]=="A renamed"
+    assert presets["uuid-B"]["Fat"]==0.5
+    assert presets["uuid-D"]["hair_color"]==[0.2, 0.2, 0.2]
+    assert favorites=={"uuid-D"}
+    conn = preset_store.open_store(db_path)
+    assert preset_store.get_setting(conn, "waifus_path")=="/other/"
+    conn.close()
+
+def test_flush_writes_only_journaled_presets(presets):
+    addon, preset_store, preset_journal, db_path = presets
+    # an edit that was not journaled stays out of the store
+    addon.preset_map[2]["Fat"] = 1.0
+    addon.preset_map[1]["Fat"] = 0.75
+    addon.journal_field(addon.preset_map[1], "Fat")
+    assert len(preset_journal.read())==1
+    addon.flush_presets()
+    presets, favorites = stored(preset_store, db_path)
+    assert presets["uuid-B"]["Fat"]==0.75
+    assert presets["uuid-C"]["Fat"]==0.0
+    assert favorites=={"uuid-A"}
+    assert preset_journal.read()==[]
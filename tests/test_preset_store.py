@@ -0,0 +1,79 @@
+import importlib
+import json
+import os
+
+import pytest
+
+from conftest import package_name
+
+@pytest.fixture
+def preset_store(addon):
+    return importlib.import_module(package_name+".preset_store")
+
+def sample_preset(uid, name="Preset"):
+    return {"name": name, "path": "dump_"+name, "eye_color": [0.0, 0.0, 0.8], "hair_color": [0.8, 0.8, 0.5],
+        "uuid": uid, "customization": "nose 0.5", "Skin tone": [0.9, 0.7, 0.6], "Fat": 0.25}
+
+def test_round_trip(preset_store, tmp_path):
+    conn = preset_store.open_store(str(tmp_path/"presets.db"))
+    a = sample_preset("uuid-a", "A")
+    b = sample_preset("uuid-b", "B")
+    del b["customization"]
+    preset_store.put_preset(conn, 0, a)
+    preset_store.put_preset(conn, 1, b)
+    preset_store.set_favorite(conn, "uuid-b", True)
+    preset_store.set_setting(conn, "waifus_path", "/dumps/")
+    conn.close()
+
+    conn = preset_store.open_store(str(tmp_path/"presets.db"))
+    assert preset_store.all_presets(conn)=={0: a, 1: b}
+    assert preset_store.get_preset(conn, "uuid-a")==a
+    assert preset_store.find_by_name(conn, "B")==[b]
+    assert preset_store.favorites(conn)=={"uuid-b"}
+    assert preset_store.get_setting(conn, "waifus_path")=="/dumps/"
+
+    # replacing a preset drops the attributes it no longer has
+    a2 = dict(a, name="A2")
+    del a2["Fat"]
+    preset_store.put_preset(conn, 0, a2)
+    assert preset_store.get_preset(conn, "uuid-a")==a2
+
+    preset_store.delete_preset(conn, "uuid-b")
+    assert preset_store.all_presets(conn)=={0: a2}
+    assert preset_store.favorites(conn)==set()
+    conn.close()
+
+def test_json_round_trip(preset_store, tmp_path):
+    cfg = {"waifus_path": "/dumps/",
+        "presets": {"0": sample_preset("uuid-a", "A"), "3": ["Legacy", "dump_legacy", [0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]},
+        "favorites": ["uuid-a"]}
+    with open(tmp_path/"hs2blender.json", "w") as fp:
+        json.dump(cfg, fp)
+    db = str(tmp_path/"hs2blender.db")
+    assert preset_store.stored_preset_count(db)==0
+    preset_store.create_from_json(db, str(tmp_path/"hs2blender.json"))
+    assert not os.path.exists(db+".tmp")
+    assert preset_store.stored_preset_count(db)==2
+
+    conn = preset_store.open_store(db)
+    out = preset_store.export_json(conn)
+    assert out["waifus_path"]=="/dumps/"
+    assert out["favorites"]==["uuid-a"]
+    assert out["presets"]["0"]==cfg["presets"]["0"]
+    legacy = out["presets"]["3"]
+    assert legacy["name"]=="Legacy" and legacy["hair_color"]==[0.4, 0.5, 0.6] and len(legacy["uuid"])>0
+
+    preset_store.backup(conn, db+".bak")
+    conn.close()
+    backup = preset_store.open_store(db+".bak")
+    assert preset_store.export_json(backup)==out
+    backup.close()
+
+def test_failed_import_leaves_no_store(preset_store, tmp_path):
+    with open(tmp_path/"hs2blender.json", "w") as fp:
+        fp.write("{ truncated")
+    db = str(tmp_path/"hs2blender.db")
+    with pytest.raises(ValueError):
+        preset_store.create_from_json(db, str(tmp_path/"hs2blender.json"))
+    assert not os.path.exists(db)
+    assert preset_store.stored_preset_count(db)==0
@@ -0,0 +1,73 @@
+import importlib
+
+import numpy as np
+import pytest
+
+from conftest import package_name
+
+@pytest.fixture
+def spatial(addon):
+    return importlib.import_module(package_name+".spatial")
+
+def brute_nearest(points, queries):
+    d = np.linalg.norm(queries[:,None,:]-points[None,:,:], axis=2)
+    return np.argmin(d, axis=1), d.min(axis=1)
+
+def test_nearest(spatial):
+    rng = np.random.default_rng(0)
+    points = rng.random([200, 3])
+    queries = rng.random([50, 3])
+    ids, dists = spatial.PointIndex(points).nearest(queries)
+    expected_ids, expected_dists = brute_nearest(points, queries)
+    assert (ids==expected_ids).all()
+    assert np.allclose(dists, expected_dists)
+
+def test_ids_and_uvs(spatial):
+    # 2D points are padded with z=0, slots map back to the caller's ids
+    uvs = np.array([[0.1, 0.1], [0.9, 0.9], [0.5, 0.5]])
+    index = spatial.PointIndex(uvs, ids=[7, 3, 7])
+    ids, dists = index.nearest([[0.45, 0.5], [1.0, 1.0]])
+    assert list(ids)==[7, 3]
+    assert np.allclose(dists, [0.05, np.sqrt(0.02)])
+
+def test_knn_and_within(spatial):
+    points = np.array([[0,0,0], [1,0,0], [3,0,0]], dtype=np.float64)
+    index = spatial.PointIndex(points)
+    ids, dists = index.knn([[0.9,0,0]], 5)
+    assert list(ids[0])==[1, 0, 2, -1, -1]
+    assert np.allclose(dists[0,:3], [0.1, 0.9, 2.1])
+    assert np.isinf(dists[0,3:]).all()
+    found = index.within([[0.9,0,0], [10,0,0]], 1.0)
+    assert list(found[0])==[1, 0]
+    assert len(found[1])==0
+    assert list(index.any_within([[0.9,0,0], [10,0,0]], 1.0))==[True, False]
+
+def test_empty_index(spatial):
+    index = spatial.PointIndex(np.zeros([0, 3]))
+    ids, dists = index.nearest([[0,0,0], [1,1,1]])
+    assert list(ids)==[-1, -1]
+    assert np.isinf(dists).all()
+    ids, dists = index.knn([[0,0,0]], 3)
+    assert (ids==-1).all() and np.isinf(dists).all()
+    assert [len(x) for x in index.within([[0,0,0]], 1.0)]==[0]
+    assert not index.any_within([[0,0,0]], 1.0).any()
+
+def test_loop_uv_index(spatial):
+    # vertex 1 has two loop UVs (a seam); either one finds it
+    offsets = np.array([0, 1, 3, 4])
+    loop_uvs = np.array([[0.0, 0.0], [0.2, 0.2], [0.8, 0.8], [0.5, 0.0]])
+    index = spatial.loop_uv_index(offsets, loop_uvs, [1, 2])
+    ids, dists = index.nearest([[0.21, 0.2], [0.79, 0.8], [0.5, 0.05]])
+    assert list(ids)==[1, 1, 2]
+
+def test_grid_in_rect(spatial):
+    rng = np.random.default_rng(1)
+    uvs = rng.random([2000, 2])
+    grid = spatial.GridIndex(uvs)
+    for rect in [(0.2, 0.3, 0.4, 0.35), (0.0, 0.0, 1.0, 1.0), (0.55, 0.1, 0.551, 0.9), (-1.0, -1.0, -0.5, -0.5), (0.9, 0.9, 2.0, 2.0)]:
+        expected = np.nonzero((uvs[:,0]>=rect[0]) & (uvs[:,0]<=rect[2]) & (uvs[:,1]>=rect[1]) & (uvs[:,1]<=rect[3]))[0]
+        assert list(grid.in_rect(rect))==list(expected)
+
+def test_grid_empty(spatial):
+    grid = spatial.GridIndex(np.zeros([0, 2]))
+    assert len(grid.in_rect((0.0, 0.0, 1.0, 1.0)))==0
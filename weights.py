@@ -0,0 +1,81 @@
+import time
+import numpy as np
+
+from . import mesh_cache
+
+#
+# Weight cleanup on the sparse weight matrix, without weight paint mode and bpy.ops.
+#
+# clean_weights() does what vertex_group_clean does (drop weights at or below a threshold), and optionally keeps
+# only the 'limit' largest deform weights of each vertex. With normalize=True, the remaining deform weights of
+# the vertices that lost something are scaled back to their original total; vertex_group_clean doesn't do
+# that, so the body is cleaned without it (its deformation stays what it was) and only clothing that loses
+# influences to the limit is renormalized.
+# The weights are read from the mesh snapshot's weight index (built once per open MeshSnapshot, and usually
+# already there during the import), changes are committed in bulk: one remove() call per group, and
+# vertex_groups[].add() for the rescaled weights.
+#
+# Influence limit for clothing at import (None = no limit); the body keeps all its influences
+clothing_influence_limit = 8
+
+# One entry per (vertex, group) pair: vertex, group index, weight
+def read_weights(obj):
+    index = mesh_cache.snapshot(obj).weights()
+    sizes = [len(index[g]) for g in index]
+    verts = np.concatenate([np.fromiter(index[g].keys(), dtype=np.int64, count=len(index[g])) for g in index] + [np.zeros([0], dtype=np.int64)])
+    weights = np.concatenate([np.fromiter(index[g].values(), dtype=np.float64, count=len(index[g])) for g in index] + [np.zeros([0])])
+    groups = np.repeat(np.array(list(index.keys()), dtype=np.int64), sizes)
+    return verts, groups, weights
+
+def deform_groups(obj, arm):
+    mask = np.zeros([len(obj.vertex_groups)], dtype=bool)
+    for g in obj.vertex_groups:
+        mask[g.index] = arm is None or (g.name in arm.data.bones and arm.data.bones[g.name].use_deform)
+    return mask
+
+# Average and largest number of deform influences per vertex
+def influence_stats(verts, deform, n):
+    counts = np.bincount(verts[deform], minlength=n)
+    return (counts.mean() if n>0 else 0.0), int(counts.max(initial=0))
+
+def clean_weights(obj, arm=None, threshold=0.005, limit=None, normalize=False):
+    t1 = time.time()
+    mesh = obj.data
+    n = len(mesh.vertices)
+    verts, groups, w = read_weights(obj)
+    if len(verts)==0:
+        return
+    deform = deform_groups(obj, arm)[groups]
+    before = influence_stats(verts, deform, n)
+
+    keep = w > threshold
+    if limit is not None:
+        # rank of each surviving deform weight within its vertex, largest first
+        order = np.lexsort((-w, verts))
+        order = order[(deform & keep)[order]]
+        v = verts[order]
+        rank = np.arange(len(order)) - np.searchsorted(v, v, 'left')
+        keep[order[rank>=limit]] = False
+
+    new_w = np.where(keep, w, 0.0)
+    if normalize:
+        total = np.bincount(verts[deform], weights=w[deform], minlength=n)
+        kept = np.bincount(verts[deform], weights=new_w[deform], minlength=n)
+        scale = np.where(kept>0, total/np.maximum(kept, 1e-12), 1.0)
+        new_w = np.where(deform, np.minimum(new_w*scale[verts], 1.0), new_w)
+
+    changed = np.nonzero(keep & (np.abs(new_w-w)>1e-7))[0]
+    for i in changed:
+        obj.vertex_groups[int(groups[i])].add([int(verts[i])], float(new_w[i]), 'REPLACE')
+    dropped = np.nonzero(~keep)[0]
+    dropped = dropped[np.argsort(groups[dropped], kind='stable')]
+    bounds = np.nonzero(np.diff(groups[dropped]))[0]+1
+    for part in np.split(dropped, bounds):
+        if len(part)>0:
+            obj.vertex_groups[int(groups[part[0]])].remove(verts[part].tolist())
+    mesh_cache.touch(obj, 'weights')
+
+    after = influence_stats(verts[keep], deform[keep], n)
+    t2 = time.time()
+    print("%s: %d weights dropped, %d rescaled, deform influences per vertex avg %.2f max %d -> avg %.2f max %d in %.3f s" %
+        (obj.name, len(dropped), len(changed), before[0], before[1], after[0], after[1], t2-t1))